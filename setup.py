@@ -10,6 +10,7 @@ setup(
     'markdown==2.3.1',
     'pygments==1.6',
     'lxml==3.2.3',
-    'Pillow==2.1.0'
+    'Pillow==2.1.0',
+    'numpy==1.16.6'
     ]
 )
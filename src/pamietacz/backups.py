@@ -0,0 +1,526 @@
+from django.conf import settings
+from datetime import datetime
+import atexit
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import struct
+import threading
+import zlib
+
+# VACUUM INTO which writes copy of database in one transaction was added
+# in this version of SQLite.
+VACUUM_INTO_VERSION = (3, 27, 0)
+
+# Snapshots are split into chunks of whole pages of about this size on
+# average so chunks which didn't change are shared by snapshots. Chunk has
+# at most MAX_CHUNK_FACTOR times more pages than average.
+SNAPSHOT_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_FACTOR = 4
+SQLITE_HEADER = "SQLite format 3\0"
+# Page size of files which aren't SQLite databases.
+DEFAULT_PAGE_SIZE = 4096
+SNAPSHOT_NAME_FORMAT = "%Y_%m_%d_%H_%M_%S_%f"
+
+# Sizes of WAL header and header of frame which is followed by page.
+WAL_HEADER_SIZE = 32
+WAL_FRAME_HEADER_SIZE = 24
+# WAL is checkpointed by archive when it's bigger than this size.
+WAL_CHECKPOINT_SIZE = 4 * 1024 * 1024
+
+logger = logging.getLogger(__name__)
+
+# Functions which give period of time of snapshot by retention period.
+RETENTION_PERIODS = {
+    "hourly": lambda time: (time.date(), time.hour),
+    "daily": lambda time: time.date(),
+    "weekly": lambda time: time.isocalendar()[:2],
+}
+
+
+def can_snapshot_wal():
+    """Return True if database in WAL mode can be snapshotted."""
+    return sqlite3.sqlite_version_info >= VACUUM_INTO_VERSION
+
+
+def snapshot_database(database_name, snapshot_file_name):
+    """Write consistent copy of SQLite database which can be changed by
+    other connections in the meantime. Python 2 doesn't have the online
+    backup API so copy is written by VACUUM INTO or, by older SQLite,
+    database file is copied in read transaction which keeps writers from
+    changing it. Older SQLite can't copy database in WAL mode because
+    committed pages can be only in WAL and checkpoint can change database
+    file while it's copied."""
+    connection = sqlite3.connect(database_name, isolation_level=None)
+    try:
+        if can_snapshot_wal():
+            connection.execute("VACUUM INTO ?", [snapshot_file_name])
+            return
+        journal_mode, = connection.execute("PRAGMA journal_mode").fetchone()
+        if journal_mode.lower() == "wal":
+            raise ValueError("Snapshot of database in WAL mode needs SQLite "
+                             "%s or newer." %
+                             ".".join(map(str, VACUUM_INTO_VERSION)))
+        connection.execute("BEGIN")
+        connection.execute("SELECT COUNT(*) FROM sqlite_master")
+        shutil.copy(database_name, snapshot_file_name)
+        connection.execute("COMMIT")
+    finally:
+        connection.close()
+
+
+class SnapshotStore(object):
+    """Snapshots of database kept in chunks named by their hash so chunks
+    which didn't change are kept once. Chunks are compressed. Snapshot is
+    described by manifest (JSON) with hash of whole database and list of
+    chunks."""
+
+    def __init__(self, directory, chunk_size=SNAPSHOT_CHUNK_SIZE):
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.chunks_directory = os.path.join(directory, "chunks")
+        self.snapshots_directory = os.path.join(directory, "snapshots")
+
+    def snapshots(self):
+        """Names of snapshots from the oldest."""
+        if not os.path.isdir(self.snapshots_directory):
+            return []
+        return sorted(name[:-len(".json")]
+                      for name in os.listdir(self.snapshots_directory)
+                      if name.endswith(".json"))
+
+    def manifest_path(self, name):
+        return os.path.join(self.snapshots_directory, name + ".json")
+
+    def chunk_path(self, chunk_hash):
+        return os.path.join(self.chunks_directory, chunk_hash[:2],
+                            chunk_hash)
+
+    def get_manifest(self, name):
+        with open(self.manifest_path(name)) as f:
+            return json.load(f)
+
+    def add(self, database_name, now=None):
+        """Take snapshot of database. Return its name or None if database
+        didn't change since the last snapshot."""
+        copy_file_name = os.path.join(self.directory, "snapshot.tmp")
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # Copy left by snapshot which failed (VACUUM INTO doesn't write to
+        # existing file).
+        remove_file(copy_file_name)
+        try:
+            snapshot_database(database_name, copy_file_name)
+            return self.add_file(copy_file_name, now)
+        finally:
+            remove_file(copy_file_name)
+
+    def add_file(self, file_name, now=None, skip_unchanged=True):
+        """Add snapshot of database from file. Return its name or None if
+        snapshot is skipped because it's the same as the last one."""
+        now = now or datetime.now()
+        for directory in [self.chunks_directory, self.snapshots_directory]:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        database_hash = hashlib.sha1()
+        chunks = []
+        with open(file_name, "rb") as f:
+            for chunk in self.read_chunks(f):
+                database_hash.update(chunk)
+                chunks.append(self.store_chunk(chunk))
+        snapshots = self.snapshots()
+        if (skip_unchanged and snapshots and
+                self.get_manifest(snapshots[-1])["hash"] ==
+                database_hash.hexdigest()):
+            return None
+        name = now.strftime(SNAPSHOT_NAME_FORMAT)
+        write_file(self.manifest_path(name),
+                   json.dumps({"hash": database_hash.hexdigest(),
+                               "chunks": chunks}))
+        return name
+
+    def read_chunks(self, f):
+        """Split database file into chunks of whole pages. Chunk ends after
+        page which hash is divisible by the average number of pages in
+        chunk (content-defined chunking). VACUUM moves pages after pages
+        which were inserted before them, the boundaries of chunks move with
+        them so chunks of moved pages which didn't change are shared."""
+        page_size = read_page_size(f)
+        pages_in_chunk = max(self.chunk_size // page_size, 1)
+        pages = []
+        for page in iter(lambda: f.read(page_size), ""):
+            pages.append(page)
+            page_hash = int(hashlib.sha1(page).hexdigest()[:8], 16)
+            if (page_hash % pages_in_chunk == 0 or
+                    len(pages) >= MAX_CHUNK_FACTOR * pages_in_chunk):
+                yield "".join(pages)
+                pages = []
+        if pages:
+            yield "".join(pages)
+
+    def store_chunk(self, chunk):
+        chunk_hash = hashlib.sha1(chunk).hexdigest()
+        path = self.chunk_path(chunk_hash)
+        if not os.path.exists(path):
+            if not os.path.isdir(os.path.dirname(path)):
+                os.mkdir(os.path.dirname(path))
+            write_file(path, zlib.compress(chunk))
+        return chunk_hash
+
+    def restore(self, name, database_name):
+        """Write database from snapshot. Database file is replaced only
+        after the whole snapshot was written and checked."""
+        restored_file_name = database_name + ".restored"
+        self.write(name, restored_file_name)
+        replace_database(restored_file_name, database_name)
+
+    def write(self, name, file_name):
+        """Write database from snapshot to file and check its hash."""
+        manifest = self.get_manifest(name)
+        database_hash = hashlib.sha1()
+        with open(file_name, "wb") as f:
+            for chunk_hash in manifest["chunks"]:
+                with open(self.chunk_path(chunk_hash), "rb") as chunk_file:
+                    chunk = zlib.decompress(chunk_file.read())
+                database_hash.update(chunk)
+                f.write(chunk)
+        if database_hash.hexdigest() != manifest["hash"]:
+            os.remove(file_name)
+            raise ValueError("Snapshot %s is damaged." % name)
+
+    def remove_old(self, retention):
+        """Keep the newest snapshot and the newest snapshot from each of
+        last periods given in retention (e.g. {"hourly": 24, "daily": 7}),
+        remove the other snapshots and chunks which aren't used by the
+        kept snapshots. Return names of removed snapshots."""
+        snapshots = self.snapshots()
+        keep = set(snapshots[-1:])
+        for period, number in retention.iteritems():
+            periods = set()
+            for name in reversed(snapshots):
+                key = RETENTION_PERIODS[period](parse_name(name))
+                if key not in periods and len(periods) < number:
+                    periods.add(key)
+                    keep.add(name)
+        removed = [name for name in snapshots if name not in keep]
+        for name in removed:
+            self.remove(name)
+        if removed:
+            self.remove_unused_chunks()
+        return removed
+
+    def remove(self, name):
+        os.remove(self.manifest_path(name))
+
+    def remove_unused_chunks(self):
+        used = set()
+        for name in self.snapshots():
+            used.update(self.get_manifest(name)["chunks"])
+        for directory in os.listdir(self.chunks_directory):
+            for chunk_hash in os.listdir(os.path.join(self.chunks_directory,
+                                                      directory)):
+                if chunk_hash not in used:
+                    os.remove(self.chunk_path(chunk_hash))
+
+
+class WALArchive(object):
+    """Archive of SQLite database in WAL mode. WAL is archived in
+    generations: generation starts with copy of database file (kept in
+    snapshot store so chunks which didn't change are shared) when WAL with
+    new salt is seen and then new frames of WAL are added as segments.
+    Database can be restored to the time of any segment.
+
+    Archive keeps connection to database open so WAL isn't checkpointed
+    when application closes the last connection. Application mustn't
+    checkpoint WAL itself (wal_autocheckpoint is 0 when
+    WAL_ARCHIVE_DIRECTORY is set), WAL is checkpointed by archive when it's
+    bigger than checkpoint size."""
+
+    def __init__(self, directory, database_name):
+        self.database_name = database_name
+        self.store = SnapshotStore(os.path.join(directory, "bases"))
+        self.generations_directory = os.path.join(directory, "generations")
+        self.connection = None
+
+    def generations(self):
+        """Names of generations (names of their base snapshots) from the
+        oldest."""
+        if not os.path.isdir(self.generations_directory):
+            return []
+        return sorted(os.listdir(self.generations_directory))
+
+    def generation_path(self, generation, *names):
+        return os.path.join(self.generations_directory, generation, *names)
+
+    def get_state(self, generation):
+        with open(self.generation_path(generation, "state.json")) as f:
+            return json.load(f)
+
+    def segments(self, generation):
+        return sorted(name[:-len(".frames")]
+                      for name in os.listdir(self.generation_path(generation))
+                      if name.endswith(".frames"))
+
+    def archive(self, now=None, checkpoint_size=WAL_CHECKPOINT_SIZE):
+        """Add frames which were written to WAL since the last time. Return
+        the number of archived bytes."""
+        now = now or datetime.now()
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.database_name,
+                                              isolation_level=None)
+            self.connection.execute("PRAGMA wal_autocheckpoint = 0")
+        wal_name = self.database_name + "-wal"
+        header = read_wal_header(wal_name)
+        if header is None:
+            return 0
+        # Base of new generation is copied before writers are locked out.
+        generation, state = self.get_generation(header, now)
+        # Writers wait until WAL is read so it isn't changed meanwhile.
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            with open(wal_name, "rb") as wal:
+                # WAL is reset only after checkpoint of archive.
+                if wal.read(WAL_HEADER_SIZE) != header:
+                    return 0
+                wal.seek(state["offset"])
+                frames = read_committed_frames(wal, state["page_size"],
+                                               header[16:24])
+            if frames:
+                write_file(self.generation_path(
+                    generation, now.strftime(SNAPSHOT_NAME_FORMAT) +
+                    ".frames"), zlib.compress(frames))
+                state["offset"] += len(frames)
+                write_file(self.generation_path(generation, "state.json"),
+                           json.dumps(state))
+            wal_size = os.path.getsize(wal_name)
+        finally:
+            self.connection.execute("COMMIT")
+        if wal_size > checkpoint_size:
+            # Frames written after they were archived and before WAL is
+            # truncated are in base of the next generation.
+            self.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return len(frames)
+
+    def get_generation(self, header, now):
+        """Return generation of WAL and its state, new generation is
+        started if WAL has new salt."""
+        salt = header[16:24].encode("hex")
+        generations = self.generations()
+        if generations:
+            state = self.get_state(generations[-1])
+            if state["salt"] == salt:
+                return generations[-1], state
+        # Database file is changed only by checkpoint of archive so it's
+        # copied while application writes to WAL.
+        base_file_name = os.path.join(self.generations_directory, "base.tmp")
+        if not os.path.isdir(self.generations_directory):
+            os.makedirs(self.generations_directory)
+        version = file_version(self.database_name)
+        shutil.copyfile(self.database_name, base_file_name)
+        try:
+            if file_version(self.database_name) != version:
+                raise ValueError("Database file was changed while it was "
+                                 "copied, WAL has to be checkpointed only "
+                                 "by archive.")
+            generation = self.store.add_file(base_file_name, now,
+                                             skip_unchanged=False)
+        finally:
+            os.remove(base_file_name)
+        state = {"salt": salt,
+                 "page_size": struct.unpack(">I", header[8:12])[0],
+                 "offset": WAL_HEADER_SIZE}
+        os.mkdir(self.generation_path(generation))
+        write_file(self.generation_path(generation, "state.json"),
+                   json.dumps(state))
+        return generation, state
+
+    def restore(self, time, database_name):
+        """Restore database to the state of the last segment archived at
+        given time."""
+        generations = [generation for generation in self.generations()
+                       if parse_name(generation) <= time]
+        if not generations:
+            raise ValueError("There is no archive before %s." % time)
+        generation = generations[-1]
+        page_size = self.get_state(generation)["page_size"]
+        restored_file_name = database_name + ".restored"
+        self.store.write(generation, restored_file_name)
+        database_pages = None
+        with open(restored_file_name, "r+b") as restored_file:
+            for segment in self.segments(generation):
+                if parse_name(segment) > time:
+                    break
+                with open(self.generation_path(
+                        generation, segment + ".frames"), "rb") as f:
+                    frames = zlib.decompress(f.read())
+                frame_size = WAL_FRAME_HEADER_SIZE + page_size
+                for offset in range(0, len(frames), frame_size):
+                    page_number, commit_pages = struct.unpack(
+                        ">II", frames[offset:offset + 8])
+                    restored_file.seek((page_number - 1) * page_size)
+                    restored_file.write(frames[
+                        offset + WAL_FRAME_HEADER_SIZE:offset + frame_size])
+                    if commit_pages:
+                        database_pages = commit_pages
+            if database_pages is not None:
+                restored_file.truncate(database_pages * page_size)
+        replace_database(restored_file_name, database_name)
+        return generation
+
+    def remove_old(self, time):
+        """Remove generations which aren't needed to restore database to
+        given time or later. Return names of removed generations."""
+        generations = self.generations()
+        removed = [generation for generation, next_generation in
+                   zip(generations, generations[1:])
+                   if parse_name(next_generation) <= time]
+        for generation in removed:
+            shutil.rmtree(self.generation_path(generation))
+            self.store.remove(generation)
+        if removed:
+            self.store.remove_unused_chunks()
+        return removed
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+def read_wal_header(wal_name):
+    """Return header of WAL or None if WAL is empty."""
+    try:
+        with open(wal_name, "rb") as wal:
+            header = wal.read(WAL_HEADER_SIZE)
+    except IOError:
+        return None
+    return header if len(header) == WAL_HEADER_SIZE else None
+
+
+def file_version(file_name):
+    status = os.stat(file_name)
+    return status.st_size, status.st_mtime
+
+
+def read_committed_frames(wal, page_size, salt):
+    """Read frames of WAL to the end of the last committed transaction.
+    Frames with other salt are left from previous generation of WAL."""
+    frame_size = WAL_FRAME_HEADER_SIZE + page_size
+    frames = []
+    committed = 0
+    while True:
+        frame = wal.read(frame_size)
+        if len(frame) < frame_size or frame[8:16] != salt:
+            break
+        frames.append(frame)
+        if struct.unpack(">I", frame[4:8])[0]:
+            committed = len(frames)
+    return "".join(frames[:committed])
+
+
+def read_page_size(f):
+    """Read page size from header of SQLite database file."""
+    header = f.read(len(SQLITE_HEADER) + 2)
+    f.seek(0)
+    if not header.startswith(SQLITE_HEADER):
+        return DEFAULT_PAGE_SIZE
+    page_size = struct.unpack(">H", header[len(SQLITE_HEADER):])[0]
+    # Page size 65536 doesn't fit in 2 bytes and it's written as 1.
+    return 65536 if page_size == 1 else page_size
+
+
+def parse_name(name):
+    return datetime.strptime(name, SNAPSHOT_NAME_FORMAT)
+
+
+def replace_database(file_name, database_name):
+    """Move restored file in place of database. WAL of replaced database
+    is removed so it isn't applied to restored database."""
+    for suffix in ["-wal", "-shm"]:
+        if os.path.exists(database_name + suffix):
+            os.remove(database_name + suffix)
+    os.rename(file_name, database_name)
+
+
+def remove_file(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def write_file(path, content):
+    """Write file so it's never seen half-written."""
+    with open(path + ".tmp", "wb") as f:
+        f.write(content)
+    os.rename(path + ".tmp", path)
+
+
+def backup_db():
+    """Take snapshot of database and remove old snapshots. Store is locked
+    so chunks used by snapshot of other process aren't removed."""
+    store = SnapshotStore(settings.BACKUP_DIRECTORY)
+    if not os.path.isdir(store.directory):
+        os.makedirs(store.directory)
+    with open(os.path.join(store.directory, "lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        name = store.add(settings.DATABASES["default"]["NAME"])
+        if name is not None:
+            store.remove_old(settings.BACKUP_RETENTION)
+    return name
+
+
+class BackupService(object):
+    """Backups made in background thread so requests don't wait for them.
+    The first request starts the window and all requests in the window are
+    coalesced into one backup made when the window passes."""
+
+    def __init__(self, window, make_backup=backup_db):
+        self.window = window
+        self.make_backup = make_backup
+        self.lock = threading.Lock()
+        # Backups are made one by one even if one takes longer than window.
+        self.backup_lock = threading.Lock()
+        self.timer = None
+        self.requests = 0
+        self.backups = 0
+        self.failed_backups = 0
+
+    def request(self):
+        with self.lock:
+            self.requests += 1
+            if self.timer is not None:
+                return
+            self.timer = threading.Timer(self.window, self.run)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def run(self):
+        """Make backup. Failed backup is logged (and counted) so it doesn't
+        stop the timer thread or exit of process."""
+        with self.lock:
+            self.timer = None
+        with self.backup_lock:
+            try:
+                self.make_backup()
+            except Exception:
+                logger.exception("Backup of database failed.")
+                with self.lock:
+                    self.failed_backups += 1
+            else:
+                with self.lock:
+                    self.backups += 1
+
+    def flush(self):
+        """Make requested backup now (e.g. when process exits)."""
+        with self.lock:
+            timer, self.timer = self.timer, None
+        if timer is not None:
+            timer.cancel()
+            self.run()
+
+
+backup_service = BackupService(settings.BACKUP_WINDOW)
+atexit.register(backup_service.flush)
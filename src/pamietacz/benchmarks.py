@@ -0,0 +1,263 @@
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import connection
+from django.test.client import Client, encode_multipart, BOUNDARY
+import cookielib
+import math
+import random
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+
+# Views in order in which every worker requests them in one iteration.
+VIEWS = ["user_shelves",
+         "user_show_shelf",
+         "show_deck",
+         "user_train_deck",
+         "user_train_session",
+         "dump_data",
+         "load_data"]
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of values."""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(int(math.ceil(percent / 100.0 * len(values))) - 1, 0)]
+
+
+class ClientSession(object):
+    """Requests sent through test client of Django in the same process so
+    the number of queries of every request is known."""
+    def __init__(self):
+        self.client = Client()
+
+    def login(self, username, password):
+        return self.client.login(username=username, password=password)
+
+    def request(self, method, path, data=None):
+        """Return status, location of redirect and number of queries."""
+        connection.use_debug_cursor = True
+        queries = len(connection.queries)
+        if method == "GET":
+            response = self.client.get(path)
+        else:
+            response = self.client.post(path, data)
+        if response.streaming:
+            for _ in response.streaming_content:
+                pass
+        else:
+            response.content
+        queries = len(connection.queries) - queries
+        # Queries aren't kept forever.
+        del connection.queries[:]
+        return response.status_code, response.get("Location"), queries
+
+    def close(self):
+        self.client.logout()
+
+
+class NoRedirectHandler(urllib2.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HTTPSession(object):
+    """Requests sent over HTTP to running server (e.g. runserver). The
+    number of queries isn't known."""
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+        self.cookies = cookielib.CookieJar()
+        self.opener = urllib2.build_opener(
+            urllib2.HTTPCookieProcessor(self.cookies), NoRedirectHandler)
+
+    def csrf_token(self):
+        for cookie in self.cookies:
+            if cookie.name == settings.CSRF_COOKIE_NAME:
+                return cookie.value
+        return ""
+
+    def login(self, username, password):
+        # Login page sets CSRF cookie.
+        self.request("GET", settings.LOGIN_URL)
+        status, location, _ = self.request(
+            "POST", settings.LOGIN_URL,
+            {"username": username, "password": password})
+        return status == 302
+
+    def request(self, method, path, data=None):
+        """Return status, location of redirect and None as the number of
+        queries."""
+        headers = {}
+        body = None
+        if method == "POST":
+            data = dict(data, csrfmiddlewaretoken=self.csrf_token())
+            if any(hasattr(value, "read") for value in data.itervalues()):
+                body = encode_multipart(BOUNDARY, data)
+                headers["Content-Type"] = ("multipart/form-data; boundary=%s"
+                                           % BOUNDARY)
+            else:
+                body = urllib.urlencode(data)
+        request = urllib2.Request(self.url + path, body, headers)
+        try:
+            response = self.opener.open(request)
+        except urllib2.HTTPError as e:
+            # Redirects and errors are returned as HTTPError.
+            response = e
+        try:
+            while response.read(64 * 1024):
+                pass
+        finally:
+            response.close()
+        return response.code, response.info().get("Location"), None
+
+    def close(self):
+        self.request("GET", "/logout/")
+
+
+class Results(object):
+    """Latencies and numbers of queries of requests of every view."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = dict((view, []) for view in VIEWS)
+        self.queries = dict((view, []) for view in VIEWS)
+        self.errors = dict((view, 0) for view in VIEWS)
+
+    def add(self, view, latency, queries, error):
+        with self.lock:
+            self.latencies[view].append(latency)
+            if queries is not None:
+                self.queries[view].append(queries)
+            self.errors[view] += error
+
+    def report(self, views, elapsed):
+        report = {}
+        for view in views:
+            latencies = self.latencies[view]
+            queries = self.queries[view]
+            report[view] = {
+                "requests": len(latencies),
+                "errors": self.errors[view],
+                "p50_ms": self._ms(percentile(latencies, 50)),
+                "p95_ms": self._ms(percentile(latencies, 95)),
+                "queries_per_request": (float(sum(queries)) / len(queries)
+                                        if queries else None),
+                "throughput": round(len(latencies) / elapsed, 3),
+            }
+        return report
+
+    def _ms(self, seconds):
+        return None if seconds is None else round(seconds * 1000, 3)
+
+
+class Worker(threading.Thread):
+    """User who requests views in given order in every iteration. Decks
+    are chosen randomly from decks of shelves started by user. Answers
+    are sent to train session created by user_train_deck."""
+    def __init__(self, session, username, password, decks, views,
+                 iterations, data_dump, results, seed):
+        super(Worker, self).__init__()
+        self.session = session
+        self.username = username
+        self.password = password
+        self.decks = decks
+        self.views = views
+        self.iterations = iterations
+        self.data_dump = data_dump
+        self.results = results
+        self.rnd = random.Random(seed)
+        self.train_session_url = None
+        self.error = None
+
+    def run(self):
+        try:
+            if not self.session.login(self.username, self.password):
+                raise ValueError("Cannot login as %s." % self.username)
+            try:
+                for _ in range(self.iterations):
+                    shelf_id, deck_id = self.rnd.choice(self.decks)
+                    for view in self.views:
+                        self.call(view, shelf_id, deck_id)
+            finally:
+                self.session.close()
+        except Exception as e:
+            self.error = e
+
+    def call(self, view, shelf_id, deck_id):
+        method, path, data = self.get_request(view, shelf_id, deck_id)
+        if path is None:
+            return
+        start = time.time()
+        try:
+            status, location, queries = self.session.request(method, path,
+                                                             data)
+        except Exception:
+            status, location, queries = None, None, None
+        latency = time.time() - start
+        self.results.add(view, latency, queries,
+                         status not in (200, 302))
+        if view == "user_train_deck" and status == 302:
+            # Deck without cards to repeat redirects to shelf.
+            path = urlparse.urlparse(location).path
+            if path.startswith("/user/train/session/"):
+                self.train_session_url = path
+        elif view == "user_train_session" and status == 302:
+            # All cards of session were answered.
+            self.train_session_url = None
+
+    def get_request(self, view, shelf_id, deck_id):
+        """Return method, path and data of request of view."""
+        if view == "user_shelves":
+            return "GET", "/", None
+        if view == "user_show_shelf":
+            return "GET", "/user/shelf/%d/show/" % shelf_id, None
+        if view == "show_deck":
+            return "GET", "/deck/%d/show/" % deck_id, None
+        if view == "user_train_deck":
+            return "GET", "/user/deck/%d/train/" % deck_id, None
+        if view == "user_train_session":
+            if self.train_session_url is None:
+                return None, None, None
+            return "POST", self.train_session_url, {"Answer": "Good"}
+        if view == "dump_data":
+            return "GET", "/data/dump/", None
+        if view == "load_data":
+            # Merged dump of the same data doesn't change it.
+            return "POST", "/data/load/", {
+                "data_dump_file": ContentFile(self.data_dump,
+                                              name="dump_data.xml"),
+                "merge": "on"}
+        raise ValueError("Unknown view: %s" % view)
+
+
+def run_benchmark(create_session, users, password, views, iterations,
+                  data_dump, seed=0):
+    """Run worker for every user at once. Users are list of tuples
+    (username, list of (shelf id, deck id) of started shelves). Return
+    report with latencies, queries per request and throughput of views."""
+    results = Results()
+    workers = [Worker(create_session(), username, password, decks, views,
+                      iterations, data_dump, results, seed + number)
+               for number, (username, decks) in enumerate(users)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - start
+    errors = [worker.error for worker in workers if worker.error]
+    if errors:
+        raise errors[0]
+    view_reports = results.report(views, elapsed)
+    requests = sum(report["requests"] for report in view_reports.values())
+    return {"workers": len(workers),
+            "iterations": iterations,
+            "elapsed_s": round(elapsed, 3),
+            "requests": requests,
+            "errors": sum(report["errors"]
+                          for report in view_reports.values()),
+            "throughput": round(requests / elapsed, 3),
+            "views": view_reports}
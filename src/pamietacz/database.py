@@ -0,0 +1,57 @@
+from backups import can_snapshot_wal, VACUUM_INTO_VERSION
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DatabaseError, transaction
+import functools
+import sqlite3
+import time
+
+
+def configure_sqlite(sender, connection, **kwargs):
+    """Set pragmas of SQLITE_PRAGMAS setting when connection to SQLite
+    database is created. Journal mode is set first because other pragmas
+    (e.g. wal_autocheckpoint) depend on it. When WAL is archived it's
+    checkpointed only by archive_wal command so no frames are missed.
+    WAL mode isn't used by SQLite which can't snapshot it for backups."""
+    if connection.vendor != "sqlite":
+        return
+    pragmas = dict(settings.SQLITE_PRAGMAS)
+    if (str(pragmas.get("journal_mode", "")).lower() == "wal" and
+            not can_snapshot_wal()):
+        raise ImproperlyConfigured(
+            "Backups of database in WAL mode need SQLite %s or newer, set "
+            "other journal_mode in SQLITE_PRAGMAS." %
+            ".".join(map(str, VACUUM_INTO_VERSION)))
+    if settings.WAL_ARCHIVE_DIRECTORY:
+        pragmas["wal_autocheckpoint"] = 0
+    pragmas = sorted(pragmas.iteritems(),
+                     key=lambda (name, value): name != "journal_mode")
+    for name, value in pragmas:
+        # Cursor of Django isn't used so the queries aren't logged.
+        connection.connection.execute("PRAGMA %s = %s" % (name, value))
+
+
+def is_locked(error):
+    return "locked" in str(error)
+
+
+def retry_write(function):
+    """Run function in transaction and run it again if database was locked
+    (at most SQLITE_WRITE_RETRIES times, waiting longer every time).
+    SQLite returns this error without waiting for busy timeout when other
+    connection wrote to database after transaction read from it, then the
+    whole transaction has to be repeated. Function has to give the same
+    result when it's run again after it was partly committed."""
+    @functools.wraps(function)
+    def wrap(*args, **kwargs):
+        for attempt in range(settings.SQLITE_WRITE_RETRIES + 1):
+            try:
+                with transaction.commit_on_success():
+                    return function(*args, **kwargs)
+            # Error of commit isn't converted to error of Django.
+            except (DatabaseError, sqlite3.OperationalError) as e:
+                if (not is_locked(e) or
+                        attempt == settings.SQLITE_WRITE_RETRIES):
+                    raise
+            time.sleep(settings.SQLITE_WRITE_RETRY_DELAY * 2 ** attempt)
+    return wrap
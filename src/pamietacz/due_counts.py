@@ -0,0 +1,27 @@
+from models import DueCounter
+
+
+def count_cards_to_repeat_now(userprofile, shelves):
+    """Count cards which user can repeat now.
+
+    Returns tuple of two dicts: number of cards to repeat per shelf id
+    and number of cards to repeat per deck id. Every given shelf is present
+    in the first dict. Only decks for which user has a train pool are
+    present in the second dict.
+
+    Numbers are read from due counters of decks with one query so that
+    the number of queries does not depend on the number of shelves, decks
+    or cards."""
+    shelves_ids = [shelf.id for shelf in shelves]
+    per_shelf = dict((shelf_id, 0) for shelf_id in shelves_ids)
+    per_deck = {}
+    if not shelves_ids:
+        return per_shelf, per_deck
+
+    due_counters = DueCounter.objects.filter(
+        userprofile=userprofile, deck__shelf__in=shelves_ids).values_list(
+        "deck__shelf_id", "deck_id", "due_cards")
+    for shelf_id, deck_id, number_of_cards in due_counters:
+        per_shelf[shelf_id] += number_of_cards
+        per_deck[deck_id] = number_of_cards
+    return per_shelf, per_deck
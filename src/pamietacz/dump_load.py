@@ -1,86 +1,358 @@
-from django.db import IntegrityError, transaction
-from models import Shelf, Deck, Card
+from collections import Counter
+from django.db import IntegrityError, connection, transaction
+from itertools import chain, groupby
+from models import Shelf, Deck, Card, DueCounter
 from lxml import etree
+from operator import itemgetter
+from rendering import render_markdown_many, RENDER_VERSION
+import hashlib
+
+# Number of rows fetched from database at once while data is dumped.
+DUMP_ROWS_IN_CHUNK = 1000
+# Number of cards rendered and inserted at once while data is loaded.
+CARDS_IN_BATCH = 1000
+# Maximum number of decks which card counts are updated by one query
+# (SQLite limits the number of query parameters).
+DECKS_IN_QUERY = 500
+
+
+class ChunksWriter(object):
+    """File-like object which keeps written chunks until they are taken."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def take(self):
+        chunks, self.chunks = self.chunks, []
+        return "".join(chunks)
+
+
+def read_dump_rows():
+    """Read all shelves, decks and cards in one query ordered like in dump.
+    Rows are (shelf id, shelf name, deck id, deck name, card id, question,
+    answer), deck and card columns are NULL for empty shelves and decks."""
+    cursor = connection.cursor()
+    cursor.execute(
+        "SELECT s.id, s.name, d.id, d.name, c.id, c.question, c.answer "
+        "FROM %(shelf)s s "
+        "LEFT OUTER JOIN %(deck)s d ON d.shelf_id = s.id "
+        "LEFT OUTER JOIN %(card)s c ON c.deck_id = d.id "
+        "ORDER BY s.id, d.%(order)s, d.id, c.id" %
+        {"shelf": Shelf._meta.db_table,
+         "deck": Deck._meta.db_table,
+         "card": Card._meta.db_table,
+         "order": connection.ops.quote_name("order")})
+    while True:
+        rows = cursor.fetchmany(DUMP_ROWS_IN_CHUNK)
+        if not rows:
+            break
+        for row in rows:
+            yield row
+
+
+def without_nulls(rows, column):
+    """Return rows or None if there are no rows or only one row with NULL
+    in given column (it's an outer join of shelf or deck which is
+    empty)."""
+    first = next(rows, None)
+    if first is None or first[column] is None:
+        return None
+    return chain([first], rows)
+
+
+def dump_data_as_xml_chunks():
+    """Generate XML with all shelves, decks and cards in chunks. Data is
+    read from database by one query and only the chunk which is written is
+    kept in memory."""
+    output = ChunksWriter()
+    with etree.xmlfile(output, encoding="UTF-8") as xml_file:
+        xml_file.write_declaration()
+        rows = without_nulls(read_dump_rows(), 0)
+        if rows is None:
+            xml_file.write(etree.Element("data"))
+        else:
+            with xml_file.element("data"):
+                for (_, shelf_name), shelf_rows in groupby(rows,
+                                                           itemgetter(0, 1)):
+                    xml_file.write("\n  ")
+                    shelf_rows = without_nulls(shelf_rows, 2)
+                    if shelf_rows is None:
+                        xml_file.write(etree.Element("shelf",
+                                                     name=shelf_name))
+                        continue
+                    with xml_file.element("shelf", name=shelf_name):
+                        for (_, deck_name), deck_rows in groupby(
+                                shelf_rows, itemgetter(2, 3)):
+                            xml_file.write("\n    ")
+                            deck_rows = without_nulls(deck_rows, 4)
+                            if deck_rows is None:
+                                xml_file.write(etree.Element(
+                                    "deck", name=deck_name))
+                                continue
+                            with xml_file.element("deck", name=deck_name):
+                                for row in deck_rows:
+                                    write_card(xml_file, row)
+                                    if output.chunks:
+                                        yield output.take()
+                                xml_file.write("\n    ")
+                        xml_file.write("\n  ")
+                xml_file.write("\n")
+    yield output.take() + "\n"
+
+
+def write_card(xml_file, row):
+    xml_file.write("\n      ")
+    with xml_file.element("card"):
+        question = etree.Element("question")
+        question.text = row[5]
+        answer = etree.Element("answer")
+        answer.text = row[6]
+        xml_file.write("\n        ", question, "\n        ", answer,
+                       "\n      ")
 
 
 def dump_data_as_xml():
-    root = etree.Element("data")
-    all_shelves = Shelf.objects.all()
-    for shelf in all_shelves:
-        shelf_xml = etree.Element("shelf")
-        shelf_xml.attrib["name"] = shelf.name
-        root.append(shelf_xml)
-        decks = Deck.objects.filter(shelf=shelf).order_by("order")
-        for deck in decks:
-            deck_xml = etree.Element("deck")
-            deck_xml.attrib["name"] = deck.name
-            shelf_xml.append(deck_xml)
-            cards = Card.objects.filter(deck=deck).order_by("id")
-            for card in cards:
-                card_xml = etree.Element("card")
-                card_question_xml = etree.Element("question")
-                card_question_xml.text = card.question
-                card_xml.append(card_question_xml)
-                card_answer_xml = etree.Element("answer")
-                card_answer_xml.text = card.answer
-                card_xml.append(card_answer_xml)
-                deck_xml.append(card_xml)
-    return etree.tostring(root,
-                          xml_declaration=True,
-                          encoding="UTF-8",
-                          pretty_print=True)
+    return "".join(dump_data_as_xml_chunks())
 
 
 class XMLDataDumpException(Exception):
     pass
 
 
-@transaction.commit_on_success
-def load_data_as_xml(data_dump_as_xml):
-    tree = etree.parse(data_dump_as_xml)
-    docinfo = tree.docinfo
-    if docinfo.encoding != "UTF-8":
-        raise XMLDataDumpException("Not supported encoding: %s" %
-                                   docinfo.encoding)
-    root = tree.getroot()
-    if root.tag != "data":
-        raise XMLDataDumpException("%s: %s != 'data'" %
-                                   (root.sourceline, root.tag))
-    for shelf_xml in root:
-        if shelf_xml.tag != "shelf":
-            raise XMLDataDumpException("%s: %s != 'shelf'" %
-                                       (shelf_xml.sourceline, shelf_xml.tag))
+def remove_parsed(element):
+    """Remove element and its previous siblings which were already
+    loaded so that parsed tree doesn't grow."""
+    element.clear()
+    while element.getprevious() is not None:
+        del element.getparent()[0]
+
+
+class XMLDataLoader(object):
+    """Shelves, decks and cards loaded while XML is parsed. Elements are
+    checked when they start (at depth 1 for data, 2 for shelf, 3 for deck
+    and 4 for card) and cards are read when they end."""
+
+    def __init__(self):
+        self.shelf = None
+        self.deck = None
+        # Order of next deck of shelf by shelf id.
+        self.decks_orders = {}
+        self.cards = []
+        # Number of inserted cards by deck id.
+        self.added_cards = Counter()
+
+    def load(self, data_dump_as_xml):
+        start = {1: self.start_data, 2: self.start_shelf,
+                 3: self.start_deck, 4: self.start_card}
+        depth = 0
+        for event, element in etree.iterparse(data_dump_as_xml,
+                                              events=("start", "end")):
+            if event == "start":
+                depth += 1
+                if depth in start:
+                    start[depth](element)
+            else:
+                depth -= 1
+                if depth == 3:
+                    self.end_card(element)
+                if 0 < depth <= 3:
+                    remove_parsed(element)
+        self.finish()
+
+    def finish(self):
+        self.save_cards()
+        # Cards were inserted in bulk so decks don't know their number.
+        decks_ids = list(self.added_cards)
+        for first in range(0, len(decks_ids), DECKS_IN_QUERY):
+            Deck.update_card_counts(decks_ids[first:first + DECKS_IN_QUERY])
+
+    def start_data(self, element):
+        # Encoding isn't given in documents without XML declaration, they
+        # are encoded in UTF-8.
+        encoding = element.getroottree().docinfo.encoding or "UTF-8"
+        if encoding != "UTF-8":
+            raise XMLDataDumpException("Not supported encoding: %s" %
+                                       encoding)
+        check_tag(element, "data")
+
+    def start_shelf(self, element):
+        check_tag(element, "shelf")
+        self.shelf = self.add_shelf(element)
+
+    def add_shelf(self, element):
         shelf = Shelf()
-        shelf.name = shelf_xml.get("name")
+        shelf.name = element.get("name")
         try:
             shelf.save()
         except IntegrityError as e:
             raise XMLDataDumpException("%s: cannot add shelf: %s" %
-                                       (shelf_xml.sourceline, str(e)))
-        for deck_data in shelf_xml:
-            if deck_data.tag != "deck":
-                raise XMLDataDumpException("%s: %s != 'deck'" %
-                                           (deck_data.sourceline,
-                                            deck_data.tag))
-            deck = Deck()
-            deck.shelf = shelf
-            deck.name = deck_data.get("name")
-            deck.save()
-            for card_data in deck_data:
-                if card_data.tag != "card":
-                    raise XMLDataDumpException("%s: %s != 'card'" %
-                                               (card_data.sourceline,
-                                                card_data.tag))
-                if card_data[0].tag != "question":
-                    raise XMLDataDumpException("%s: %s != 'question'" %
-                                               (card_data[0].sourceline,
-                                                card_data[0].tag))
-                if card_data[1].tag != "answer":
-                    raise XMLDataDumpException("%s: s%s != 'answer'" %
-                                               (card_data[1].sourceline,
-                                                card_data[1].tag))
-                card = Card()
-                card.deck = deck
-                card.question = card_data[0].text
-                card.answer = card_data[1].text
-                card.save()
+                                       (element.sourceline, str(e)))
+        return shelf
+
+    def start_deck(self, element):
+        check_tag(element, "deck")
+        self.deck = self.add_deck(element)
+
+    def add_deck(self, element):
+        # Order of deck is known without queries.
+        order = self.decks_orders.get(self.shelf.id, 0)
+        deck = Deck(shelf=self.shelf, name=element.get("name"), order=order)
+        deck.save()
+        self.decks_orders[self.shelf.id] = order + 1
+        return deck
+
+    def start_card(self, element):
+        check_tag(element, "card")
+
+    def end_card(self, element):
+        self.add_card(read_card(element, self.deck))
+
+    def add_card(self, card):
+        self.cards.append(card)
+        if len(self.cards) >= CARDS_IN_BATCH:
+            self.save_cards()
+
+    def save_cards(self):
+        """Render cards in one batch and insert them by one query."""
+        if not self.cards:
+            return
+        render_cards(self.cards)
+        try:
+            Card.objects.bulk_create(self.cards)
+        except IntegrityError as e:
+            raise XMLDataDumpException("cannot add cards: %s" % str(e))
+        self.added_cards.update(card.deck_id for card in self.cards)
+        self.cards = []
+
+
+class XMLDataMerger(XMLDataLoader):
+    """Shelves, decks and cards loaded from XML merged with those which
+    are in database. Shelves are matched by name, decks by shelf and name
+    and cards by deck and question. Only new cards are inserted and cards
+    which answers changed are updated so train cards of users are kept."""
+
+    def __init__(self):
+        super(XMLDataMerger, self).__init__()
+        self.shelves = dict(Shelf.objects.values_list("name", "id"))
+        # The first deck is taken if many decks have the same name.
+        self.decks = {}
+        for deck_id, shelf_id, name, order in Deck.objects.order_by(
+                "-order").values_list("id", "shelf_id", "name", "order"):
+            self.decks[(shelf_id, name)] = deck_id
+            self.decks_orders.setdefault(shelf_id, order + 1)
+        # Deck id -> (question -> hash of answer) of cards which were in
+        # database or were loaded, so cards of deck which is repeated in
+        # XML or card which is repeated in deck aren't inserted twice.
+        self.decks_cards = {}
+        # Cards of current deck.
+        self.deck_cards = {}
+        self.changed_cards = []
+
+    def finish(self):
+        super(XMLDataMerger, self).finish()
+        self.save_changed_cards()
+        # New cards can be repeated now by all users who train decks.
+        for deck_id, number_of_cards in self.added_cards.iteritems():
+            DueCounter.cards_added(deck_id, number_of_cards)
+
+    def add_shelf(self, element):
+        name = element.get("name")
+        if name in self.shelves:
+            return Shelf(id=self.shelves[name], name=name)
+        shelf = super(XMLDataMerger, self).add_shelf(element)
+        self.shelves[name] = shelf.id
+        return shelf
+
+    def add_deck(self, element):
+        name = element.get("name")
+        key = (self.shelf.id, name)
+        if key not in self.decks:
+            deck = super(XMLDataMerger, self).add_deck(element)
+            self.decks[key] = deck.id
+            self.deck_cards = self.decks_cards[deck.id] = {}
+            return deck
+        deck = Deck(id=self.decks[key], shelf=self.shelf, name=name)
+        if deck.id not in self.decks_cards:
+            self.decks_cards[deck.id] = dict(
+                (question, text_hash(answer))
+                for question, answer in Card.objects.filter(
+                    deck=deck).values_list("question", "answer"))
+        self.deck_cards = self.decks_cards[deck.id]
+        return deck
+
+    def end_card(self, element):
+        card = read_card(element, self.deck)
+        answer_hash = text_hash(card.answer)
+        old_answer_hash = self.deck_cards.get(card.question)
+        self.deck_cards[card.question] = answer_hash
+        if old_answer_hash is None:
+            self.add_card(card)
+        elif old_answer_hash != answer_hash:
+            self.changed_cards.append(card)
+            if len(self.changed_cards) >= CARDS_IN_BATCH:
+                self.save_changed_cards()
+
+    def save_changed_cards(self):
+        """Render cards in one batch and update their answers. Cards are
+        found by deck and question because changed card could be loaded
+        before and its id isn't known."""
+        if not self.changed_cards:
+            return
+        # Changed card can still wait to be inserted.
+        self.save_cards()
+        render_cards(self.changed_cards)
+        connection.cursor().executemany(
+            "UPDATE %s SET answer = %%s, question_after_markdown = %%s, "
+            "answer_after_markdown = %%s, render_version = %%s "
+            "WHERE deck_id = %%s AND question = %%s" % Card._meta.db_table,
+            [(card.answer, card.question_after_markdown,
+              card.answer_after_markdown, card.render_version,
+              card.deck_id, card.question)
+             for card in self.changed_cards])
+        self.changed_cards = []
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).digest()
+
+
+def render_cards(cards):
+    htmls = render_markdown_many(sum([[card.question, card.answer]
+                                      for card in cards], []))
+    for number, card in enumerate(cards):
+        card.question_after_markdown = htmls[2 * number]
+        card.answer_after_markdown = htmls[2 * number + 1]
+        card.render_version = RENDER_VERSION
+
+
+def check_tag(element, tag):
+    if element.tag != tag:
+        raise XMLDataDumpException("%s: %s != '%s'" %
+                                   (element.sourceline, element.tag, tag))
+
+
+@transaction.commit_on_success
+def load_data_as_xml(data_dump_as_xml, merge=False):
+    """Load shelves, decks and cards from XML while it's parsed. Cards are
+    saved in batches, elements which were loaded are removed so only one
+    batch of cards is kept in memory. With merge, data is merged with
+    shelves, decks and cards which are already in database."""
+    loader = XMLDataMerger() if merge else XMLDataLoader()
+    loader.load(data_dump_as_xml)
+
+
+def read_card(card_data, deck):
+    if len(card_data) < 2:
+        raise XMLDataDumpException("%s: card without question and answer" %
+                                   card_data.sourceline)
+    check_tag(card_data[0], "question")
+    check_tag(card_data[1], "answer")
+    if card_data[0].text is None or card_data[1].text is None:
+        raise XMLDataDumpException("%s: empty question or answer" %
+                                   card_data.sourceline)
+    return Card(deck=deck,
+                question=card_data[0].text,
+                answer=card_data[1].text)
@@ -1,6 +1,7 @@
 from django.contrib.auth.forms import UserCreationForm
 from django.core.exceptions import ValidationError
-from django.forms import ModelForm, Form, FileField, ImageField
+from django.forms import (ModelForm, Form, FileField, ImageField,
+                          BooleanField)
 from models import Shelf, Deck, Card, UserProfile
 
 
@@ -59,6 +60,9 @@ class CardForm(ModelForm):
 
 class DataDumpUploadFileForm(Form):
     data_dump_file = FileField()
+    merge = BooleanField(required=False,
+                         help_text=("Merge with shelves, decks and cards "
+                                    "which already exist."))
 
 
 class UserProfileCreationForm(UserCreationForm):
@@ -0,0 +1,111 @@
+from django.db import transaction
+from django.db.models import Q
+from models import Job, TrainPool
+import datetime
+import traceback
+
+# How many times job is started before it's marked as failed.
+MAX_ATTEMPTS = 5
+
+# How long to wait before failed job is started again (multiplied by
+# the number of attempts).
+RETRY_DELAY = datetime.timedelta(minutes=1)
+
+# Running job which wasn't claimed or didn't finish its batch for this
+# time is claimed again because its worker was probably killed.
+CLAIM_TIMEOUT = datetime.timedelta(minutes=10)
+
+# How many train pools are updated in one transaction.
+TRAIN_POOLS_BATCH_SIZE = 1000
+
+job_handlers = {}
+
+
+def job_handler(kind):
+    def register(function):
+        job_handlers[kind] = function
+        return function
+    return register
+
+
+@job_handler(Job.ADD_CARD_TO_TRAIN_POOLS)
+def add_card_to_train_pools(job):
+    """Add new card to all train pools of deck, batch by batch. The last
+    finished train pool is saved in payload so when job is repeated then
+    it starts from the batch which failed."""
+    payload = job.get_payload()
+    train_pools = TrainPool.objects.filter(deck=job.deck)
+    if not job.total:
+        job.total = train_pools.count()
+        job.save()
+    while True:
+        train_pools_ids = list(train_pools.filter(
+            id__gt=payload.get("last_train_pool_id", 0)).order_by(
+            "id").values_list("id", flat=True)[:TRAIN_POOLS_BATCH_SIZE])
+        if not train_pools_ids:
+            break
+        with transaction.commit_on_success():
+            TrainPool.add_card_to_train_pools_batch(payload["card_id"],
+                                                    job.deck_id,
+                                                    train_pools_ids[0],
+                                                    train_pools_ids[-1])
+            payload["last_train_pool_id"] = train_pools_ids[-1]
+            job.set_payload(payload)
+            job.progress += len(train_pools_ids)
+            job.claimed_at = datetime.datetime.now()
+            job.save()
+
+
+def claim_jobs(limit):
+    """Get pending jobs and running jobs which were claimed too long ago
+    and mark them as running. Job which was claimed by other worker in
+    the meantime is skipped. Running job which used all its attempts is
+    marked as failed."""
+    now = datetime.datetime.now()
+    jobs = Job.objects.filter(
+        Q(status=Job.PENDING, run_after__lte=now) |
+        Q(status=Job.RUNNING, claimed_at__lt=now - CLAIM_TIMEOUT)).order_by(
+        "id")[:limit]
+    claimed = []
+    for job in jobs:
+        unchanged = Job.objects.filter(id=job.id, status=job.status,
+                                       claimed_at=job.claimed_at)
+        if job.status == Job.RUNNING and job.attempts >= MAX_ATTEMPTS:
+            unchanged.update(status=Job.FAILED,
+                             error="Job wasn't finished by its worker.")
+            transaction.commit_unless_managed()
+            continue
+        updated = unchanged.update(status=Job.RUNNING,
+                                   attempts=job.attempts + 1,
+                                   claimed_at=now)
+        transaction.commit_unless_managed()
+        if updated:
+            job.status = Job.RUNNING
+            job.attempts += 1
+            job.claimed_at = now
+            claimed.append(job)
+    return claimed
+
+
+def run_job(job):
+    try:
+        job_handlers[job.kind](job)
+    except Exception:
+        transaction.rollback_unless_managed()
+        job.error = traceback.format_exc()
+        if job.attempts < MAX_ATTEMPTS:
+            job.status = Job.PENDING
+            job.run_after = (datetime.datetime.now() +
+                             RETRY_DELAY * job.attempts)
+        else:
+            job.status = Job.FAILED
+    else:
+        job.status = Job.DONE
+        job.error = ""
+    job.save()
+    return job
+
+
+def run_pending_jobs(limit):
+    """Run at most limit pending jobs. Return finished jobs."""
+    return [run_job(job) for job in claim_jobs(limit)]
@@ -0,0 +1,56 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+from pamietacz.backups import WALArchive, WAL_CHECKPOINT_SIZE
+import datetime
+import time
+
+
+class Command(BaseCommand):
+    help = ("Archive WAL of database continuously to WAL_ARCHIVE_DIRECTORY "
+            "so database can be restored to any time by restore_to_time "
+            "command. Application doesn't checkpoint WAL when "
+            "WAL_ARCHIVE_DIRECTORY is set, WAL is checkpointed by this "
+            "command.")
+    option_list = BaseCommand.option_list + (
+        make_option("--sleep",
+                    type="float",
+                    default=10,
+                    help="Seconds between archiving (default: 10)."),
+        make_option("--checkpoint-size",
+                    type="int",
+                    dest="checkpoint_size",
+                    default=WAL_CHECKPOINT_SIZE,
+                    help=("WAL is checkpointed when it's bigger than this "
+                          "number of bytes (default: %d)." %
+                          WAL_CHECKPOINT_SIZE)),
+        make_option("--keep-days",
+                    type="int",
+                    dest="keep_days",
+                    default=7,
+                    help=("Number of days to which database can be "
+                          "restored (default: 7).")),
+        make_option("--once",
+                    action="store_true",
+                    default=False,
+                    help="Archive WAL once and exit."))
+
+    def handle(self, *args, **options):
+        if not settings.WAL_ARCHIVE_DIRECTORY:
+            raise CommandError("WAL_ARCHIVE_DIRECTORY isn't set.")
+        archive = WALArchive(settings.WAL_ARCHIVE_DIRECTORY,
+                             settings.DATABASES["default"]["NAME"])
+        try:
+            while True:
+                archived = archive.archive(
+                    checkpoint_size=options["checkpoint_size"])
+                if archived:
+                    self.stdout.write("Archived %d bytes of WAL." % archived)
+                archive.remove_old(datetime.datetime.now() -
+                                   datetime.timedelta(
+                                       days=options["keep_days"]))
+                if options["once"]:
+                    break
+                time.sleep(options["sleep"])
+        finally:
+            archive.close()
@@ -0,0 +1,176 @@
+from django.core.management.base import BaseCommand
+from django.core.urlresolvers import resolve, reverse
+from django.db import connection
+from django.test.client import Client
+from django.test.utils import override_settings
+from optparse import make_option
+from pamietacz.database import is_locked
+from pamietacz.models import (Shelf,
+                              Deck,
+                              Card,
+                              TrainCard,
+                              TrainPool,
+                              TrainSession,
+                              Review,
+                              DueCounter,
+                              UserProfile)
+from pamietacz.views import user_train_session
+import datetime
+import threading
+import time
+import urlparse
+
+
+# Default settings of SQLite and no retries of write transactions.
+DEFAULT_PROFILE = {"SQLITE_PRAGMAS": {"journal_mode": "delete",
+                                      "synchronous": "full",
+                                      "cache_size": -2000,
+                                      "mmap_size": 0,
+                                      "temp_store": "default"},
+                   "SQLITE_WRITE_RETRIES": 0}
+
+PASSWORD = "benchmark"
+
+
+class AnsweringUser(threading.Thread):
+    """User which trains deck (all its cards) and answers cards one by
+    one until given number of answers is sent. When all cards of deck are
+    answered and no session can be started, train cards of user are made
+    due again (counted as retrainings) and the deck is trained again."""
+    def __init__(self, username, deck, number_of_answers):
+        super(AnsweringUser, self).__init__()
+        self.username = username
+        self.deck = deck
+        self.number_of_answers = number_of_answers
+        self.answers = 0
+        self.retrainings = 0
+        self.locked_errors = 0
+        self.other_errors = 0
+
+    def run(self):
+        client = Client()
+        train_url = reverse("pamietacz.views.user_train_deck",
+                            kwargs={"deck_id": self.deck.id,
+                                    "all_cards": True})
+        logged_in = False
+        session_url = None
+        try:
+            while self.answers < self.number_of_answers:
+                try:
+                    if not logged_in:
+                        logged_in = client.login(username=self.username,
+                                                 password=PASSWORD)
+                        continue
+                    if session_url is None:
+                        session_url = self.start_session(client, train_url)
+                        continue
+                    response = client.post(session_url, {"Answer": "Good"})
+                except Exception as e:
+                    if is_locked(e):
+                        self.locked_errors += 1
+                        continue
+                    self.other_errors += 1
+                    break
+                if response.status_code not in (200, 302):
+                    self.other_errors += 1
+                    break
+                self.answers += 1
+                # Session is finished when there are no cards left.
+                if response.status_code == 302:
+                    session_url = None
+        finally:
+            client.logout()
+            connection.close()
+
+    def start_session(self, client, train_url):
+        """Return URL of started session or None if there are no cards
+        to repeat (then the cards are made due again)."""
+        response = client.get(train_url)
+        if response.status_code != 302:
+            raise ValueError("Session not started: %d" %
+                             response.status_code)
+        path = urlparse.urlparse(response["Location"]).path
+        if resolve(path).func != user_train_session:
+            TrainCard.objects.filter(
+                userprofile__username=self.username,
+                deck=self.deck).update(time_to_show=datetime.datetime.now())
+            self.retrainings += 1
+            return None
+        return path
+
+
+class Command(BaseCommand):
+    help = ("Compare throughput of answers sent at once by many users to "
+            "the database with default settings of SQLite and with "
+            "settings of SQLITE_PRAGMAS and retries of write transactions. "
+            "Data created by benchmark is removed.")
+    option_list = BaseCommand.option_list + (
+        make_option("--users",
+                    type="int",
+                    default=8,
+                    help="Number of users answering at once (default: 8)."),
+        make_option("--answers",
+                    type="int",
+                    default=100,
+                    help="Number of answers of every user (default: 100)."),
+        make_option("--cards",
+                    type="int",
+                    default=100,
+                    help="Number of cards in deck (default: 100)."))
+
+    def handle(self, *args, **options):
+        usernames = ["benchmark user %d" % number
+                     for number in range(options["users"])]
+        shelf = Shelf.objects.create(name="benchmark shelf")
+        try:
+            deck = Deck(shelf=shelf, name="benchmark deck")
+            deck.save()
+            for number in range(options["cards"]):
+                Card(deck=deck,
+                     question="Question %d" % number,
+                     answer="Answer %d" % number).save()
+            for username in usernames:
+                user = UserProfile(username=username)
+                user.set_password(PASSWORD)
+                user.save()
+                user.shelves.add(shelf)
+
+            for name, profile in (("default", DEFAULT_PROFILE),
+                                  ("SQLITE_PRAGMAS", {})):
+                # Every profile starts with decks which weren't trained.
+                for model in (TrainSession, TrainCard, TrainPool, Review,
+                              DueCounter):
+                    model.objects.filter(
+                        userprofile__username__in=usernames).delete()
+                # Settings are used by connections created after this.
+                connection.close()
+                # Backups aren't requested by views without DEBUG.
+                with override_settings(DEBUG=False,
+                                       ALLOWED_HOSTS=["testserver"],
+                                       **profile):
+                    self._benchmark(name, usernames, deck, options["answers"])
+        finally:
+            UserProfile.objects.filter(username__in=usernames).delete()
+            shelf.delete()
+
+    def _benchmark(self, name, usernames, deck, number_of_answers):
+        users = [AnsweringUser(username, deck, number_of_answers)
+                 for username in usernames]
+        start = time.time()
+        for user in users:
+            user.start()
+        for user in users:
+            user.join()
+        elapsed = time.time() - start
+        answers = sum(user.answers for user in users)
+        # Every counted answer has to be saved as review.
+        reviews = Review.objects.filter(
+            userprofile__username__in=usernames).count()
+        self.stdout.write(
+            "%s: %d answers in %.3f s (%.1f answers/s), %d reviews saved, "
+            "%d retrainings, %d locked errors, %d other errors" %
+            (name, answers, elapsed, answers / elapsed, reviews,
+             sum(user.retrainings for user in users),
+             sum(user.locked_errors for user in users),
+             sum(user.other_errors for user in users)))
+        connection.close()
@@ -0,0 +1,103 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from optparse import make_option
+from pamietacz.models import (Shelf,
+                              Deck,
+                              Card,
+                              TrainCard,
+                              TrainPool,
+                              DueCounter,
+                              UserProfile)
+import time
+
+# Join table like the one which connected train pools with train cards
+# before (ManyToManyField), it's removed after benchmark.
+JOIN_TABLE = "benchmark_trainpool_train_cards"
+
+
+def create_train_pool_card_by_card(userprofile, deck):
+    """The way train pool was filled before: every train card was saved
+    and added to join table of train pool (ManyToManyField.add selected
+    existing rows and inserted new one), each in its own transaction."""
+    train_pool = TrainPool(userprofile=userprofile, deck=deck)
+    train_pool.save()
+    cursor = connection.cursor()
+    for card in Card.objects.filter(deck=deck):
+        train_card = TrainCard(card=card, userprofile=userprofile, deck=deck)
+        train_card.save()
+        cursor.execute("SELECT traincard_id FROM %s WHERE trainpool_id = %%s "
+                       "AND traincard_id IN (%%s)" % JOIN_TABLE,
+                       [train_pool.id, train_card.id])
+        cursor.fetchall()
+        cursor.execute("INSERT INTO %s (trainpool_id, traincard_id) "
+                       "VALUES (%%s, %%s)" % JOIN_TABLE,
+                       [train_pool.id, train_card.id])
+        transaction.commit_unless_managed()
+    train_pool.save()
+    return train_pool
+
+
+class Command(BaseCommand):
+    help = ("Compare time of creating train pool for big deck card by card "
+            "and with one INSERT ... SELECT statement. Both are committed "
+            "like in requests. All data created by benchmark is removed.")
+    option_list = BaseCommand.option_list + (
+        make_option("--cards",
+                    type="int",
+                    default=5000,
+                    help="Number of cards in deck (default: 5000)."),)
+
+    def handle(self, *args, **options):
+        cursor = connection.cursor()
+        cursor.execute("CREATE TABLE %s (id integer PRIMARY KEY, "
+                       "trainpool_id integer NOT NULL, "
+                       "traincard_id integer NOT NULL, "
+                       "UNIQUE (trainpool_id, traincard_id))" % JOIN_TABLE)
+        transaction.commit_unless_managed()
+        try:
+            self._benchmark(options["cards"])
+        finally:
+            self._remove_data()
+
+    def _remove_data(self):
+        transaction.rollback_unless_managed()
+        userprofiles = UserProfile.objects.filter(username="benchmark user")
+        TrainCard.objects.filter(userprofile__in=userprofiles).delete()
+        TrainPool.objects.filter(userprofile__in=userprofiles).delete()
+        DueCounter.objects.filter(userprofile__in=userprofiles).delete()
+        userprofiles.delete()
+        Card.objects.filter(deck__shelf__name="benchmark shelf").delete()
+        Shelf.objects.filter(name="benchmark shelf").delete()
+        cursor = connection.cursor()
+        cursor.execute("DROP TABLE %s" % JOIN_TABLE)
+        transaction.commit_unless_managed()
+
+    def _benchmark(self, number_of_cards):
+        userprofile = UserProfile.objects.create(username="benchmark user")
+        shelf = Shelf.objects.create(name="benchmark shelf")
+        deck = Deck(shelf=shelf, name="benchmark deck")
+        deck.save()
+        Card.objects.bulk_create([
+            Card(deck=deck,
+                 question="Question %d" % number,
+                 answer="Answer %d" % number,
+                 question_after_markdown="<p>Question %d</p>" % number,
+                 answer_after_markdown="<p>Answer %d</p>" % number)
+            for number in range(number_of_cards)])
+        Deck.update_card_counts([deck.id])
+
+        for name, create_train_pool in (
+                ("card by card", create_train_pool_card_by_card),
+                ("INSERT ... SELECT", TrainPool.create_train_pool)):
+            start = time.time()
+            create_train_pool(userprofile, deck)
+            elapsed = time.time() - start
+            created = TrainCard.objects.filter(userprofile=userprofile,
+                                               deck=deck).count()
+            self.stdout.write("%s: %d train cards in %.3f s" %
+                              (name, created, elapsed))
+            TrainCard.objects.filter(userprofile=userprofile).delete()
+            connection.cursor().execute("DELETE FROM %s" % JOIN_TABLE)
+            transaction.commit_unless_managed()
+            TrainPool.objects.filter(userprofile=userprofile).delete()
+            DueCounter.objects.filter(userprofile=userprofile).delete()
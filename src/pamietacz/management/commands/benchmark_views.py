@@ -0,0 +1,179 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+from optparse import make_option
+from pamietacz.benchmarks import (VIEWS,
+                                  ClientSession,
+                                  HTTPSession,
+                                  run_benchmark)
+from pamietacz.dump_load import dump_data_as_xml
+from pamietacz.models import Deck, UserProfile
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib2
+
+# Seconds for which started runserver is waited for.
+RUNSERVER_TIMEOUT = 30
+
+# Settings of started runserver (settings module of command and host).
+RUNSERVER_SETTINGS = """from %s import *
+
+DEBUG = False
+TEMPLATE_DEBUG = False
+DEBUG_PROPAGATE_EXCEPTIONS = False
+ALLOWED_HOSTS = [%r]
+"""
+
+
+def get_users(prefix, number):
+    """Return list of (username, list of (shelf id, deck id)) of users
+    with given prefix who started shelves with decks."""
+    users = []
+    for userprofile in UserProfile.objects.filter(
+            username__startswith=prefix).order_by("id"):
+        decks = list(Deck.objects.filter(
+            shelf__userprofile=userprofile).order_by("id").values_list(
+            "shelf_id", "id"))
+        if decks:
+            users.append((userprofile.username, decks))
+        if len(users) == number:
+            break
+    return users
+
+
+class RunServer(object):
+    """runserver started in other process on given address. It's run with
+    settings module which turns DEBUG off so the views don't request
+    backups (like the client mode does)."""
+    def __init__(self, address):
+        self.url = "http://%s" % address
+        self.settings_directory = tempfile.mkdtemp()
+        with open(os.path.join(self.settings_directory,
+                               "benchmark_settings.py"), "w") as f:
+            f.write(RUNSERVER_SETTINGS % (settings.SETTINGS_MODULE,
+                                          address.rsplit(":", 1)[0]))
+        # Log of requests isn't shown.
+        self.log = open(os.devnull, "w")
+        self.process = subprocess.Popen(
+            [sys.executable, sys.argv[0], "runserver", "--noreload",
+             address],
+            env=dict(os.environ,
+                     DJANGO_SETTINGS_MODULE="benchmark_settings",
+                     PYTHONPATH=os.pathsep.join([self.settings_directory] +
+                                                sys.path)),
+            stdout=self.log, stderr=self.log)
+        start = time.time()
+        while True:
+            try:
+                urllib2.urlopen(self.url + settings.LOGIN_URL).close()
+                return
+            except IOError:
+                if (self.process.poll() is not None or
+                        time.time() - start > RUNSERVER_TIMEOUT):
+                    self.stop()
+                    raise CommandError("Cannot start runserver on %s." %
+                                       address)
+                time.sleep(0.1)
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.terminate()
+        self.process.wait()
+        self.log.close()
+        shutil.rmtree(self.settings_directory)
+
+
+class Command(BaseCommand):
+    help = ("Benchmark views requested at once by users (e.g. created by "
+            "generate_data command) through test client of Django and "
+            "through HTTP against runserver. Report with p50/p95 latency "
+            "(milliseconds), queries per request (only test client) and "
+            "throughput (requests per second) of every view is written as "
+            "JSON.")
+    option_list = BaseCommand.option_list + (
+        make_option("--users",
+                    type="int",
+                    default=4,
+                    help="Number of users requesting at once (default: 4)."),
+        make_option("--iterations",
+                    type="int",
+                    default=10,
+                    help=("Number of times every user requests the views "
+                          "(default: 10).")),
+        make_option("--views",
+                    default=",".join(VIEWS),
+                    help="Comma separated views (default: %s)." %
+                    ",".join(VIEWS)),
+        make_option("--prefix",
+                    default="synthetic user ",
+                    help=("Prefix of usernames of users (default: "
+                          "'synthetic user ').")),
+        make_option("--password",
+                    default="synthetic",
+                    help="Password of users (default: synthetic)."),
+        make_option("--mode",
+                    choices=["client", "http", "both"],
+                    default="both",
+                    help="client, http or both (default: both)."),
+        make_option("--url",
+                    help=("URL of running server used by http mode instead "
+                          "of starting runserver.")),
+        make_option("--address",
+                    default="127.0.0.1:8123",
+                    help=("Address of runserver started by http mode "
+                          "(default: 127.0.0.1:8123).")),
+        make_option("--output",
+                    help="File of report (default: standard output)."),
+        make_option("--seed",
+                    type="int",
+                    default=0,
+                    help="Seed of random numbers (default: 0)."))
+
+    def handle(self, *args, **options):
+        views = options["views"].split(",")
+        unknown_views = set(views) - set(VIEWS)
+        if unknown_views:
+            raise CommandError("Unknown views: %s." %
+                               ", ".join(sorted(unknown_views)))
+        users = get_users(options["prefix"], options["users"])
+        if not users:
+            raise CommandError("There are no users with prefix %r who "
+                               "started shelves." % options["prefix"])
+        # Merged by load_data so the data doesn't change.
+        data_dump = dump_data_as_xml() if "load_data" in views else None
+
+        def benchmark(create_session):
+            return run_benchmark(create_session, users, options["password"],
+                                 views, options["iterations"], data_dump,
+                                 options["seed"])
+
+        report = {}
+        if options["mode"] in ("client", "both"):
+            # Backups aren't requested by views without DEBUG.
+            with override_settings(DEBUG=False,
+                                   ALLOWED_HOSTS=["testserver"]):
+                report["client"] = benchmark(ClientSession)
+        if options["mode"] in ("http", "both"):
+            if options["url"]:
+                report["http"] = benchmark(
+                    lambda: HTTPSession(options["url"]))
+            else:
+                server = RunServer(options["address"])
+                try:
+                    report["http"] = benchmark(
+                        lambda: HTTPSession(server.url))
+                finally:
+                    server.stop()
+
+        output = json.dumps(report, indent=2, sort_keys=True,
+                            separators=(",", ": "))
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(output + "\n")
+        else:
+            self.stdout.write(output)
@@ -0,0 +1,200 @@
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from optparse import make_option
+from pamietacz.dump_load import render_cards
+from pamietacz.models import (Shelf,
+                              Deck,
+                              Card,
+                              TrainCard,
+                              TrainPool,
+                              Review,
+                              DueCounter,
+                              UserProfile)
+import datetime
+import random
+
+# Every this card has code in answer so highlighting is rendered too.
+CODE_CARDS_EVERY = 5
+
+
+def create_card(deck, number):
+    question = "Question %d of *%s*?" % (number, deck.name)
+    if number % CODE_CARDS_EVERY:
+        answer = "Answer %d with **bold** text and list:\n\n* a\n* b" % number
+    else:
+        answer = ("Answer %d with code:\n\n"
+                  "    :::python\n"
+                  "    def answer():\n"
+                  "        return %d\n" % (number, number))
+    return Card(deck=deck, question=question, answer=answer)
+
+
+class HistoryGenerator(object):
+    """Train pools, train cards and reviews of user for decks as if user
+    answered random cards of deck at random times of last days."""
+    def __init__(self, rnd, now, options):
+        self.rnd = rnd
+        self.now = now
+        self.start = now - datetime.timedelta(days=options["history_days"])
+        self.answered = options["answered"]
+        self.answers = options["answers"]
+        self.good = options["good"]
+
+    def answer(self):
+        if self.rnd.random() < self.good:
+            return self.rnd.choice([4, 5])
+        return self.rnd.choice([0, 1, 2, 3])
+
+    def answer_times(self):
+        seconds = int((self.now - self.start).total_seconds())
+        return sorted(self.start + datetime.timedelta(
+            seconds=self.rnd.randint(0, seconds))
+            for _ in range(self.answers))
+
+    def generate(self, userprofile, deck, cards_ids):
+        """Return train cards and reviews (not saved yet) for deck."""
+        answered = set(self.rnd.sample(
+            cards_ids, int(round(len(cards_ids) * self.answered))))
+        train_cards = []
+        reviews = []
+        for card_id in cards_ids:
+            train_card = TrainCard(card_id=card_id,
+                                   userprofile_id=userprofile.id,
+                                   deck_id=deck.id,
+                                   time_to_show=self.start)
+            if card_id in answered:
+                for answered_at in self.answer_times():
+                    reviews.append(train_card.review(self.answer(),
+                                                     answered_at))
+            elif settings.LAZY_TRAIN_CARDS:
+                continue
+            train_cards.append(train_card)
+        return train_cards, reviews
+
+
+class Command(BaseCommand):
+    help = ("Generate synthetic shelves, decks, cards and users who "
+            "started shelves and trained their decks (train cards and "
+            "reviews of answers given in last days), e.g. for benchmarks. "
+            "Users get the same password.")
+    option_list = BaseCommand.option_list + (
+        make_option("--shelves",
+                    type="int",
+                    default=5,
+                    help="Number of shelves (default: 5)."),
+        make_option("--decks",
+                    type="int",
+                    default=5,
+                    help="Number of decks in every shelf (default: 5)."),
+        make_option("--cards",
+                    type="int",
+                    default=100,
+                    help="Number of cards in every deck (default: 100)."),
+        make_option("--users",
+                    type="int",
+                    default=10,
+                    help="Number of users (default: 10)."),
+        make_option("--started-shelves",
+                    type="int",
+                    dest="started_shelves",
+                    default=2,
+                    help=("Number of random shelves started by every user "
+                          "(default: 2).")),
+        make_option("--answered",
+                    type="float",
+                    default=0.5,
+                    help=("Part of cards of started shelves which user "
+                          "answered (default: 0.5).")),
+        make_option("--answers",
+                    type="int",
+                    default=3,
+                    help="Number of answers of answered card (default: 3)."),
+        make_option("--good",
+                    type="float",
+                    default=0.8,
+                    help="Part of answers which are good (default: 0.8)."),
+        make_option("--history-days",
+                    type="int",
+                    dest="history_days",
+                    default=30,
+                    help=("Answers are given in this number of last days "
+                          "(default: 30).")),
+        make_option("--prefix",
+                    default="synthetic",
+                    help=("Prefix of names of shelves and users (default: "
+                          "synthetic).")),
+        make_option("--password",
+                    default="synthetic",
+                    help="Password of users (default: synthetic)."),
+        make_option("--seed",
+                    type="int",
+                    default=0,
+                    help="Seed of random numbers (default: 0)."))
+
+    @transaction.commit_on_success
+    def handle(self, *args, **options):
+        if Shelf.objects.filter(
+                name__startswith=options["prefix"] + " ").exists():
+            raise CommandError("Data with prefix %r already exists." %
+                               options["prefix"])
+        rnd = random.Random(options["seed"])
+        shelves = self._create_shelves(options)
+        users = self._create_users(options)
+        history = HistoryGenerator(rnd, datetime.datetime.now(), options)
+        started_shelves = min(options["started_shelves"], len(shelves))
+        shelves_decks = dict(
+            (shelf, list(Deck.objects.filter(shelf=shelf)))
+            for shelf in shelves)
+        decks_cards = dict(
+            (deck.id, list(Card.objects.filter(deck=deck).values_list(
+                "id", flat=True)))
+            for decks in shelves_decks.itervalues() for deck in decks)
+        reviews_count = 0
+        for userprofile in users:
+            for shelf in rnd.sample(shelves, started_shelves):
+                userprofile.shelves.add(shelf)
+                for deck in shelves_decks[shelf]:
+                    train_cards, reviews = history.generate(
+                        userprofile, deck, decks_cards[deck.id])
+                    TrainPool.objects.create(userprofile=userprofile,
+                                             deck=deck)
+                    TrainCard.objects.bulk_create(train_cards)
+                    Review.objects.bulk_create(reviews)
+                    reviews_count += len(reviews)
+        DueCounter.update_due_counters(all_counters=True)
+        self.stdout.write(
+            "%d shelves, %d decks, %d cards, %d users, %d reviews" %
+            (len(shelves), len(decks_cards),
+             sum(len(cards) for cards in decks_cards.itervalues()),
+             len(users), reviews_count))
+
+    def _create_shelves(self, options):
+        shelves = []
+        for shelf_number in range(options["shelves"]):
+            shelf = Shelf.objects.create(name="%s shelf %d" %
+                                         (options["prefix"], shelf_number))
+            decks_ids = []
+            for deck_number in range(options["decks"]):
+                deck = Deck(shelf=shelf, name="Deck %d" % deck_number)
+                deck.save()
+                cards = [create_card(deck, number)
+                         for number in range(options["cards"])]
+                render_cards(cards)
+                Card.objects.bulk_create(cards)
+                decks_ids.append(deck.id)
+            Deck.update_card_counts(decks_ids)
+            shelves.append(shelf)
+        return shelves
+
+    def _create_users(self, options):
+        # Password is hashed once because hashing is slow.
+        password = make_password(options["password"])
+        UserProfile.objects.bulk_create([
+            UserProfile(username="%s user %d" % (options["prefix"], number),
+                        password=password)
+            for number in range(options["users"])])
+        return list(UserProfile.objects.filter(
+            username__startswith=options["prefix"] + " user ").order_by(
+            "id"))
@@ -0,0 +1,62 @@
+from django.core.management.base import NoArgsCommand
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from pamietacz.models import TrainCard, TrainPool
+
+# Join table which connected train pools with train cards before user
+# and deck were stored directly in train card.
+OLD_TRAIN_CARDS_TABLE = "pamietacz_trainpool_train_cards"
+
+
+class Command(NoArgsCommand):
+    help = ("Move train cards of database created by older version from "
+            "train pool join table to user and deck columns of train card.")
+
+    @transaction.commit_on_success
+    def handle_noargs(self, **options):
+        cursor = connection.cursor()
+        introspection = connection.introspection
+        train_card_table = TrainCard._meta.db_table
+        train_pool_table = TrainPool._meta.db_table
+        if OLD_TRAIN_CARDS_TABLE not in introspection.table_names(cursor):
+            self.stdout.write("Nothing to migrate.")
+            return
+
+        columns = [column[0] for column in
+                   introspection.get_table_description(cursor,
+                                                       train_card_table)]
+        for column, table in (("userprofile_id", "pamietacz_userprofile"),
+                              ("deck_id", "pamietacz_deck")):
+            if column not in columns:
+                cursor.execute("ALTER TABLE %s ADD COLUMN %s integer "
+                               "REFERENCES %s (id)" %
+                               (train_card_table, column, table))
+
+        for column in ("userprofile_id", "deck_id"):
+            cursor.execute("UPDATE %(train_card)s SET %(column)s = ("
+                           "SELECT p.%(column)s FROM %(train_pool)s p "
+                           "INNER JOIN %(join)s j ON j.trainpool_id = p.id "
+                           "WHERE j.traincard_id = %(train_card)s.id)" %
+                           {"train_card": train_card_table,
+                            "train_pool": train_pool_table,
+                            "join": OLD_TRAIN_CARDS_TABLE,
+                            "column": column})
+
+        # Train cards which were not in any train pool were never shown.
+        cursor.execute("DELETE FROM %s WHERE userprofile_id IS NULL" %
+                       train_card_table)
+        deleted = cursor.rowcount
+
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS %s_user_card "
+                       "ON %s (userprofile_id, card_id)" %
+                       (train_card_table, train_card_table))
+        for sql in connection.creation.sql_indexes_for_model(TrainCard,
+                                                             no_style()):
+            cursor.execute(sql.replace("CREATE INDEX",
+                                       "CREATE INDEX IF NOT EXISTS"))
+        cursor.execute("DROP TABLE %s" % OLD_TRAIN_CARDS_TABLE)
+
+        cursor.execute("SELECT COUNT(*) FROM %s" % train_card_table)
+        self.stdout.write("Migrated %d train cards, deleted %d train cards "
+                          "without train pool." %
+                          (cursor.fetchone()[0], deleted))
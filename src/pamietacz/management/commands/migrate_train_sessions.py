@@ -0,0 +1,38 @@
+from django.core.management.base import NoArgsCommand
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from pamietacz.models import TrainSession
+
+# Column in which cards of session were kept as comma separated ids
+# before they were moved to train session cards.
+OLD_TRAIN_CARDS_COLUMN = "train_cards"
+
+
+class Command(NoArgsCommand):
+    help = ("Recreate train sessions table of database created by older "
+            "version where cards of session were kept as comma separated "
+            "ids. Sessions which are not finished are removed.")
+
+    @transaction.commit_on_success
+    def handle_noargs(self, **options):
+        cursor = connection.cursor()
+        introspection = connection.introspection
+        table = TrainSession._meta.db_table
+        columns = [column[0] for column in
+                   introspection.get_table_description(cursor, table)]
+        if OLD_TRAIN_CARDS_COLUMN not in columns:
+            self.stdout.write("Nothing to migrate.")
+            return
+
+        cursor.execute("SELECT COUNT(*) FROM %s" % table)
+        removed = cursor.fetchone()[0]
+        cursor.execute("DROP TABLE %s" % table)
+        style = no_style()
+        statements, _ = connection.creation.sql_create_model(TrainSession,
+                                                             style)
+        statements += connection.creation.sql_indexes_for_model(TrainSession,
+                                                                style)
+        for sql in statements:
+            cursor.execute(sql)
+        self.stdout.write("Removed %d not finished train sessions." %
+                          removed)
@@ -0,0 +1,104 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from optparse import make_option
+from pamietacz.models import Card
+from pamietacz.rendering import RENDER_VERSION, render_markdown_in_worker
+import multiprocessing
+import time
+
+RENDER_VERSION_COLUMN = "render_version"
+
+
+def split(items, number_of_parts):
+    size = max(1, -(-len(items) // number_of_parts))
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+class Command(BaseCommand):
+    help = ("Render again HTML of cards which were rendered by other "
+            "version of rendering (other Markdown extensions or library "
+            "versions). Cards are rendered in process pool chunk by chunk, "
+            "every chunk is saved in its own transaction so command which "
+            "was stopped continues with cards which are still not "
+            "rendered. Column for render version is added to cards table "
+            "of database created by older version.")
+    option_list = BaseCommand.option_list + (
+        make_option("--processes",
+                    type="int",
+                    default=multiprocessing.cpu_count(),
+                    help=("Number of rendering processes, 0 renders in "
+                          "this process (default: number of CPUs).")),
+        make_option("--chunk",
+                    type="int",
+                    default=1000,
+                    help=("Number of cards rendered and saved at once "
+                          "(default: 1000).")))
+
+    def handle(self, *args, **options):
+        self.add_render_version_column()
+        processes = options["processes"]
+        pool = multiprocessing.Pool(processes) if processes else None
+        try:
+            self.rerender(pool, max(processes, 1), options["chunk"])
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+    @transaction.commit_on_success
+    def add_render_version_column(self):
+        cursor = connection.cursor()
+        table = Card._meta.db_table
+        columns = [column[0] for column in
+                   connection.introspection.get_table_description(cursor,
+                                                                  table)]
+        if RENDER_VERSION_COLUMN not in columns:
+            cursor.execute("ALTER TABLE %s ADD COLUMN %s varchar(40) "
+                           "NOT NULL DEFAULT ''" %
+                           (table, RENDER_VERSION_COLUMN))
+
+    def rerender(self, pool, processes, chunk):
+        stale_cards = Card.objects.exclude(
+            render_version=RENDER_VERSION).order_by("id")
+        total = stale_cards.count()
+        self.stdout.write("%d cards to render." % total)
+        start = time.time()
+        rendered = 0
+        changed = 0
+        last_id = 0
+        while True:
+            cards = list(stale_cards.filter(id__gt=last_id).values_list(
+                "id", "question", "answer")[:chunk])
+            if not cards:
+                break
+            last_id = cards[-1][0]
+            texts = []
+            for card_id, question, answer in cards:
+                texts += [question, answer]
+            if pool is None:
+                htmls = render_markdown_in_worker(texts)
+            else:
+                htmls = sum(pool.map(render_markdown_in_worker,
+                                     split(texts, processes)), [])
+            # Card edited while it was rendered keeps HTML saved with its
+            # new text and isn't updated.
+            with transaction.commit_on_success():
+                cursor = connection.cursor()
+                cursor.executemany(
+                    "UPDATE %s SET question_after_markdown = %%s, "
+                    "answer_after_markdown = %%s, render_version = %%s "
+                    "WHERE id = %%s AND question = %%s AND answer = %%s" %
+                    Card._meta.db_table,
+                    [(htmls[2 * i], htmls[2 * i + 1], RENDER_VERSION,
+                      card_id, question, answer)
+                     for i, (card_id, question, answer) in enumerate(cards)])
+                updated = cursor.rowcount
+            rendered += updated
+            changed += len(cards) - updated
+            duration = time.time() - start
+            self.stdout.write("%d / %d cards rendered (%.0f cards per "
+                              "second)." %
+                              (rendered, total,
+                               rendered / max(duration, 1e-6)))
+        if changed:
+            self.stdout.write("%d cards were changed while they were "
+                              "rendered." % changed)
@@ -0,0 +1,191 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from optparse import make_option
+from pamietacz import scheduling
+from pamietacz.models import TrainCard, Review, DueCounter
+import csv
+import datetime
+import functools
+import numpy
+import time
+
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def parse_datetime(value):
+    try:
+        return datetime.datetime.strptime(value, DATETIME_FORMAT)
+    except ValueError:
+        raise CommandError("Wrong time %r, expected format is %s." %
+                           (value, DATETIME_FORMAT.replace("%", "")))
+
+
+def read_answers(path):
+    """Read answers from CSV file with rows: user id, card id, answer (0-5)
+    and time of answer. Return dict (user id, card id) -> list of
+    (time, answer) sorted by time."""
+    answers = {}
+    with open(path, "rb") as f:
+        for line_number, row in enumerate(csv.reader(f), 1):
+            try:
+                userprofile_id, card_id, q, answered_at = row
+                key = (int(userprofile_id), int(card_id))
+                q = int(q)
+            except ValueError:
+                raise CommandError("Wrong answer in line %d of %s." %
+                                   (line_number, path))
+            answers.setdefault(key, []).append((parse_datetime(answered_at),
+                                                q))
+    for card_answers in answers.itervalues():
+        card_answers.sort()
+    return answers
+
+
+def read_reviews(first_train_card_id, last_train_card_id):
+    """Read answers kept in reviews of train cards with ids in given range.
+    Return dict like read_answers."""
+    cursor = connection.cursor()
+    cursor.execute(
+        "SELECT r.userprofile_id, r.card_id, r.time, r.q "
+        "FROM %(review)s r "
+        "JOIN %(traincard)s tc ON tc.userprofile_id = r.userprofile_id "
+        "AND tc.card_id = r.card_id "
+        "WHERE tc.id BETWEEN %%s AND %%s "
+        "ORDER BY r.time, r.id" %
+        {"review": Review._meta.db_table,
+         "traincard": TrainCard._meta.db_table},
+        [first_train_card_id, last_train_card_id])
+    answers = {}
+    for userprofile_id, card_id, answered_at, q in cursor.fetchall():
+        answers.setdefault((userprofile_id, card_id), []).append(
+            (answered_at, q))
+    return answers
+
+
+class Command(BaseCommand):
+    help = ("Count again schedule of train cards of given decks or users "
+            "(all train cards if none is given). Time to show is counted "
+            "from given time and current interval or, with --replay or "
+            "--reviews, train cards are reset and all answers are applied "
+            "again.")
+    option_list = BaseCommand.option_list + (
+        make_option("--deck",
+                    type="int",
+                    action="append",
+                    dest="decks",
+                    default=[],
+                    help="Id of deck (can be given many times)."),
+        make_option("--user",
+                    action="append",
+                    dest="users",
+                    default=[],
+                    help="Name of user (can be given many times)."),
+        make_option("--from",
+                    dest="from_time",
+                    help=("Time from which cards are scheduled, %s "
+                          "(default: now)." %
+                          DATETIME_FORMAT.replace("%", ""))),
+        make_option("--replay",
+                    help=("CSV file with answers (user id, card id, "
+                          "answer, time) which are applied again.")),
+        make_option("--reviews",
+                    action="store_true",
+                    default=False,
+                    help="Apply again answers kept in reviews."),
+        make_option("--chunk",
+                    type="int",
+                    default=10000,
+                    help=("Number of train cards updated in one "
+                          "transaction (default: 10000).")))
+
+    def handle(self, *args, **options):
+        train_cards = TrainCard.objects.all()
+        if options["decks"]:
+            train_cards = train_cards.filter(deck__in=options["decks"])
+        if options["users"]:
+            train_cards = train_cards.filter(
+                userprofile__username__in=options["users"])
+        if options["replay"]:
+            answers = read_answers(options["replay"])
+            schedule = functools.partial(self.replay,
+                                         get_answers=lambda rows: answers)
+        elif options["reviews"]:
+            schedule = functools.partial(
+                self.replay,
+                get_answers=lambda rows: read_reviews(rows[0][0],
+                                                      rows[-1][0]))
+        else:
+            if options["from_time"]:
+                from_time = parse_datetime(options["from_time"])
+            else:
+                from_time = datetime.datetime.now()
+            schedule = functools.partial(self.reschedule,
+                                         from_time=from_time)
+
+        start = time.time()
+        updated = 0
+        last_id = 0
+        while True:
+            rows = list(train_cards.filter(id__gt=last_id).order_by(
+                "id").values_list("id", "userprofile_id", "card_id", "ef",
+                                  "n", "i", "time_to_show")[
+                :options["chunk"]])
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            with transaction.commit_on_success():
+                updated += self.save(schedule(rows))
+        # Cards to repeat have changed.
+        DueCounter.update_due_counters(all_counters=True)
+        duration = time.time() - start
+        self.stdout.write("Updated %d train cards in %.2f s (%.0f per "
+                          "second)." %
+                          (updated, duration, updated / max(duration, 1e-6)))
+
+    def reschedule(self, rows, from_time):
+        ids, _, _, ef, n, i, _ = zip(*rows)
+        time_to_show = scheduling.reschedule(n, i, from_time)
+        return ids, ef, n, i, time_to_show
+
+    def replay(self, rows, get_answers):
+        answers = get_answers(rows)
+        rows = [row for row in rows if (row[1], row[2]) in answers]
+        if not rows:
+            return [], [], [], [], []
+        ids, userprofiles_ids, cards_ids, _, _, _, time_to_show = zip(*rows)
+        cards_answers = [answers[key]
+                         for key in zip(userprofiles_ids, cards_ids)]
+        # One row for each answer, cards with fewer answers are padded
+        # with -1 which is skipped.
+        max_answers = max(len(card_answers)
+                          for card_answers in cards_answers)
+        q = numpy.full((max_answers, len(rows)), -1, dtype=numpy.int64)
+        now = numpy.full((max_answers, len(rows)), "NaT",
+                         dtype="datetime64[us]")
+        for column, card_answers in enumerate(cards_answers):
+            for row, (answered_at, answer) in enumerate(card_answers):
+                q[row, column] = answer
+                now[row, column] = answered_at
+        default = TrainCard()
+        ef, n, i, time_to_show = scheduling.replay(
+            numpy.full(len(rows), default.ef),
+            numpy.full(len(rows), default.n),
+            numpy.full(len(rows), default.i),
+            time_to_show, q, now)
+        return ids, ef, n, i, time_to_show
+
+    def save(self, schedule):
+        ids, ef, n, i, time_to_show = schedule
+        value_to_db_datetime = connection.ops.value_to_db_datetime
+        params = zip(numpy.asarray(ef).tolist(),
+                     numpy.asarray(n).tolist(),
+                     numpy.asarray(i).tolist(),
+                     [value_to_db_datetime(t)
+                      for t in scheduling.to_datetimes(time_to_show)],
+                     ids)
+        if params:
+            connection.cursor().executemany(
+                "UPDATE %s SET ef = %%s, n = %%s, i = %%s, "
+                "time_to_show = %%s WHERE id = %%s" %
+                TrainCard._meta.db_table, params)
+        return len(params)
@@ -0,0 +1,38 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+from pamietacz.backups import SnapshotStore
+
+
+class Command(BaseCommand):
+    args = "[snapshot]"
+    help = ("Restore database from backup snapshot (the newest if none is "
+            "given). Application should be stopped because database file "
+            "is replaced.")
+    option_list = BaseCommand.option_list + (
+        make_option("--list",
+                    action="store_true",
+                    default=False,
+                    help="List snapshots."),
+        make_option("--output",
+                    help=("File to which database is restored (default: "
+                          "database from settings).")))
+
+    def handle(self, *args, **options):
+        store = SnapshotStore(settings.BACKUP_DIRECTORY)
+        snapshots = store.snapshots()
+        if options["list"]:
+            for name in snapshots:
+                self.stdout.write(name)
+            return
+        if not snapshots:
+            raise CommandError("There are no snapshots.")
+        name = args[0] if args else snapshots[-1]
+        if name not in snapshots:
+            raise CommandError("Unknown snapshot %s." % name)
+        output = options["output"] or settings.DATABASES["default"]["NAME"]
+        try:
+            store.restore(name, output)
+        except ValueError as e:
+            raise CommandError(str(e))
+        self.stdout.write("Restored snapshot %s to %s." % (name, output))
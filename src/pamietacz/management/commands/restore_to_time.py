@@ -0,0 +1,39 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+from pamietacz.backups import WALArchive
+import datetime
+
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+class Command(BaseCommand):
+    args = "<time>"
+    help = ("Restore database from WAL archive to given time (%s). "
+            "Application and archive_wal command should be stopped "
+            "because database file is replaced." %
+            DATETIME_FORMAT.replace("%", ""))
+    option_list = BaseCommand.option_list + (
+        make_option("--output",
+                    help=("File to which database is restored (default: "
+                          "database from settings).")),)
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Time is required.")
+        try:
+            time = datetime.datetime.strptime(args[0], DATETIME_FORMAT)
+        except ValueError:
+            raise CommandError("Wrong time %r, expected format is %s." %
+                               (args[0], DATETIME_FORMAT.replace("%", "")))
+        if not settings.WAL_ARCHIVE_DIRECTORY:
+            raise CommandError("WAL_ARCHIVE_DIRECTORY isn't set.")
+        database_name = settings.DATABASES["default"]["NAME"]
+        output = options["output"] or database_name
+        archive = WALArchive(settings.WAL_ARCHIVE_DIRECTORY, database_name)
+        try:
+            generation = archive.restore(time, output)
+        except ValueError as e:
+            raise CommandError(str(e))
+        self.stdout.write("Restored database to %s from archive started "
+                          "at %s." % (output, generation))
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+from pamietacz.jobs import run_pending_jobs
+import time
+
+
+class Command(BaseCommand):
+    help = "Run background jobs (e.g. adding new cards to train pools)."
+    option_list = BaseCommand.option_list + (
+        make_option("--batch",
+                    type="int",
+                    default=10,
+                    help="Number of jobs taken at once (default: 10)."),
+        make_option("--sleep",
+                    type="float",
+                    default=5,
+                    help=("Seconds to wait when there are no jobs "
+                          "(default: 5).")),
+        make_option("--once",
+                    action="store_true",
+                    default=False,
+                    help="Exit when there are no more pending jobs."))
+
+    def handle(self, *args, **options):
+        while True:
+            jobs = run_pending_jobs(options["batch"])
+            for job in jobs:
+                self.stdout.write("Job %d (%s): %s, %d / %d, attempt %d" %
+                                  (job.id, job.kind, job.status,
+                                   job.progress, job.total, job.attempts))
+            if not jobs:
+                if options["once"]:
+                    break
+                time.sleep(options["sleep"])
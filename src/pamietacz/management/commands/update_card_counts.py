@@ -0,0 +1,24 @@
+from django.core.management.base import NoArgsCommand
+from django.db import connection, transaction
+from pamietacz.models import Deck
+
+CARD_COUNT_COLUMN = "card_count"
+
+
+class Command(NoArgsCommand):
+    help = ("Count again cards of all decks. Column for the number of "
+            "cards is added to decks table of database created by older "
+            "version.")
+
+    @transaction.commit_on_success
+    def handle_noargs(self, **options):
+        cursor = connection.cursor()
+        table = Deck._meta.db_table
+        columns = [column[0] for column in
+                   connection.introspection.get_table_description(cursor,
+                                                                  table)]
+        if CARD_COUNT_COLUMN not in columns:
+            cursor.execute("ALTER TABLE %s ADD COLUMN %s integer unsigned "
+                           "NOT NULL DEFAULT 0" % (table, CARD_COUNT_COLUMN))
+        updated = Deck.update_card_counts()
+        self.stdout.write("Counted cards of %d decks." % updated)
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+from pamietacz.models import DueCounter
+
+
+class Command(BaseCommand):
+    help = ("Count again cards to repeat of decks in which some cards "
+            "became due (should be run periodically, e.g. every minute).")
+    option_list = BaseCommand.option_list + (
+        make_option("--all",
+                    action="store_true",
+                    dest="all_counters",
+                    default=False,
+                    help="Count again all due counters."),)
+
+    def handle(self, *args, **options):
+        updated = DueCounter.update_due_counters(options["all_counters"])
+        self.stdout.write("Updated %d due counters." % updated)
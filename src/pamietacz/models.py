@@ -1,16 +1,13 @@
+from django.conf import settings
 from django.contrib.auth.models import AbstractUser, UserManager
 from django.core.exceptions import ValidationError
-from django.db import models, transaction
+from django.db import connection, models, transaction, IntegrityError
+from django.db.backends.signals import connection_created
 import re
-import random
 import datetime
-from markdown import Markdown
-
-
-markdown_instance = Markdown(extensions=["tables",
-                                         "fenced_code",
-                                         "codehilite"],
-                             output_format="html5")
+import json
+from rendering import render_markdown_many, RENDER_VERSION
+from database import configure_sqlite
 
 
 def whitespace_validator(text):
@@ -34,6 +31,10 @@ class Deck(models.Model):
                             validators=[whitespace_validator])
     order = models.PositiveIntegerField(blank=False)
     shelf = models.ForeignKey(Shelf)
+    # Number of cards in deck kept so that cards don't have to be counted
+    # for every deck shown. It's updated when card is saved or deleted,
+    # after bulk operations update_card_counts has to be called.
+    card_count = models.PositiveIntegerField(default=0, editable=False)
 
     def clean(self):
         self.name = self.name.strip()
@@ -60,8 +61,28 @@ class Deck(models.Model):
         except Deck.DoesNotExist:
             pass
 
+    @classmethod
+    def update_card_counts(cls, decks_ids=None):
+        """Count again cards of given decks (or all decks)."""
+        query = ("UPDATE %(deck)s SET card_count = (SELECT COUNT(*) "
+                 "FROM %(card)s c WHERE c.deck_id = %(deck)s.id)" %
+                 {"deck": cls._meta.db_table,
+                  "card": Card._meta.db_table})
+        params = []
+        if decks_ids is not None:
+            if not decks_ids:
+                return 0
+            query += " WHERE id IN (%s)" % ", ".join(["%s"] * len(decks_ids))
+            params = list(decks_ids)
+        cursor = connection.cursor()
+        cursor.execute(query, params)
+        transaction.commit_unless_managed()
+        return cursor.rowcount
+
     def save(self, *args, **kwargs):
-        if self.pk is None:
+        # New deck is put after other decks of shelf unless its order is
+        # given.
+        if self.pk is None and self.order is None:
             if Deck.objects.filter(shelf=self.shelf).count() == 0:
                 self.order = 0
             else:
@@ -81,14 +102,71 @@ class Card(models.Model):
     answer_after_markdown = (
         models.TextField(blank=False, validators=[whitespace_validator]))
     deck = models.ForeignKey(Deck)
+    # Version of rendering which was used for HTML of question and answer.
+    # Cards rendered by other version are rendered again by rerender_cards
+    # command.
+    render_version = models.CharField(max_length=40, default="",
+                                      editable=False)
 
     class Meta:
         unique_together = ("deck", "question")
 
     def save(self, *args, **kwargs):
-        self.answer_after_markdown = markdown_instance.convert(self.answer)
-        self.question_after_markdown = markdown_instance.convert(self.question)
+        self.question_after_markdown, self.answer_after_markdown = (
+            render_markdown_many([self.question, self.answer]))
+        self.render_version = RENDER_VERSION
+        new_card = self.pk is None
         super(Card, self).save(*args, **kwargs)
+        if new_card:
+            Deck.objects.filter(id=self.deck_id).update(
+                card_count=models.F("card_count") + 1)
+            DueCounter.card_added(self)
+
+    def delete(self):
+        DueCounter.card_deleted(self)
+        Deck.objects.filter(id=self.deck_id).update(
+            card_count=models.F("card_count") - 1)
+        super(Card, self).delete()
+
+
+class RenderedMarkdown(models.Model):
+    """HTML rendered from Markdown kept by hash of text and configuration
+    of rendering (see rendering.render_key)."""
+    key = models.CharField(max_length=40, primary_key=True)
+    html = models.TextField()
+
+    # Maximum number of keys in one query (SQLite limits the number of
+    # parameters).
+    KEYS_IN_QUERY = 500
+
+    @classmethod
+    def get_many(cls, keys):
+        """Return dict key -> HTML for found keys."""
+        found = {}
+        for i in range(0, len(keys), cls.KEYS_IN_QUERY):
+            found.update(cls.objects.filter(
+                key__in=keys[i:i + cls.KEYS_IN_QUERY]).values_list("key",
+                                                                   "html"))
+        return found
+
+    @classmethod
+    def store_many(cls, htmls):
+        """Save dict key -> HTML. Keys which are already saved (e.g. by
+        other process) are skipped. When other process saves some of keys
+        after they were checked then they are checked again, and if it
+        happens again then HTML isn't saved (it's only cache)."""
+        for attempt in range(2):
+            existing = cls.get_many(htmls.keys())
+            sid = transaction.savepoint()
+            try:
+                cls.objects.bulk_create([cls(key=key, html=html)
+                                         for key, html in htmls.iteritems()
+                                         if key not in existing])
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
+            else:
+                transaction.savepoint_commit(sid)
+                return
 
 
 class UserProfile(AbstractUser):
@@ -97,25 +175,60 @@ class UserProfile(AbstractUser):
     objects = UserManager()
 
     def started_shelf(self, shelf):
-        return shelf in self.shelves.all()
+        return self.shelves.filter(pk=shelf.pk).exists()
 
 
 class TrainCard(models.Model):
-    """Train card remembers state of given card for specific user."""
+    """Train card remembers state of given card for specific user.
+
+    User and deck are kept also directly in train card (not only in train
+    pool) so the cards to repeat can be found with the index on
+    (userprofile, deck, time_to_show) without any joins."""
     card = models.ForeignKey(Card)
-    time_to_show = models.DateTimeField(auto_now_add=True)
+    userprofile = models.ForeignKey(UserProfile)
+    deck = models.ForeignKey(Deck)
+    time_to_show = models.DateTimeField(default=datetime.datetime.now)
     i = models.IntegerField(default=0)
     ef = models.FloatField(default=2.5)
     n = models.IntegerField(default=0)
 
+    # Fields which are changed by calculate_interval.
+    SCHEDULE_FIELDS = ["time_to_show", "i", "ef", "n"]
+
+    class Meta:
+        unique_together = ("userprofile", "card")
+        index_together = [["userprofile", "deck", "time_to_show"]]
+
+    @classmethod
+    def insert_from_select(cls, select, params):
+        """Insert new train cards for rows returned by given SELECT
+        statement. The SELECT has to return card id, user id and deck id.
+        Other columns get default values. Rows are copied inside database
+        so the number of statements doesn't depend on the number of
+        rows."""
+        fields = [cls._meta.get_field(name)
+                  for name in ("time_to_show", "i", "ef", "n")]
+        query = ("INSERT INTO %s (card_id, userprofile_id, deck_id, %s) "
+                 "SELECT s.*, %s FROM (%s) s" %
+                 (cls._meta.db_table,
+                  ", ".join(field.column for field in fields),
+                  ", ".join(["%s"] * len(fields)),
+                  select))
+        values = [field.get_db_prep_save(field.get_default(), connection)
+                  for field in fields]
+        cursor = connection.cursor()
+        cursor.execute(query, values + params)
+        transaction.commit_unless_managed()
+
     def _calculate_new_ef(self, q):
         new_ef = self.ef + (0.1 - (5 - q) * (0.08 + (5 - q) * 0.02))
         if new_ef < 1.3:
             new_ef = 1.3
         self.ef = new_ef
 
-    def calculate_interval(self, q):
-        """SuperMemo 2 algorithm (slightly modified)."""
+    def calculate_interval(self, q, now=None):
+        """SuperMemo 2 algorithm (slightly modified). New time to show is
+        counted from now or from given time of answer."""
 
         # Calculate new EF only for good answers.
         if not q < 3:
@@ -134,17 +247,84 @@ class TrainCard(models.Model):
 
         # Set new time to show only for good answers.
         if not q < 4:
+            if now is None:
+                now = datetime.datetime.now()
             self.time_to_show = (
-                datetime.datetime.now() +
-                datetime.timedelta(seconds=int(24 * 60 * self.i)))
+                now + datetime.timedelta(seconds=int(24 * 60 * self.i)))
+
+    def review(self, q, now=None):
+        """Calculate new interval for answer given now (or at given time)
+        and return review (not saved yet) which remembers it."""
+        if now is None:
+            now = datetime.datetime.now()
+        previous_interval = self.i
+        self.calculate_interval(q, now)
+        return Review(userprofile_id=self.userprofile_id,
+                      card_id=self.card_id,
+                      q=q,
+                      time=now,
+                      previous_interval=previous_interval,
+                      interval=int(self.i))
+
+    def save_schedule(self):
+        """Save only fields changed by calculate_interval. Train card which
+        was not saved yet is inserted."""
+        if self.id is None:
+            self.save()
+        else:
+            self.save(update_fields=self.SCHEDULE_FIELDS)
+
+
+class Review(models.Model):
+    """Answer given by user for card. Reviews are only added (never
+    changed) so they keep the whole history of answers.
+
+    Index on (userprofile, time) is used also instead of index on
+    userprofile alone."""
+    userprofile = models.ForeignKey(UserProfile, db_index=False)
+    card = models.ForeignKey(Card)
+    q = models.PositiveSmallIntegerField()
+    time = models.DateTimeField()
+    previous_interval = models.IntegerField()
+    interval = models.IntegerField()
+
+    class Meta:
+        index_together = [["userprofile", "time"]]
 
 
 class TrainPool(models.Model):
     """Train pool is source of cards for specific user. When new session
-    starts then the cards are retrieved from this pool."""
+    starts then the cards are retrieved from this pool.
+
+    If LAZY_TRAIN_CARDS setting is turned on then train cards are not
+    created for the cards of deck when pool is created or when card is
+    added. Train card is saved only when user answers the card first time.
+    Cards without train card are new ones and can be repeated now."""
     deck = models.ForeignKey(Deck)
     userprofile = models.ForeignKey(UserProfile)
-    train_cards = models.ManyToManyField(TrainCard)
+
+    # Orders in which cards to repeat can be chosen. New cards (without
+    # train card) are due now so they come after overdue cards.
+    ORDER_BY = {
+        "random": "%(random)s",
+        "most_overdue": "is_new, time_to_show, card_id",
+        "lowest_ef": "COALESCE(ef, 2.5), card_id",
+    }
+
+    # Cards are chosen from so many times more (the most overdue and the
+    # first new) candidates than the limit, so they are found by index
+    # and the whole due cards aren't sorted. Lowest EF has no index and
+    # it's chosen from all due cards.
+    CANDIDATES_FACTOR = {
+        "random": 10,
+        "most_overdue": 1,
+        "lowest_ef": None,
+    }
+
+    @property
+    def train_cards(self):
+        return TrainCard.objects.filter(userprofile_id=self.userprofile_id,
+                                        deck_id=self.deck_id)
 
     @classmethod
     def create_or_get_train_pool(cls, userprofile, deck):
@@ -157,24 +337,293 @@ class TrainPool(models.Model):
 
     @classmethod
     def create_train_pool(cls, userprofile, deck):
-        cards = Card.objects.filter(deck=deck)
         train_pool = TrainPool(userprofile=userprofile, deck=deck)
         train_pool.save()
-
-        # Fill pool with cards.
-        for card in cards:
-            train_card = TrainCard(card=card)
-            train_card.save()
-            train_pool.train_cards.add(train_card)
-        train_pool.save()
+        DueCounter.create_due_counter(userprofile, deck)
+        if settings.LAZY_TRAIN_CARDS:
+            return train_pool
+
+        # Fill pool with cards. All train cards are inserted with one
+        # statement no matter how many cards are in the deck.
+        TrainCard.insert_from_select(
+            "SELECT id, %%s, deck_id FROM %s WHERE deck_id = %%s" %
+            Card._meta.db_table,
+            [userprofile.id, deck.id])
         return train_pool
 
+    @classmethod
+    def add_card_to_train_pools(cls, card):
+        """If new card is added then we need also to add it to train pools
+        so users can train it also from now. If deck is trained by many
+        users then it's done in background job."""
+        if settings.LAZY_TRAIN_CARDS:
+            return
+        train_pools = TrainPool.objects.filter(deck_id=card.deck_id)
+        if train_pools.count() > settings.TRAIN_POOLS_IN_REQUEST_LIMIT:
+            Job.enqueue(Job.ADD_CARD_TO_TRAIN_POOLS,
+                        card.deck,
+                        card_id=card.id)
+        else:
+            cls.add_card_to_train_pools_batch(card.id, card.deck_id)
+
+    @classmethod
+    def add_card_to_train_pools_batch(cls, card_id, deck_id,
+                                      first_train_pool_id=None,
+                                      last_train_pool_id=None):
+        """Add card to train pools of deck with ids in given range. Train
+        pools which already have this card are skipped so the same batch
+        can be repeated. Card is selected from cards table so nothing is
+        added when card was deleted before its job was run."""
+        select = ("SELECT c.id, p.userprofile_id, p.deck_id FROM %s p "
+                  "JOIN %s c ON c.id = %%s "
+                  "WHERE p.deck_id = %%s AND NOT EXISTS ("
+                  "SELECT 1 FROM %s tc WHERE tc.card_id = c.id "
+                  "AND tc.userprofile_id = p.userprofile_id)" %
+                  (TrainPool._meta.db_table, Card._meta.db_table,
+                   TrainCard._meta.db_table))
+        params = [card_id, deck_id]
+        if first_train_pool_id is not None:
+            select += " AND p.id BETWEEN %s AND %s"
+            params += [first_train_pool_id, last_train_pool_id]
+        TrainCard.insert_from_select(select, params)
+
+    def new_cards(self):
+        """Cards of deck which user has never answered and which have no
+        train card yet."""
+        return Card.objects.filter(deck_id=self.deck_id).exclude(
+            id__in=self.train_cards.values("card_id"))
+
+    def new_train_cards(self):
+        """Not saved train cards for new cards. They are saved when user
+        answers them first time."""
+        now = datetime.datetime.now()
+        return [TrainCard(card=card,
+                          userprofile_id=self.userprofile_id,
+                          deck_id=self.deck_id,
+                          time_to_show=now)
+                for card in self.new_cards()]
+
+    def cards_to_repeat_now(self):
+        """Ids of cards which can be repeated now: cards with train card
+        which time to show has passed and new cards."""
+        not_to_repeat = self.train_cards.filter(
+            time_to_show__gt=datetime.datetime.now())
+        cards = Card.objects.filter(deck_id=self.deck_id).exclude(
+            id__in=not_to_repeat.values("card_id"))
+        return cards.values_list("id", flat=True)
+
     def number_of_cards_to_repeat_now(self):
-        items = 0
-        for train_card in self.train_cards.all():
-            if train_card.time_to_show <= datetime.datetime.now():
-                items += 1
-        return items
+        return self.cards_to_repeat_now().count()
+
+    def choose_cards_to_repeat_now(self, limit=None, order="random"):
+        """Choose cards which can be repeated now. Cards are chosen
+        and limited in database and only ids are retrieved so the time
+        doesn't depend on the number of cards to repeat.
+
+        Returns list of tuples (card id, train card id). Train card id is
+        None for cards without train card."""
+        query, params = self.cards_to_repeat_now_query(limit, order)
+        cursor = connection.cursor()
+        cursor.execute(query, params)
+        return cursor.fetchall()
+
+    def cards_to_repeat_now_query(self, limit, order):
+        """Return query and its parameters which choose cards to repeat
+        now. Due train cards are found by index on (userprofile, deck,
+        time_to_show) from the most overdue and new cards from the first
+        card of deck, both only up to the number of candidates."""
+        try:
+            order_by = self.ORDER_BY[order]
+        except KeyError:
+            raise ValueError("Unknown order: %s" % order)
+        candidates = None
+        if limit is not None and self.CANDIDATES_FACTOR[order] is not None:
+            candidates = limit * self.CANDIDATES_FACTOR[order]
+        now = connection.ops.value_to_db_datetime(datetime.datetime.now())
+        due_train_cards = (
+            "SELECT tc.card_id AS card_id, tc.id AS train_card_id, "
+            "0 AS is_new, tc.time_to_show AS time_to_show, tc.ef AS ef "
+            "FROM %s tc WHERE tc.userprofile_id = %%s AND tc.deck_id = %%s "
+            "AND tc.time_to_show <= %%s ORDER BY tc.time_to_show" %
+            TrainCard._meta.db_table)
+        new_cards = (
+            "SELECT c.id, NULL, 1, NULL, NULL FROM %s c "
+            "WHERE c.deck_id = %%s AND NOT EXISTS ("
+            "SELECT 1 FROM %s tc "
+            "WHERE tc.userprofile_id = %%s AND tc.card_id = c.id) "
+            "ORDER BY c.id" %
+            (Card._meta.db_table, TrainCard._meta.db_table))
+        params = [self.userprofile_id, self.deck_id, now]
+        if candidates is not None:
+            due_train_cards += " LIMIT %s"
+            params.append(candidates)
+        params += [self.deck_id, self.userprofile_id]
+        if candidates is not None:
+            new_cards += " LIMIT %s"
+            params.append(candidates)
+        query = ("SELECT card_id, train_card_id FROM ("
+                 "SELECT * FROM (%s) due UNION ALL "
+                 "SELECT * FROM (%s) new_cards) cards "
+                 "ORDER BY %s" %
+                 (due_train_cards, new_cards,
+                  order_by % {"random": connection.ops.random_function_sql()}))
+        if limit is not None:
+            query += " LIMIT %s"
+            params.append(limit)
+        return query, params
+
+
+class DueCounter(models.Model):
+    """Number of all cards and cards which user can repeat now for deck
+    which is trained by user. Counters are updated when cards are added,
+    deleted or answered so the cards don't have to be counted every time
+    when they are shown.
+
+    Cards which were answered can become due later. The earliest such
+    time is kept in next_due and the counters for which this time passed
+    are counted again by update_due_counters command (which should be run
+    periodically). Next due time can be earlier than it is needed (e.g.
+    when card was deleted) but never later."""
+    userprofile = models.ForeignKey(UserProfile, db_index=False)
+    deck = models.ForeignKey(Deck)
+    total_cards = models.IntegerField(default=0)
+    due_cards = models.IntegerField(default=0)
+    next_due = models.DateTimeField(null=True, db_index=True)
+
+    class Meta:
+        unique_together = ("userprofile", "deck")
+
+    @classmethod
+    def create_due_counter(cls, userprofile, deck):
+        # All cards of new train pool can be repeated now.
+        total_cards = Card.objects.filter(deck=deck).count()
+        return cls.objects.create(userprofile=userprofile,
+                                  deck=deck,
+                                  total_cards=total_cards,
+                                  due_cards=total_cards)
+
+    @classmethod
+    def card_added(cls, card):
+        """New card can be repeated now by all users who train the deck."""
+        cls.cards_added(card.deck_id, 1)
+
+    @classmethod
+    def cards_added(cls, deck_id, number_of_cards):
+        cls.objects.filter(deck_id=deck_id).update(
+            total_cards=models.F("total_cards") + number_of_cards,
+            due_cards=models.F("due_cards") + number_of_cards)
+
+    @classmethod
+    def card_deleted(cls, card):
+        """Remove card from counters. It's counted as due for users who
+        don't have train card for it which is shown later. Due cards are
+        never decreased below zero."""
+        now = connection.ops.value_to_db_datetime(datetime.datetime.now())
+        due_cards = ("due_cards - CASE WHEN EXISTS ("
+                     "SELECT 1 FROM %(train_card)s tc "
+                     "WHERE tc.userprofile_id = "
+                     "%(due_counter)s.userprofile_id "
+                     "AND tc.card_id = %%s AND tc.time_to_show > %%s) "
+                     "THEN 0 ELSE 1 END" %
+                     {"due_counter": cls._meta.db_table,
+                      "train_card": TrainCard._meta.db_table})
+        cursor = connection.cursor()
+        cursor.execute(
+            "UPDATE %s SET total_cards = total_cards - 1, "
+            "due_cards = CASE WHEN %s < 0 THEN 0 ELSE %s END "
+            "WHERE deck_id = %%s" %
+            (cls._meta.db_table, due_cards, due_cards),
+            [card.id, now, card.id, now, card.deck_id])
+        transaction.commit_unless_managed()
+
+    @classmethod
+    def cards_answered(cls, userprofile_id, deck_id, times_to_show, now):
+        """Update counter after answers. Times to show are list of tuples
+        (time to show before answer, time to show after answer).
+
+        Card which became due after the counter was counted isn't counted
+        as due yet, so due cards are removed from counter only when all of
+        them were due before its next due time. Otherwise the counter is
+        counted again by update_due_counters anyway (its next due time
+        passed) and it's only never decreased below zero meanwhile."""
+        due_cards_added = 0
+        due_cards_removed = 0
+        last_removed = None
+        next_due = None
+        for old_time_to_show, new_time_to_show in times_to_show:
+            if new_time_to_show <= now:
+                due_cards_added += 1
+            else:
+                next_due = min(next_due or new_time_to_show,
+                               new_time_to_show)
+            if old_time_to_show <= now:
+                due_cards_removed += 1
+                last_removed = max(last_removed or old_time_to_show,
+                                   old_time_to_show)
+        if due_cards_added == due_cards_removed and next_due is None:
+            return
+        due_cards = "due_cards + %s"
+        params = [due_cards_added]
+        if due_cards_removed:
+            due_cards += (" - CASE WHEN next_due IS NULL OR next_due > %s "
+                          "THEN %s ELSE 0 END")
+            params += [connection.ops.value_to_db_datetime(last_removed),
+                       due_cards_removed]
+        query = ("UPDATE %s SET due_cards = CASE WHEN %s < 0 THEN 0 "
+                 "ELSE %s END" % (cls._meta.db_table, due_cards, due_cards))
+        params += params
+        if next_due is not None:
+            next_due = connection.ops.value_to_db_datetime(next_due)
+            query += (", next_due = CASE WHEN next_due IS NULL "
+                      "OR next_due > %s THEN %s ELSE next_due END")
+            params += [next_due, next_due]
+        query += " WHERE userprofile_id = %s AND deck_id = %s"
+        params += [userprofile_id, deck_id]
+        cursor = connection.cursor()
+        cursor.execute(query, params)
+        transaction.commit_unless_managed()
+
+    @classmethod
+    def update_due_counters(cls, all_counters=False):
+        """Create missing counters of train pools and count again counters
+        for which next due time passed (or all counters). Return the number
+        of counted counters."""
+        now = connection.ops.value_to_db_datetime(datetime.datetime.now())
+        tables = {"due_counter": cls._meta.db_table,
+                  "train_pool": TrainPool._meta.db_table,
+                  "train_card": TrainCard._meta.db_table,
+                  "card": Card._meta.db_table}
+        cursor = connection.cursor()
+        cursor.execute(
+            "INSERT INTO %(due_counter)s "
+            "(userprofile_id, deck_id, total_cards, due_cards, next_due) "
+            "SELECT DISTINCT p.userprofile_id, p.deck_id, 0, 0, %%s "
+            "FROM %(train_pool)s p WHERE NOT EXISTS ("
+            "SELECT 1 FROM %(due_counter)s dc "
+            "WHERE dc.userprofile_id = p.userprofile_id "
+            "AND dc.deck_id = p.deck_id)" % tables,
+            [now])
+
+        # Cards without train card (created lazily) can be repeated now.
+        cards = ("(SELECT COUNT(*) FROM %(card)s c "
+                 "WHERE c.deck_id = %(due_counter)s.deck_id)" % tables)
+        train_cards_shown_later = (
+            "FROM %(train_card)s tc "
+            "WHERE tc.userprofile_id = %(due_counter)s.userprofile_id "
+            "AND tc.deck_id = %(due_counter)s.deck_id "
+            "AND tc.time_to_show > %%s" % tables)
+        query = ("UPDATE %s SET total_cards = %s, "
+                 "due_cards = %s - (SELECT COUNT(*) %s), "
+                 "next_due = (SELECT MIN(tc.time_to_show) %s)" %
+                 (cls._meta.db_table, cards, cards,
+                  train_cards_shown_later, train_cards_shown_later))
+        params = [now, now]
+        if not all_counters:
+            query += " WHERE next_due <= %s"
+            params.append(now)
+        cursor.execute(query, params)
+        transaction.commit_unless_managed()
+        return cursor.rowcount
 
 
 class TrainSession(models.Model):
@@ -185,10 +634,8 @@ class TrainSession(models.Model):
     deck = models.ForeignKey(Deck)
     userprofile = models.ForeignKey(UserProfile)
 
-    # Training cards used in given session.
-    train_cards = models.CommaSeparatedIntegerField(max_length=200)
-
-    # Index which says which card is now used.
+    # Index which says which card is now used. It's position of
+    # train session card.
     current_card_index = models.IntegerField(default=0)
 
     MAX_NUM_OF_CARDS_IN_SESSION = 10
@@ -211,46 +658,197 @@ class TrainSession(models.Model):
 
     @classmethod
     def create_train_session(cls, userprofile, deck, train_pool, all_cards):
-        # Retrieve cards from training pool.
-        train_cards_objects = train_pool.train_cards.filter(
-            time_to_show__lte=datetime.datetime.now())
+        # Specify what cards from training pool will be used in this session.
+        limit = None if all_cards else cls.MAX_NUM_OF_CARDS_IN_SESSION
+        cards_ids = train_pool.choose_cards_to_repeat_now(
+            limit, settings.TRAIN_SESSION_ORDER)
 
         # If there are no cards in train pool then it doesn't make sense to
         # create new session.
-        if not len(train_cards_objects):
+        if not cards_ids:
             return None
 
-        # Specify what cards from training pool will be used in this session.
-        train_cards_ids = [str(train_cards_object.id)
-                           for train_cards_object in train_cards_objects]
-        random.shuffle(train_cards_ids)
-        if not all_cards:
-            train_cards_ids = (
-                train_cards_ids[0:cls.MAX_NUM_OF_CARDS_IN_SESSION])
-
         train_session = TrainSession(userprofile=userprofile, deck=deck)
-        train_session.save()
-
-        # Training cards are represented in session as comma separated list
-        # of training cards ids.
-        train_session.train_cards = ",".join(train_cards_ids)
 
         # Set that first training card will be shown.
         train_session.current_card_index = 0
         train_session.save()
+
+        # Training cards are kept in session in order in which they
+        # are shown. Train card for given card may not exist yet if train
+        # cards are created lazily.
+        TrainSessionCard.objects.bulk_create([
+            TrainSessionCard(train_session=train_session,
+                             position=position,
+                             card_id=card_id,
+                             train_card_id=train_card_id)
+            for position, (card_id, train_card_id) in enumerate(cards_ids)])
         return train_session
 
     def get_train_card(self):
-        # Train cards are kept in session as comma separated ids so here
-        # we unpack them.
-        train_cards_objects = self.train_cards.split(",")
-
-        # All cards were used so no card will be returned in this case.
-        if self.current_card_index >= len(train_cards_objects):
+        """Return train card (together with its card) which is now shown.
+        Return None if all cards were used."""
+        # Cards deleted during session are skipped.
+        train_session_cards = self.trainsessioncard_set.filter(
+            position__gte=self.current_card_index).select_related(
+            "card", "train_card").order_by("position")[:1]
+        if not train_session_cards:
             return None
-        id_of_train_card = int(train_cards_objects[self.current_card_index])
-        return TrainCard.objects.get(id=id_of_train_card)
+        train_session_card = train_session_cards[0]
+        train_session_card.train_session = self
+        self.current_card_index = train_session_card.position
+        return train_session_card.get_train_card()
 
     def increase_train_card_index(self):
         """Make that next card will be returned from given session."""
         self.current_card_index += 1
+
+    def next_train_session_cards(self, position, limit):
+        """Return at most limit cards of session (with their cards) which
+        are shown from given position."""
+        position = max(position, self.current_card_index)
+        return self.trainsessioncard_set.filter(
+            position__gte=position).select_related("card").order_by(
+            "position")[:limit]
+
+    def answer_many(self, answers):
+        """Save answers given for many cards of session at once. Answers
+        are list of tuples (card id, q, time of answer). Answers for cards
+        which are not in session or were already answered are ignored.
+        Changed columns of train cards are updated and new train cards are
+        inserted together in transaction of caller (view). Return True if
+        all cards of session were answered."""
+        cards_ids = [card_id for card_id, q, answered_at in answers]
+        train_session_cards = dict(
+            (train_session_card.card_id, train_session_card)
+            for train_session_card in self.trainsessioncard_set.filter(
+                card__in=cards_ids,
+                position__gte=self.current_card_index).select_related(
+                "card", "train_card"))
+        train_cards_answers = []
+        last_position = None
+        for card_id, q, answered_at in answers:
+            # Removed so the card is answered only once.
+            train_session_card = train_session_cards.pop(card_id, None)
+            if train_session_card is None:
+                continue
+            train_session_card.train_session = self
+            train_cards_answers.append((train_session_card.get_train_card(),
+                                        q, answered_at))
+            last_position = max(last_position, train_session_card.position)
+        self.save_answers(train_cards_answers)
+        if last_position is not None:
+            self.current_card_index = last_position + 1
+            self.save(update_fields=["current_card_index"])
+        return self.is_finished()
+
+    def save_answers(self, answers):
+        """Save answers - list of tuples (train card, q, time of answer or
+        None if answer is given now). Changed columns of train cards are
+        updated, new train cards and reviews are inserted together and due
+        counter of deck is updated."""
+        now = datetime.datetime.now()
+        new_train_cards = []
+        reviews = []
+        times_to_show = []
+        for train_card, q, answered_at in answers:
+            old_time_to_show = train_card.time_to_show
+            reviews.append(train_card.review(q, answered_at or now))
+            times_to_show.append((old_time_to_show, train_card.time_to_show))
+            if train_card.id is None:
+                new_train_cards.append(train_card)
+            else:
+                train_card.save_schedule()
+        TrainCard.objects.bulk_create(new_train_cards)
+        Review.objects.bulk_create(reviews)
+        DueCounter.cards_answered(self.userprofile_id, self.deck_id,
+                                  times_to_show, now)
+
+    def is_finished(self):
+        return not self.trainsessioncard_set.filter(
+            position__gte=self.current_card_index).exists()
+
+
+class TrainSessionCard(models.Model):
+    """Card which is trained in given train session."""
+    train_session = models.ForeignKey(TrainSession)
+
+    # Order in which cards are shown in session.
+    position = models.IntegerField()
+    card = models.ForeignKey(Card)
+
+    # Train card of card. It's empty if card was never answered and
+    # train cards are created lazily.
+    train_card = models.ForeignKey(TrainCard, null=True)
+
+    class Meta:
+        unique_together = ("train_session", "position")
+
+    def get_train_card(self):
+        train_card = self.train_card
+        if train_card is None:
+            try:
+                train_card = TrainCard.objects.get(
+                    userprofile_id=self.train_session.userprofile_id,
+                    card_id=self.card_id)
+            except TrainCard.DoesNotExist:
+                # Card is answered first time so its train card will be
+                # saved after answer.
+                train_card = TrainCard(
+                    userprofile_id=self.train_session.userprofile_id,
+                    deck_id=self.card.deck_id)
+        train_card.card = self.card
+        return train_card
+
+
+class Job(models.Model):
+    """Job is heavy work which is done in background by run_jobs command
+    instead of in the request. Jobs are kept in database so no other
+    services are needed to run them."""
+    ADD_CARD_TO_TRAIN_POOLS = "add_card_to_train_pools"
+
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    kind = models.CharField(max_length=64)
+
+    # Arguments of job as JSON object.
+    payload = models.TextField()
+
+    # Deck which is changed by the job so its progress can be shown
+    # on deck page.
+    deck = models.ForeignKey(Deck, null=True)
+
+    status = models.CharField(max_length=16, default=PENDING)
+    progress = models.IntegerField(default=0)
+    total = models.IntegerField(default=0)
+    attempts = models.IntegerField(default=0)
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(default=datetime.datetime.now)
+
+    # Job is not started before this time. It's used to delay retries.
+    run_after = models.DateTimeField(default=datetime.datetime.now)
+
+    # When running job was claimed by worker (or last finished its batch).
+    # Job of worker which was killed is claimed again when it's too old.
+    claimed_at = models.DateTimeField(null=True)
+
+    class Meta:
+        index_together = [["status", "run_after"]]
+
+    @classmethod
+    def enqueue(cls, kind, deck=None, **payload):
+        job = Job(kind=kind, deck=deck, payload=json.dumps(payload))
+        job.save()
+        return job
+
+    def get_payload(self):
+        return json.loads(self.payload)
+
+    def set_payload(self, payload):
+        self.payload = json.dumps(payload)
+
+
+connection_created.connect(configure_sqlite)
@@ -0,0 +1,311 @@
+from collections import Counter, OrderedDict
+from django.conf import settings
+from markdown import Markdown
+from markdown.extensions.codehilite import (CodeHilite, CodeHiliteExtension,
+                                            HiliteTreeprocessor)
+from markdown.extensions.fenced_code import (FENCED_BLOCK_RE,
+                                             FencedBlockPreprocessor,
+                                             FencedCodeExtension)
+from pygments import highlight
+from pygments.formatters import HtmlFormatter
+from pygments.lexers import get_lexer_by_name, guess_lexer, TextLexer
+import hashlib
+import markdown
+import pygments
+import threading
+import time
+
+MARKDOWN_EXTENSIONS = ["tables", "fenced_code", "codehilite"]
+MARKDOWN_OUTPUT_FORMAT = "html5"
+
+# Version of rendering code of this module. It must be increased whenever
+# CachedCodeHilite, CachedFencedBlockPreprocessor or
+# CachedHiliteTreeprocessor change HTML which they produce.
+RENDER_CODE_VERSION = 1
+
+# Everything which changes rendered HTML. It's a part of the cache key so
+# cached HTML isn't used after configuration, library or code was changed.
+RENDER_CONFIG = "%r %s markdown-%s pygments-%s code-%s" % (
+    MARKDOWN_EXTENSIONS, MARKDOWN_OUTPUT_FORMAT, markdown.version,
+    pygments.__version__, RENDER_CODE_VERSION)
+RENDER_VERSION = hashlib.sha1(RENDER_CONFIG).hexdigest()
+
+
+class RenderCache(object):
+    """Rendered HTML kept in memory. The least recently used items are
+    removed when cache is full."""
+
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            html = self.items.pop(key, None)
+            if html is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.items[key] = html
+            return html
+
+    def set(self, key, html):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = html
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+class HighlightStats(object):
+    """Number of code blocks highlighted by each lexer."""
+
+    def __init__(self):
+        self.lexers = Counter()
+        self.guesses = 0
+        self.lock = threading.Lock()
+
+    def add(self, lexer_name, guessed):
+        with self.lock:
+            self.lexers[lexer_name] += 1
+            self.guesses += guessed
+
+    def clear(self):
+        with self.lock:
+            self.lexers.clear()
+            self.guesses = 0
+
+
+highlight_cache = RenderCache(settings.HIGHLIGHT_CACHE_SIZE)
+highlight_stats = HighlightStats()
+# Lexers found by name (None if there is no lexer with given name).
+lexers = {}
+
+
+def get_lexer(name):
+    if name not in lexers:
+        try:
+            lexers[name] = get_lexer_by_name(name)
+        except ValueError:
+            lexers[name] = None
+    return lexers[name]
+
+
+class CachedCodeHilite(CodeHilite):
+    """Code block highlighted by Pygments. HTML of the same code highlighted
+    by the same lexer is taken from cache. Lexer is guessed only if there is
+    no lexer for the language given in code block and its name is kept in
+    lexer_name."""
+
+    lexer_name = None
+
+    def hilite(self):
+        self.src = self.src.strip("\n")
+        if self.lang is None:
+            self._getLang()
+        lexer = get_lexer(self.lang) if self.lang else None
+        key = (lexer.name if lexer else None, self.guess_lang, self.src,
+               self.linenums, self.css_class, self.style, self.noclasses)
+        cached = highlight_cache.get(key)
+        if cached is not None:
+            self.lexer_name, html = cached
+            return html
+        guessed = lexer is None and self.guess_lang
+        if guessed:
+            try:
+                lexer = guess_lexer(self.src)
+            except ValueError:
+                lexer = None
+        if lexer is None:
+            lexer = TextLexer()
+        formatter = HtmlFormatter(linenos=self.linenums,
+                                  cssclass=self.css_class,
+                                  style=self.style,
+                                  noclasses=self.noclasses)
+        html = highlight(self.src, lexer, formatter)
+        self.lexer_name = lexer.name
+        highlight_cache.set(key, (self.lexer_name, html))
+        highlight_stats.add(self.lexer_name, guessed)
+        return html
+
+
+class CachedHiliteTreeprocessor(HiliteTreeprocessor):
+    """Indented code blocks highlighted with cache."""
+
+    def run(self, root):
+        for block in root.getiterator("pre"):
+            children = block.getchildren()
+            if len(children) == 1 and children[0].tag == "code":
+                code = CachedCodeHilite(
+                    children[0].text,
+                    linenums=self.config["linenums"],
+                    guess_lang=self.config["guess_lang"],
+                    css_class=self.config["css_class"],
+                    style=self.config["pygments_style"],
+                    noclasses=self.config["noclasses"],
+                    tab_length=self.markdown.tab_length)
+                placeholder = self.markdown.htmlStash.store(code.hilite(),
+                                                            safe=True)
+                block.clear()
+                block.tag = "p"
+                block.text = placeholder
+
+
+class CachedCodeHiliteExtension(CodeHiliteExtension):
+    def extendMarkdown(self, md, md_globals):
+        hiliter = CachedHiliteTreeprocessor(md)
+        hiliter.config = self.getConfigs()
+        md.treeprocessors.add("hilite", hiliter, "<inline")
+        md.registerExtension(self)
+
+
+class CachedFencedBlockPreprocessor(FencedBlockPreprocessor):
+    """Fenced code blocks highlighted with cache."""
+
+    def run(self, lines):
+        if not self.checked_for_codehilite:
+            for extension in self.markdown.registeredExtensions:
+                if isinstance(extension, CodeHiliteExtension):
+                    self.codehilite_conf = extension.config
+                    break
+            self.checked_for_codehilite = True
+        if not self.codehilite_conf:
+            return super(CachedFencedBlockPreprocessor, self).run(lines)
+
+        text = "\n".join(lines)
+        while True:
+            m = FENCED_BLOCK_RE.search(text)
+            if not m:
+                break
+            conf = self.codehilite_conf
+            code = CachedCodeHilite(m.group("code"),
+                                    linenums=conf["linenums"][0],
+                                    guess_lang=conf["guess_lang"][0],
+                                    css_class=conf["css_class"][0],
+                                    style=conf["pygments_style"][0],
+                                    lang=(m.group("lang") or None),
+                                    noclasses=conf["noclasses"][0])
+            placeholder = self.markdown.htmlStash.store(code.hilite(),
+                                                        safe=True)
+            text = "%s\n%s\n%s" % (text[:m.start()], placeholder,
+                                   text[m.end():])
+        return text.split("\n")
+
+
+class CachedFencedCodeExtension(FencedCodeExtension):
+    def extendMarkdown(self, md, md_globals):
+        md.registerExtension(self)
+        md.preprocessors.add("fenced_code_block",
+                             CachedFencedBlockPreprocessor(md),
+                             ">normalize_whitespace")
+
+
+def create_markdown():
+    # The same extensions as MARKDOWN_EXTENSIONS with highlighting which
+    # uses cache, rendered HTML doesn't change.
+    return Markdown(extensions=["tables", CachedFencedCodeExtension(),
+                                CachedCodeHiliteExtension([])],
+                    output_format=MARKDOWN_OUTPUT_FORMAT)
+
+
+class RendererPool(object):
+    """Markdown instances which can be used by many threads. Instance is
+    taken from pool for one conversion so it's never used by two threads
+    at once. Markdown keeps state of conversion (e.g. stashed HTML) which
+    would get into next conversions and make them slower so instance is
+    reset before it's given back. New instance is created when all of them
+    are used."""
+
+    def __init__(self, create_renderer=create_markdown):
+        self.create_renderer = create_renderer
+        self.free_renderers = []
+        self.lock = threading.Lock()
+        self.renderers = 0
+        self.conversions = 0
+        self.conversion_time = 0.0
+
+    def convert(self, text):
+        with self.lock:
+            renderer = (self.free_renderers.pop()
+                        if self.free_renderers else None)
+        if renderer is None:
+            renderer = self.create_renderer()
+            with self.lock:
+                self.renderers += 1
+        start = time.time()
+        try:
+            return renderer.convert(text)
+        finally:
+            renderer.reset()
+            with self.lock:
+                self.conversions += 1
+                self.conversion_time += time.time() - start
+                self.free_renderers.append(renderer)
+
+    def stats(self):
+        """Return counters: number of created renderers, number of
+        conversions and time spent on conversions (in seconds)."""
+        with self.lock:
+            return {"renderers": self.renderers,
+                    "conversions": self.conversions,
+                    "conversion_time": self.conversion_time}
+
+
+renderer_pool = RendererPool()
+
+
+render_cache = RenderCache(settings.MARKDOWN_CACHE_SIZE)
+
+
+def render_key(text):
+    """Hash of text and render configuration."""
+    return hashlib.sha1(("%s\n%s" % (RENDER_CONFIG, text)).encode(
+        "utf-8")).hexdigest()
+
+
+def render_markdown(text):
+    """Convert Markdown text to HTML."""
+    return render_markdown_many([text])[0]
+
+
+def render_markdown_many(texts, persistent=None):
+    """Convert Markdown texts to HTML. Text which was converted before is
+    taken from cache in memory or, if MARKDOWN_PERSISTENT_CACHE setting is
+    turned on, from database (many texts with one query). Database isn't
+    used if persistent is False."""
+    if persistent is None:
+        persistent = settings.MARKDOWN_PERSISTENT_CACHE
+    if persistent:
+        # Imported here because models use rendering.
+        from models import RenderedMarkdown
+    keys = [render_key(text) for text in texts]
+    htmls = dict((key, render_cache.get(key)) for key in set(keys))
+    not_found = [key for key, html in htmls.iteritems() if html is None]
+    if not_found and persistent:
+        for key, html in RenderedMarkdown.get_many(not_found).iteritems():
+            htmls[key] = html
+            render_cache.set(key, html)
+
+    rendered = {}
+    for key, text in zip(keys, texts):
+        if htmls[key] is None:
+            htmls[key] = renderer_pool.convert(text)
+            render_cache.set(key, htmls[key])
+            rendered[key] = htmls[key]
+    if rendered and persistent:
+        RenderedMarkdown.store_many(rendered)
+    return [htmls[key] for key in keys]
+
+
+def render_markdown_in_worker(texts):
+    """Convert texts in worker process which doesn't use database."""
+    return render_markdown_many(texts, persistent=False)
@@ -0,0 +1,80 @@
+"""SuperMemo 2 algorithm computed for many train cards at once.
+
+The functions work on NumPy arrays and give exactly the same results as
+TrainCard.calculate_interval applied card by card (interval is kept in
+database as integer so it's truncated between answers)."""
+import numpy
+
+
+def calculate_intervals(ef, n, i, q, now):
+    """Calculate new EF, number of good answers and interval for arrays
+    of train card states and answers. Now is array of times of answers
+    (datetime64) or a single time. Return tuple of arrays (ef, n, i,
+    time_to_show) where time to show is NaT for cards which time to show
+    doesn't change."""
+    ef = numpy.asarray(ef, dtype=numpy.float64)
+    n = numpy.asarray(n, dtype=numpy.int64)
+    i = numpy.asarray(i, dtype=numpy.float64)
+    q = numpy.asarray(q, dtype=numpy.int64)
+    now = numpy.asarray(now, dtype="datetime64[us]")
+
+    # Calculate new EF only for good answers.
+    good = q >= 3
+    new_ef = ef + (0.1 - (5 - q) * (0.08 + (5 - q) * 0.02))
+    new_ef = numpy.where(new_ef < 1.3, 1.3, new_ef)
+    new_ef = numpy.where(good, new_ef, ef)
+
+    # Wrong answer resets counter of answers.
+    new_n = numpy.where(good, n + 1, 0)
+
+    new_i = numpy.where(new_n == 1, 1.0,
+                        numpy.where(new_n == 2, 6.0, i * new_ef))
+    new_i = numpy.where(good, new_i, i)
+
+    # Set new time to show only for good answers.
+    seconds = numpy.trunc(24 * 60 * new_i).astype(numpy.int64)
+    time_to_show = now + seconds * numpy.timedelta64(1000000, "us")
+    time_to_show = numpy.where(q >= 4, time_to_show,
+                               numpy.datetime64("NaT", "us"))
+    return new_ef, new_n, new_i, time_to_show
+
+
+def replay(ef, n, i, time_to_show, q, now):
+    """Apply answers to train cards one after another. Arguments are
+    arrays of initial states of train cards and two dimensional arrays of
+    answers and their times (one row for each answer, one column for
+    each train card). Answers which are negative are skipped (so cards
+    can have different number of answers). Return tuple of arrays
+    (ef, n, i, time_to_show)."""
+    ef = numpy.array(ef, dtype=numpy.float64)
+    n = numpy.array(n, dtype=numpy.int64)
+    i = numpy.array(i, dtype=numpy.int64)
+    time_to_show = numpy.array(time_to_show, dtype="datetime64[us]")
+    for answers, times in zip(numpy.asarray(q), numpy.asarray(now)):
+        answered = answers >= 0
+        new_ef, new_n, new_i, new_time_to_show = calculate_intervals(
+            ef, n, i, numpy.where(answered, answers, 0), times)
+        ef = numpy.where(answered, new_ef, ef)
+        n = numpy.where(answered, new_n, n)
+        # Interval is saved in database as integer.
+        i = numpy.where(answered, numpy.trunc(new_i).astype(numpy.int64), i)
+        changed = answered & ~numpy.isnat(new_time_to_show)
+        time_to_show = numpy.where(changed, new_time_to_show, time_to_show)
+    return ef, n, i, time_to_show
+
+
+def reschedule(n, i, now):
+    """Count time to show of train cards from given time as if they were
+    answered then: cards without good answers are shown at that time,
+    others after their interval."""
+    n = numpy.asarray(n, dtype=numpy.int64)
+    i = numpy.asarray(i, dtype=numpy.float64)
+    now = numpy.asarray(now, dtype="datetime64[us]")
+    seconds = numpy.trunc(24 * 60 * i).astype(numpy.int64)
+    seconds = numpy.where(n > 0, seconds, 0)
+    return now + seconds * numpy.timedelta64(1000000, "us")
+
+
+def to_datetimes(times):
+    """Convert array of datetime64 to list of datetime objects."""
+    return numpy.asarray(times, dtype="datetime64[us]").tolist()
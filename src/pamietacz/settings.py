@@ -1,4 +1,5 @@
 import os
+import sqlite3
 
 HERE = os.path.dirname(__file__)
 SECRET_KEY = "very secret"
@@ -28,4 +29,72 @@ LOGIN_URL = "/login/"
 
 AUTH_USER_MODEL = "pamietacz.UserProfile"
 
+# If True then train card for given card and user is saved only when user
+# answers the card first time. Otherwise train cards for all cards of deck
+# are saved when user starts to train the deck.
+LAZY_TRAIN_CARDS = False
+
+# If card is added to deck with more train pools than this limit then
+# train cards for the new card are created in background by run_jobs
+# command instead of in the request.
+TRAIN_POOLS_IN_REQUEST_LIMIT = 500
+
+# Order in which cards to repeat are chosen for new train session:
+# "random" (from the longest waiting cards, 10 times more than size of
+# session), "most_overdue" (the longest waiting cards first) or "lowest_ef"
+# (the most difficult cards first, all due cards are sorted).
+TRAIN_SESSION_ORDER = "random"
+
+# Number of texts rendered from Markdown to HTML kept in memory of process.
+MARKDOWN_CACHE_SIZE = 10000
+
+# If turned on then rendered HTML is kept also in database so it's shared
+# by processes and kept after restart.
+MARKDOWN_PERSISTENT_CACHE = False
+
+# Number of code blocks highlighted by Pygments kept in memory of process.
+HIGHLIGHT_CACHE_SIZE = 1000
+
+# Directory of database backups.
+BACKUP_DIRECTORY = "backups"
+
+# Seconds after first change in which all changes are saved in one backup.
+BACKUP_WINDOW = 60
+
+# Number of hours, days and weeks from which the newest backup is kept.
+BACKUP_RETENTION = {"hourly": 24, "daily": 7, "weekly": 4}
+
+# Pragmas set on every new connection to SQLite database.
+SQLITE_PRAGMAS = {
+    # In WAL journal mode readers aren't blocked by writers. Backups of
+    # database in WAL mode need VACUUM INTO (SQLite 3.27.0 or newer).
+    "journal_mode": ("wal" if sqlite3.sqlite_version_info >= (3, 27, 0)
+                     else "delete"),
+    # In WAL mode database can't be damaged when it isn't synchronized after
+    # every transaction, only the last transactions can be lost when system
+    # crashes.
+    "synchronous": "normal",
+    # Negative size is in KiB (about 20 MB).
+    "cache_size": -20000,
+    # Bytes of database read through memory map instead of system calls.
+    "mmap_size": 256 * 1024 * 1024,
+    "temp_store": "memory",
+    # Milliseconds for which connection waits for lock of other connection.
+    "busy_timeout": 5000,
+    # Number of pages in WAL after which it's checkpointed by application.
+    # It's set to 0 when WAL_ARCHIVE_DIRECTORY is set because WAL is
+    # checkpointed by archive_wal command then.
+    "wal_autocheckpoint": 1000,
+}
+
+# Number of times for which write transaction of training views is run
+# again when database is locked and seconds before the first retry (it's
+# doubled for every next retry).
+SQLITE_WRITE_RETRIES = 5
+SQLITE_WRITE_RETRY_DELAY = 0.05
+
+# Directory of WAL archive made by archive_wal command (e.g. "wal_archive")
+# or None if WAL isn't archived.
+WAL_ARCHIVE_DIRECTORY = None
+
 MEDIA_URL = '/uploaded/'
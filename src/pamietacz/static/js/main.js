@@ -19,4 +19,193 @@ $(window).keypress(function(event) {
 
 $('input[id^="option_"]').click(function() {
     $(this).css("color", "red");
-});
\ No newline at end of file
+});
+
+// Train session is run from cards prefetched from the server so the next
+// card is shown immediately. Answers are sent to the server in background
+// in batches: when enough answers are collected, when no answer was given
+// for a while or when the session ends. Answers which are not sent yet
+// when the page is closed are sent by beacon. Until the first cards are
+// loaded the answer form works as usual.
+var trainSession = $("#train_session");
+if (trainSession.length) {
+    var cardsUrl = trainSession.data("cards-url");
+    var answersUrl = trainSession.data("answers-url");
+    var csrfToken = trainSession.find("input[name=csrfmiddlewaretoken]").val();
+    var initialized = false;
+    var prefetchedCards = [];
+    var currentCard = null;
+    var nextPosition = null;
+    var noMoreCards = false;
+    var loadingCards = false;
+    var answersToSend = [];
+    var sendingAnswer = false;
+    var sendAnswersTimer = null;
+    // Shelves of user are shown when session is left before the first
+    // cards were loaded.
+    var finishUrl = "/";
+    // Answers are sent when so many of them are collected.
+    var ANSWERS_IN_BATCH = 10;
+    // Server accepts at most so many answers at once.
+    var MAX_ANSWERS_IN_BATCH = 100;
+    // Answers are sent when no answer was given for so many milliseconds.
+    var SEND_ANSWERS_AFTER = 5000;
+
+    var sessionEnded = function() {
+        return currentCard === null && noMoreCards;
+    };
+
+    // Session which was finished or removed on the server (e.g. in other
+    // window) can't be continued.
+    var leaveSession = function() {
+        noMoreCards = true;
+        currentCard = null;
+        prefetchedCards = [];
+        answersToSend = [];
+        window.location = finishUrl;
+    };
+
+    // Only network and server errors are worth retrying.
+    var canRetry = function(xhr) {
+        return xhr.status === 0 || xhr.status >= 500;
+    };
+
+    var finishIfDone = function() {
+        if (!sessionEnded()) {
+            return;
+        }
+        if (answersToSend.length) {
+            sendAnswers();
+        } else if (!sendingAnswer) {
+            window.location = finishUrl;
+        }
+    };
+
+    var showCard = function(card) {
+        currentCard = card;
+        $("#question").html(card.question);
+        $("#answer_text").html(card.answer);
+        $("#answer").hide();
+        $("#show_answer").removeAttr("disabled");
+        $('input[id^="option_"]').css("color", "");
+    };
+
+    var showNextCard = function() {
+        if (prefetchedCards.length) {
+            showCard(prefetchedCards.shift());
+        } else {
+            currentCard = null;
+        }
+        if (prefetchedCards.length < 2) {
+            loadCards();
+        }
+        finishIfDone();
+    };
+
+    var loadCards = function() {
+        if (loadingCards || noMoreCards) {
+            return;
+        }
+        loadingCards = true;
+        var parameters = nextPosition === null ? {} : {from: nextPosition};
+        $.getJSON(cardsUrl, parameters).done(function(data) {
+            loadingCards = false;
+            finishUrl = data.finish_url;
+            if (data.cards.length === 0) {
+                noMoreCards = true;
+            } else {
+                nextPosition = data.cards[data.cards.length - 1].position + 1;
+                prefetchedCards = prefetchedCards.concat(data.cards);
+            }
+            if (!initialized) {
+                // The first card is already shown by the server.
+                initialized = true;
+                currentCard = prefetchedCards.shift() || null;
+                finishIfDone();
+            } else if (currentCard === null) {
+                showNextCard();
+            }
+        }).fail(function(xhr) {
+            loadingCards = false;
+            if (canRetry(xhr)) {
+                setTimeout(loadCards, 1000);
+            } else {
+                leaveSession();
+            }
+        });
+    };
+
+    var sendAnswers = function() {
+        clearTimeout(sendAnswersTimer);
+        sendAnswersTimer = null;
+        if (sendingAnswer || answersToSend.length === 0) {
+            return;
+        }
+        sendingAnswer = true;
+        var batch = answersToSend.slice(0, MAX_ANSWERS_IN_BATCH);
+        $.ajax({
+            url: answersUrl,
+            type: "POST",
+            data: JSON.stringify({answers: batch}),
+            contentType: "application/json",
+            headers: {"X-CSRFToken": csrfToken}
+        }).done(function(data) {
+            answersToSend.splice(0, batch.length);
+            sendingAnswer = false;
+            if (data.finished) {
+                leaveSession();
+                return;
+            }
+            scheduleAnswers();
+            finishIfDone();
+        }).fail(function(xhr) {
+            sendingAnswer = false;
+            if (canRetry(xhr)) {
+                setTimeout(sendAnswers, 1000);
+            } else {
+                leaveSession();
+            }
+        });
+    };
+
+    var scheduleAnswers = function() {
+        if (answersToSend.length >= ANSWERS_IN_BATCH || sessionEnded()) {
+            sendAnswers();
+        } else if (answersToSend.length && sendAnswersTimer === null) {
+            sendAnswersTimer = setTimeout(sendAnswers, SEND_ANSWERS_AFTER);
+        }
+    };
+
+    // Beacon can't set CSRF header so answers are sent as form fields.
+    var sendAnswersByBeacon = function() {
+        if (!navigator.sendBeacon) {
+            return;
+        }
+        while (answersToSend.length) {
+            var batch = answersToSend.splice(0, MAX_ANSWERS_IN_BATCH);
+            var form = new FormData();
+            form.append("csrfmiddlewaretoken", csrfToken);
+            form.append("answers", JSON.stringify({answers: batch}));
+            navigator.sendBeacon(answersUrl, form);
+        }
+    };
+
+    $(window).on("pagehide", sendAnswersByBeacon);
+
+    $('input[id^="option_"]').click(function(event) {
+        if (!initialized) {
+            return;
+        }
+        event.preventDefault();
+        if (currentCard === null) {
+            return;
+        }
+        answersToSend.push({card: currentCard.card,
+                            answer: $(this).val(),
+                            time: new Date().getTime()});
+        showNextCard();
+        scheduleAnswers();
+    });
+
+    loadCards();
+}
@@ -0,0 +1,331 @@
+from django.core.management import call_command
+from django.test import TestCase
+from django.test.utils import override_settings
+from pamietacz import backups
+from StringIO import StringIO
+import datetime
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import zlib
+
+
+class SnapshotTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.database_name = os.path.join(self.directory, "database")
+        self.connection = sqlite3.connect(self.database_name)
+        self.connection.execute("CREATE TABLE card (question text)")
+        self.connection.execute("INSERT INTO card VALUES ('committed')")
+        self.connection.commit()
+
+    def tearDown(self):
+        self.connection.close()
+        shutil.rmtree(self.directory)
+
+    def assertSnapshot(self, questions):
+        snapshot_file_name = os.path.join(self.directory, "snapshot")
+        backups.snapshot_database(self.database_name, snapshot_file_name)
+        snapshot = sqlite3.connect(snapshot_file_name)
+        try:
+            self.assertEqual(snapshot.execute(
+                "SELECT question FROM card").fetchall(), questions)
+        finally:
+            snapshot.close()
+            os.remove(snapshot_file_name)
+
+    def test_snapshot_has_committed_data(self):
+        self.assertSnapshot([(u"committed",)])
+
+    def test_snapshot_by_copy_of_file(self):
+        old_version = backups.VACUUM_INTO_VERSION
+        backups.VACUUM_INTO_VERSION = (99, 0, 0)
+        try:
+            self.assertSnapshot([(u"committed",)])
+            # Committed pages can be only in WAL.
+            self.connection.execute("PRAGMA journal_mode = wal")
+            self.assertRaises(ValueError, backups.snapshot_database,
+                              self.database_name,
+                              os.path.join(self.directory, "snapshot"))
+        finally:
+            backups.VACUUM_INTO_VERSION = old_version
+
+
+class SnapshotStoreTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.database_name = os.path.join(self.directory, "database")
+        self.connection = sqlite3.connect(self.database_name)
+        self.connection.execute("CREATE TABLE card (question text)")
+        self.add_cards(0, 100)
+        self.store = backups.SnapshotStore(
+            os.path.join(self.directory, "backups"), chunk_size=4096)
+
+    def tearDown(self):
+        self.connection.close()
+        shutil.rmtree(self.directory)
+
+    def add_cards(self, first, last):
+        self.connection.executemany(
+            "INSERT INTO card VALUES (?)",
+            [("Question %d %s" % (i, "x" * 100),)
+             for i in range(first, last)])
+        self.connection.commit()
+
+    def count_chunks(self):
+        return sum(len(files) for _, _, files in
+                   os.walk(self.store.chunks_directory))
+
+    def test_only_changed_chunks_are_added(self):
+        first = self.store.add(self.database_name, datetime.datetime(
+            2013, 10, 17, 10))
+        chunks = self.count_chunks()
+        self.assertTrue(chunks > 1)
+        self.assertEqual(self.store.add(self.database_name), None)
+
+        self.add_cards(100, 110)
+        second = self.store.add(self.database_name, datetime.datetime(
+            2013, 10, 17, 11))
+        self.assertEqual(self.store.snapshots(), [first, second])
+        self.assertTrue(self.count_chunks() < 2 * chunks)
+
+        restored = os.path.join(self.directory, "restored")
+        self.store.restore(first, restored)
+        connection = sqlite3.connect(restored)
+        try:
+            self.assertEqual(connection.execute(
+                "SELECT COUNT(*) FROM card").fetchone(), (100,))
+        finally:
+            connection.close()
+
+    def test_chunks_are_shared_when_pages_are_moved(self):
+        self.connection.execute("CREATE TABLE deck (name text)")
+        self.connection.executemany(
+            "INSERT INTO deck VALUES (?)",
+            [("Deck %d %s" % (i, "x" * 100),) for i in range(2000)])
+        self.add_cards(100, 3000)
+        store = backups.SnapshotStore(self.store.directory, chunk_size=16384)
+        first = store.add(self.database_name, datetime.datetime(
+            2013, 10, 17, 10))
+        # Pages of deck table are moved by VACUUM behind new pages.
+        self.add_cards(3000, 3050)
+        second = store.add(self.database_name, datetime.datetime(
+            2013, 10, 17, 11))
+        first_chunks = store.get_manifest(first)["chunks"]
+        second_chunks = store.get_manifest(second)["chunks"]
+        shared = set(first_chunks) & set(second_chunks)
+        self.assertTrue(len(shared) > 0.8 * len(set(second_chunks)))
+
+    def test_copy_left_by_failed_snapshot_is_removed(self):
+        copy_file_name = os.path.join(self.store.directory, "snapshot.tmp")
+        os.makedirs(self.store.directory)
+        backups.write_file(copy_file_name, "left by failed snapshot")
+        self.assertTrue(self.store.add(self.database_name))
+        self.assertFalse(os.path.exists(copy_file_name))
+
+        # Copy is removed also when snapshot fails.
+        self.assertRaises(sqlite3.DatabaseError, self.store.add,
+                          os.path.join(self.directory, "missing", "db"))
+        self.assertFalse(os.path.exists(copy_file_name))
+
+    def test_damaged_snapshot_is_not_restored(self):
+        name = self.store.add(self.database_name)
+        chunk_hash = self.store.get_manifest(name)["chunks"][0]
+        backups.write_file(self.store.chunk_path(chunk_hash),
+                           zlib.compress("damaged"))
+        restored = os.path.join(self.directory, "restored")
+        self.assertRaises(ValueError, self.store.restore, name, restored)
+        self.assertFalse(os.path.exists(restored))
+
+    def test_old_snapshots_are_removed(self):
+        times = [datetime.datetime(2013, 10, day, hour, minute)
+                 for day in [15, 16, 17]
+                 for hour in [10, 11]
+                 for minute in [0, 30]]
+        for number, time in enumerate(times):
+            self.add_cards(number * 1000, number * 1000 + 10)
+            self.store.add(self.database_name, time)
+        chunks = self.count_chunks()
+        removed = self.store.remove_old({"hourly": 2, "daily": 2})
+        kept = [time.strftime(backups.SNAPSHOT_NAME_FORMAT)
+                for time in [datetime.datetime(2013, 10, 16, 11, 30),
+                             datetime.datetime(2013, 10, 17, 10, 30),
+                             datetime.datetime(2013, 10, 17, 11, 30)]]
+        self.assertEqual(self.store.snapshots(), kept)
+        self.assertEqual(len(removed), len(times) - len(kept))
+        self.assertTrue(self.count_chunks() < chunks)
+        for name in kept:
+            self.store.restore(name, os.path.join(self.directory, name))
+
+    def test_restore_command(self):
+        name = self.store.add(self.database_name)
+        self.add_cards(100, 200)
+        output = StringIO()
+        with override_settings(BACKUP_DIRECTORY=self.store.directory):
+            call_command("restore_backup", list=True, stdout=output)
+            self.assertEqual(output.getvalue().split(), [name])
+            call_command("restore_backup", output=self.database_name,
+                         stdout=output)
+        connection = sqlite3.connect(self.database_name)
+        try:
+            self.assertEqual(connection.execute(
+                "SELECT COUNT(*) FROM card").fetchone(), (100,))
+        finally:
+            connection.close()
+
+
+class WALArchiveTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.database_name = os.path.join(self.directory, "database")
+        self.connection = sqlite3.connect(self.database_name)
+        self.connection.execute("PRAGMA journal_mode = wal")
+        self.connection.execute("PRAGMA wal_autocheckpoint = 0")
+        self.connection.execute("CREATE TABLE card (question text)")
+        self.cards = 0
+        self.add_cards(10)
+        self.archive = backups.WALArchive(
+            os.path.join(self.directory, "archive"), self.database_name)
+        self.start = datetime.datetime(2013, 10, 17, 10)
+
+    def tearDown(self):
+        self.archive.close()
+        self.connection.close()
+        shutil.rmtree(self.directory)
+
+    def add_cards(self, number):
+        self.connection.executemany(
+            "INSERT INTO card VALUES (?)",
+            [("Question %d" % i,)
+             for i in range(self.cards, self.cards + number)])
+        self.connection.commit()
+        self.cards += number
+
+    def archive_after(self, minutes, **kwargs):
+        return self.archive.archive(
+            self.start + datetime.timedelta(minutes=minutes), **kwargs)
+
+    def assertRestored(self, minutes, cards):
+        restored = os.path.join(self.directory, "restored")
+        self.archive.restore(self.start +
+                             datetime.timedelta(minutes=minutes), restored)
+        connection = sqlite3.connect(restored)
+        try:
+            self.assertEqual(connection.execute(
+                "SELECT COUNT(*) FROM card").fetchone(), (cards,))
+            self.assertEqual(connection.execute(
+                "PRAGMA integrity_check").fetchone(), (u"ok",))
+        finally:
+            connection.close()
+
+    def test_database_is_restored_to_time(self):
+        self.assertTrue(self.archive_after(0) > 0)
+        self.assertEqual(self.archive_after(0.5), 0)
+        self.add_cards(10)
+        self.archive_after(1)
+        self.add_cards(10)
+        # WAL is checkpointed and new generation starts after next write.
+        self.archive_after(2, checkpoint_size=0)
+        self.add_cards(10)
+        self.archive_after(3)
+        self.assertEqual(len(self.archive.generations()), 2)
+
+        for minutes, cards in [(0, 10), (0.5, 10), (1, 20), (2, 30),
+                               (3, 40), (60, 40)]:
+            self.assertRestored(minutes, cards)
+        self.assertRaises(ValueError, self.archive.restore,
+                          self.start - datetime.timedelta(minutes=1),
+                          os.path.join(self.directory, "restored"))
+
+        # The first generation isn't needed to restore database to the
+        # time of the second one.
+        self.assertEqual(self.archive.remove_old(
+            self.start + datetime.timedelta(minutes=3)),
+            [self.start.strftime(backups.SNAPSHOT_NAME_FORMAT)])
+        self.assertRestored(3, 40)
+
+    def test_writers_arent_locked_while_base_is_copied(self):
+        copyfile = backups.shutil.copyfile
+        writer = sqlite3.connect(self.database_name, timeout=0)
+
+        def copy_while_writing(source, destination):
+            writer.execute("INSERT INTO card VALUES ('written')")
+            writer.commit()
+            copyfile(source, destination)
+
+        backups.shutil.copyfile = copy_while_writing
+        try:
+            self.archive_after(0)
+        finally:
+            backups.shutil.copyfile = copyfile
+            writer.close()
+        self.cards += 1
+        self.assertRestored(0, 11)
+
+    def test_restore_to_time_command(self):
+        self.archive.archive(self.start)
+        self.add_cards(10)
+        restored = os.path.join(self.directory, "restored")
+        with override_settings(
+                WAL_ARCHIVE_DIRECTORY=os.path.join(self.directory,
+                                                   "archive")):
+            call_command("restore_to_time", "2013-10-17 10:00:00",
+                         output=restored, stdout=StringIO())
+        connection = sqlite3.connect(restored)
+        try:
+            self.assertEqual(connection.execute(
+                "SELECT COUNT(*) FROM card").fetchone(), (10,))
+        finally:
+            connection.close()
+
+
+class BackupServiceTests(TestCase):
+    def setUp(self):
+        self.made = threading.Event()
+        self.backups = []
+
+    def make_backup(self):
+        self.backups.append(len(self.backups))
+        self.made.set()
+
+    def test_requests_in_window_are_coalesced(self):
+        service = backups.BackupService(0.1, self.make_backup)
+        for i in range(10):
+            service.request()
+        self.assertEqual(self.backups, [])
+        self.assertTrue(self.made.wait(5))
+        self.assertEqual(self.backups, [0])
+        self.assertEqual(service.requests, 10)
+
+        # Next request starts new window.
+        self.made.clear()
+        service.request()
+        self.assertTrue(self.made.wait(5))
+        self.assertEqual(self.backups, [0, 1])
+
+    def test_failed_backup_is_counted(self):
+        def fail():
+            raise OSError("No space left on device")
+
+        service = backups.BackupService(3600, fail)
+        service.request()
+        service.flush()
+        self.assertEqual((service.backups, service.failed_backups), (0, 1))
+
+        # Next backup is made after failed one.
+        service.make_backup = self.make_backup
+        service.request()
+        service.flush()
+        self.assertEqual((service.backups, service.failed_backups), (1, 1))
+
+    def test_flush_makes_requested_backup(self):
+        service = backups.BackupService(3600, self.make_backup)
+        service.flush()
+        self.assertEqual(self.backups, [])
+        service.request()
+        service.flush()
+        self.assertEqual(self.backups, [0])
+        self.assertEqual((service.requests, service.backups), (1, 1))
+        self.assertEqual(service.timer, None)
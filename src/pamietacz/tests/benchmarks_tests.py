@@ -0,0 +1,82 @@
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase, LiveServerTestCase
+from pamietacz import benchmarks
+from pamietacz.dump_load import dump_data_as_xml
+from pamietacz.management.commands.benchmark_views import get_users
+from pamietacz.models import (Shelf,
+                              Deck,
+                              Card,
+                              Review,
+                              DueCounter,
+                              UserProfile)
+from StringIO import StringIO
+
+
+def generate_data():
+    call_command("generate_data", shelves=2, decks=2, cards=5, users=3,
+                 started_shelves=1, answered=0.4, answers=2,
+                 stdout=StringIO())
+
+
+class GenerateDataTests(TestCase):
+    def test_data_is_generated(self):
+        generate_data()
+        self.assertEqual(Shelf.objects.count(), 2)
+        self.assertEqual(list(Deck.objects.values_list("card_count",
+                                                       flat=True)),
+                         [5] * 4)
+        self.assertEqual(Card.objects.count(), 20)
+        users = UserProfile.objects.all()
+        self.assertEqual(len(users), 3)
+        for userprofile in users:
+            self.assertTrue(userprofile.check_password("synthetic"))
+            self.assertEqual(userprofile.shelves.count(), 1)
+        # 2 cards of every deck of started shelf are answered twice.
+        self.assertEqual(Review.objects.count(), 3 * 2 * 2 * 2)
+        self.assertEqual(list(DueCounter.objects.values_list(
+            "total_cards", flat=True)), [5] * 6)
+
+        self.assertRaises(CommandError, generate_data)
+
+
+class BenchmarkTests(TestCase):
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual(benchmarks.percentile(values, 50), 50)
+        self.assertEqual(benchmarks.percentile(values, 95), 95)
+        self.assertEqual(benchmarks.percentile([3], 95), 3)
+        self.assertEqual(benchmarks.percentile([], 95), None)
+
+    def test_views_are_requested_through_client(self):
+        generate_data()
+        (username, decks), = get_users("synthetic user ", 1)
+        results = benchmarks.Results()
+        # Worker is run in this thread which sees the test database.
+        worker = benchmarks.Worker(benchmarks.ClientSession(), username,
+                                   "synthetic", decks, benchmarks.VIEWS, 2,
+                                   dump_data_as_xml(), results, 0)
+        worker.run()
+        self.assertEqual(worker.error, None)
+        report = results.report(benchmarks.VIEWS, 1.0)
+        for view in benchmarks.VIEWS:
+            self.assertEqual(report[view]["requests"], 2)
+            self.assertEqual(report[view]["errors"], 0)
+            self.assertTrue(report[view]["queries_per_request"] > 0)
+            self.assertTrue(report[view]["p95_ms"] >=
+                            report[view]["p50_ms"])
+        self.assertEqual(Card.objects.count(), 20)
+
+
+class HTTPBenchmarkTests(LiveServerTestCase):
+    def test_views_are_requested_over_http(self):
+        generate_data()
+        users = get_users("synthetic user ", 2)
+        report = benchmarks.run_benchmark(
+            lambda: benchmarks.HTTPSession(self.live_server_url), users,
+            "synthetic", benchmarks.VIEWS, 1, dump_data_as_xml())
+        self.assertEqual(report["workers"], 2)
+        self.assertEqual(report["errors"], 0)
+        self.assertEqual(report["requests"], 2 * len(benchmarks.VIEWS))
+        self.assertEqual(report["views"]["load_data"]["queries_per_request"],
+                         None)
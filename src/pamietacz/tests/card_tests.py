@@ -1,15 +1,17 @@
 from django.conf import settings
 from django.core.files.uploadedfile import SimpleUploadedFile
-from django.db import IntegrityError
+from django.core.management import call_command
+from django.db import IntegrityError, transaction
 from django.http import (HttpResponseRedirect,
                          HttpResponseNotFound,
                          HttpResponseBadRequest)
 from django.test import TestCase
-from pamietacz.models import Shelf, Deck, Card
+from pamietacz.models import Shelf, Deck, Card, DueCounter
 from test_utils import (add_shelf,
                         add_deck,
                         add_card,
-                        TestCaseWithAuthentication)
+                        TestCaseWithAuthentication,
+                        TransactionTestCaseWithAuthentication)
 from PIL import Image
 import StringIO
 import shutil
@@ -247,6 +249,81 @@ class DeleteCardTests(TestCaseWithAuthentication):
         self.assertEqual(r.status_code, HttpResponseNotFound.status_code)
 
 
+class CardCountTests(TestCaseWithAuthentication):
+    def test_card_count_of_deck_is_updated(self):
+        add_shelf(self.client, "Some nice shelf")
+        shelf = Shelf.objects.all()[0]
+        add_deck(self.client, shelf.id, "Some nice deck")
+        add_deck(self.client, shelf.id, "Other deck")
+        deck, other_deck = Deck.objects.order_by("id")
+        for i in range(3):
+            add_card(self.client, deck.id, "Question %d" % i, "Answer")
+        self.assertEqual(Deck.objects.get(id=deck.id).card_count, 3)
+
+        # Edited card is not counted again.
+        card = Card.objects.all()[0]
+        self.client.post("/card/%s/edit/" % card.id,
+                         {"question": "New question", "answer": "Answer"})
+        self.assertEqual(Deck.objects.get(id=deck.id).card_count, 3)
+
+        self.client.get("/card/%s/delete/" % card.id)
+        self.assertEqual(Deck.objects.get(id=deck.id).card_count, 2)
+        self.assertEqual(Deck.objects.get(id=other_deck.id).card_count, 0)
+
+
+class SaveCardTransactionTests(TransactionTestCaseWithAuthentication):
+    def setUp(self):
+        super(SaveCardTransactionTests, self).setUp()
+        add_shelf(self.client, "Some nice shelf")
+        add_deck(self.client, Shelf.objects.get().id, "Some nice deck")
+        self.deck = Deck.objects.get()
+
+    def test_card_is_not_added_without_its_counters(self):
+        card_added = DueCounter.__dict__["card_added"]
+
+        def fail(card):
+            raise ValueError("Counter wasn't updated")
+
+        DueCounter.card_added = staticmethod(fail)
+        try:
+            self.assertRaises(ValueError, add_card, self.client,
+                              self.deck.id, "What is it?", "This is that.")
+        finally:
+            DueCounter.card_added = card_added
+        self.assertEqual(Card.objects.count(), 0)
+        self.assertEqual(Deck.objects.get().card_count, 0)
+
+    def test_saved_card_doesnt_commit_transaction_of_caller(self):
+        with transaction.commit_manually():
+            Card(deck=self.deck, question="What is it?",
+                 answer="This is that.").save()
+            transaction.rollback()
+        self.assertEqual(Card.objects.count(), 0)
+        self.assertEqual(Deck.objects.get().card_count, 0)
+
+
+class UpdateCardCountsCommandTests(TransactionTestCaseWithAuthentication):
+    """Reading table description commits transaction in SQLite so it
+    can't be tested inside transaction."""
+
+    def test_card_counts_are_repaired(self):
+        add_shelf(self.client, "Some nice shelf")
+        shelf = Shelf.objects.all()[0]
+        add_deck(self.client, shelf.id, "Some nice deck")
+        deck = Deck.objects.get()
+        Card.objects.bulk_create([Card(deck=deck,
+                                       question="Question %d" % i,
+                                       answer="Answer",
+                                       question_after_markdown="Question",
+                                       answer_after_markdown="Answer")
+                                  for i in range(5)])
+        self.assertEqual(Deck.objects.get().card_count, 0)
+        stdout = StringIO.StringIO()
+        call_command("update_card_counts", stdout=stdout)
+        self.assertIn("Counted cards of 1 decks", stdout.getvalue())
+        self.assertEqual(Deck.objects.get().card_count, 5)
+
+
 class MarkdownCardTests(TestCaseWithAuthentication):
     def test_question_and_answer_use_markdown(self):
         """Markdown is used to make text looking nicer."""
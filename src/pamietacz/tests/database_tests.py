@@ -0,0 +1,100 @@
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DatabaseError
+from django.test import TestCase
+from django.test.utils import override_settings
+from pamietacz import backups
+from pamietacz.database import configure_sqlite, retry_write
+import os
+import shutil
+import sqlite3
+import tempfile
+
+
+class SQLiteConnection(object):
+    vendor = "sqlite"
+
+    def __init__(self, database_name):
+        self.connection = sqlite3.connect(database_name)
+
+
+class ConfigureSQLiteTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    @override_settings(SQLITE_PRAGMAS={"wal_autocheckpoint": 0,
+                                       "journal_mode": "wal",
+                                       "busy_timeout": 1234,
+                                       "cache_size": -4000})
+    def test_pragmas_are_set(self):
+        connection = SQLiteConnection(os.path.join(self.directory, "db"))
+        try:
+            configure_sqlite(None, connection)
+            for name, value in [("journal_mode", u"wal"),
+                                ("wal_autocheckpoint", 0),
+                                ("busy_timeout", 1234),
+                                ("cache_size", -4000)]:
+                self.assertEqual(connection.connection.execute(
+                    "PRAGMA %s" % name).fetchone(), (value,))
+        finally:
+            connection.connection.close()
+
+    @override_settings(SQLITE_PRAGMAS={"journal_mode": "wal",
+                                       "wal_autocheckpoint": 1000},
+                       WAL_ARCHIVE_DIRECTORY="wal_archive")
+    def test_wal_isnt_checkpointed_when_its_archived(self):
+        connection = SQLiteConnection(os.path.join(self.directory, "db"))
+        try:
+            configure_sqlite(None, connection)
+            self.assertEqual(connection.connection.execute(
+                "PRAGMA wal_autocheckpoint").fetchone(), (0,))
+        finally:
+            connection.connection.close()
+
+    @override_settings(SQLITE_PRAGMAS={"journal_mode": "wal"})
+    def test_wal_is_refused_when_it_cant_be_backed_up(self):
+        connection = SQLiteConnection(os.path.join(self.directory, "db"))
+        old_version = backups.VACUUM_INTO_VERSION
+        backups.VACUUM_INTO_VERSION = (99, 0, 0)
+        try:
+            self.assertRaises(ImproperlyConfigured, configure_sqlite, None,
+                              connection)
+            self.assertEqual(connection.connection.execute(
+                "PRAGMA journal_mode").fetchone(), (u"delete",))
+        finally:
+            backups.VACUUM_INTO_VERSION = old_version
+            connection.connection.close()
+
+
+@override_settings(SQLITE_WRITE_RETRIES=2, SQLITE_WRITE_RETRY_DELAY=0)
+class RetryWriteTests(TestCase):
+    def setUp(self):
+        self.calls = 0
+
+    def make_write(self, errors):
+        @retry_write
+        def write():
+            self.calls += 1
+            if self.calls <= len(errors):
+                raise errors[self.calls - 1]
+            return "written"
+        return write
+
+    def test_write_is_retried_when_database_is_locked(self):
+        write = self.make_write([
+            DatabaseError("database is locked"),
+            sqlite3.OperationalError("database is locked")])
+        self.assertEqual(write(), "written")
+        self.assertEqual(self.calls, 3)
+
+    def test_error_is_raised_after_last_retry(self):
+        write = self.make_write([DatabaseError("database is locked")] * 3)
+        self.assertRaises(DatabaseError, write)
+        self.assertEqual(self.calls, 3)
+
+    def test_other_errors_are_not_retried(self):
+        write = self.make_write([DatabaseError("no such table: card")])
+        self.assertRaises(DatabaseError, write)
+        self.assertEqual(self.calls, 1)
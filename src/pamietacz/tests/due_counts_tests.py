@@ -0,0 +1,277 @@
+from django.core.management import call_command
+from django.test.utils import override_settings
+from pamietacz.due_counts import count_cards_to_repeat_now
+from pamietacz.models import (Shelf,
+                              Deck,
+                              Card,
+                              TrainPool,
+                              TrainCard,
+                              TrainSession,
+                              DueCounter,
+                              UserProfile)
+from test_utils import (add_shelf,
+                        add_deck,
+                        add_card,
+                        TestCaseWithAuthentication)
+from StringIO import StringIO
+import datetime
+
+
+def create_started_shelves(userprofile, number_of_shelves,
+                           number_of_decks, number_of_cards,
+                           number_of_cards_to_repeat):
+    """Create shelves with decks and cards which are all trained by
+    given user. Only some cards in every deck are ready to repeat now.
+    Objects are created in bulk so realistic amount of data can be
+    used in tests."""
+    future = datetime.datetime.now() + datetime.timedelta(days=1)
+    shelves = []
+    first_shelf_number = Shelf.objects.count()
+    for shelf_number in range(first_shelf_number,
+                              first_shelf_number + number_of_shelves):
+        shelf = Shelf.objects.create(name="Shelf %d" % shelf_number)
+        userprofile.shelves.add(shelf)
+        shelves.append(shelf)
+        for deck_number in range(number_of_decks):
+            deck = Deck.objects.create(shelf=shelf,
+                                       name="Deck %d" % deck_number)
+            Card.objects.bulk_create([
+                Card(deck=deck,
+                     question="Question %d" % card_number,
+                     answer="Answer",
+                     question_after_markdown="Question %d" % card_number,
+                     answer_after_markdown="Answer")
+                for card_number in range(number_of_cards)])
+            cards = Card.objects.filter(deck=deck)
+            TrainCard.objects.bulk_create([TrainCard(card=card,
+                                                     userprofile=userprofile,
+                                                     deck=deck)
+                                           for card in cards])
+            train_cards = TrainCard.objects.filter(deck=deck)
+            not_to_repeat = train_cards[number_of_cards_to_repeat:]
+            TrainCard.objects.filter(
+                id__in=list(not_to_repeat.values_list("id", flat=True))
+            ).update(time_to_show=future)
+            TrainPool.objects.create(userprofile=userprofile, deck=deck)
+    Deck.update_card_counts()
+    DueCounter.update_due_counters()
+    return shelves
+
+
+class CountCardsToRepeatNowTests(TestCaseWithAuthentication):
+    def test_count_per_shelf_and_per_deck(self):
+        profile = UserProfile.objects.all()[0]
+        shelves = create_started_shelves(profile, 2, 3, 5, 2)
+
+        # Deck without train pool is not counted.
+        Deck.objects.create(shelf=shelves[0], name="Not trained deck")
+
+        # Shelf without decks has nothing to repeat.
+        empty_shelf = Shelf.objects.create(name="Empty shelf")
+
+        per_shelf, per_deck = count_cards_to_repeat_now(
+            profile, shelves + [empty_shelf])
+        self.assertEqual(per_shelf, {shelves[0].id: 6,
+                                     shelves[1].id: 6,
+                                     empty_shelf.id: 0})
+        self.assertEqual(len(per_deck), 6)
+        self.assertEqual(set(per_deck.values()), set([2]))
+
+    def test_train_pool_without_cards_is_counted_as_zero(self):
+        profile = UserProfile.objects.all()[0]
+        shelves = create_started_shelves(profile, 1, 1, 0, 0)
+        per_shelf, per_deck = count_cards_to_repeat_now(profile, shelves)
+        deck = Deck.objects.get(shelf=shelves[0])
+        self.assertEqual(per_shelf, {shelves[0].id: 0})
+        self.assertEqual(per_deck, {deck.id: 0})
+
+    def test_cards_of_other_users_are_not_counted(self):
+        profile = UserProfile.objects.all()[0]
+        other = UserProfile.objects.create_user(username="Other",
+                                                password="Password")
+        shelves = create_started_shelves(other, 1, 2, 5, 5)
+        profile.shelves.add(shelves[0])
+        per_shelf, per_deck = count_cards_to_repeat_now(profile, shelves)
+        self.assertEqual(per_shelf, {shelves[0].id: 0})
+        self.assertEqual(per_deck, {})
+
+
+class CountCardsToRepeatNowQueriesTests(TestCaseWithAuthentication):
+    """The number of queries needed to show user pages doesn't depend
+    on the amount of shelves, decks and cards."""
+
+    def test_user_shelves_queries(self):
+        profile = UserProfile.objects.all()[0]
+        create_started_shelves(profile, 1, 1, 1, 1)
+        with self.assertNumQueries(4):
+            r = self.client.get("/")
+        self.assertIn("1 items to train", r.content)
+
+        create_started_shelves(profile, 40, 5, 150, 10)
+        with self.assertNumQueries(4):
+            r = self.client.get("/")
+        self.assertIn("50 items to train", r.content)
+
+    def test_user_show_shelf_queries(self):
+        profile = UserProfile.objects.all()[0]
+        shelf = create_started_shelves(profile, 1, 50, 100, 7)[0]
+
+        with self.assertNumQueries(7):
+            r = self.client.get("/user/shelf/%s/show/" % shelf.id)
+        self.assertEqual(r.content.count("(7 / 100)"), 50)
+
+        other_shelf = create_started_shelves(profile, 1, 5, 100, 7)[0]
+        with self.assertNumQueries(7):
+            r = self.client.get("/user/shelf/%s/show/" % other_shelf.id)
+        self.assertEqual(r.content.count("(7 / 100)"), 5)
+
+    def test_show_shelf_queries(self):
+        profile = UserProfile.objects.all()[0]
+        shelf = create_started_shelves(profile, 1, 50, 10, 0)[0]
+        with self.assertNumQueries(4):
+            r = self.client.get("/shelf/%s/show/" % shelf.id)
+        self.assertEqual(r.content.count("(10)"), 50)
+
+        other_shelf = create_started_shelves(profile, 1, 5, 10, 0)[0]
+        with self.assertNumQueries(4):
+            r = self.client.get("/shelf/%s/show/" % other_shelf.id)
+        self.assertEqual(r.content.count("(10)"), 5)
+
+
+class DueCounterTests(TestCaseWithAuthentication):
+    def setUp(self):
+        super(DueCounterTests, self).setUp()
+        add_shelf(self.client, "Some nice shelf")
+        self.shelf = Shelf.objects.all()[0]
+        add_deck(self.client, self.shelf.id, "Some nice deck")
+        self.deck = Deck.objects.all()[0]
+        for i in range(3):
+            add_card(self.client, self.deck.id, "Question %d" % i, "Answer")
+        self.client.get("/user/shelf/%s/start/" % self.shelf.id)
+        self.client.get("/user/deck/%s/train/" % self.deck.id)
+
+    def assertDueCounter(self, total_cards, due_cards):
+        due_counter = DueCounter.objects.get()
+        self.assertEqual((due_counter.total_cards, due_counter.due_cards),
+                         (total_cards, due_cards))
+        return due_counter
+
+    def assertDueCounterIsRight(self):
+        """Counted again due counter is the same as updated one."""
+        due_counter = DueCounter.objects.get()
+        DueCounter.update_due_counters(all_counters=True)
+        self.assertDueCounter(due_counter.total_cards, due_counter.due_cards)
+
+    def answer(self, answer):
+        session = TrainSession.objects.get()
+        self.client.post("/user/train/session/%s/" % session.id,
+                         {"Answer": answer})
+
+    def test_due_counter_is_updated(self):
+        self.assertDueCounter(3, 3)
+
+        # Card answered good is not due any more.
+        self.answer("Good")
+        due_counter = self.assertDueCounter(3, 2)
+        train_card = TrainCard.objects.get(n=1)
+        self.assertEqual(due_counter.next_due, train_card.time_to_show)
+        self.assertDueCounterIsRight()
+
+        # Bad answer doesn't change time to show.
+        self.answer("Bad")
+        self.assertDueCounter(3, 2)
+
+        # New card can be repeated now.
+        add_card(self.client, self.deck.id, "Question 4", "Answer")
+        self.assertDueCounter(4, 3)
+        self.assertDueCounterIsRight()
+
+        # Deleted card which is due.
+        card = TrainCard.objects.filter(n=0)[0].card
+        self.client.get("/card/%s/delete/" % card.id)
+        self.assertDueCounter(3, 2)
+        self.assertDueCounterIsRight()
+
+        # Deleted card which is not due.
+        self.client.get("/card/%s/delete/" % train_card.card_id)
+        self.assertDueCounter(2, 2)
+        self.assertDueCounterIsRight()
+
+        # Counter is shown on user pages.
+        r = self.client.get("/")
+        self.assertIn("2 items to train", r.content)
+
+        # Counter is removed when shelf is stopped.
+        self.client.get("/user/shelf/%s/stop/" % self.shelf.id)
+        self.assertEqual(DueCounter.objects.count(), 0)
+
+    @override_settings(LAZY_TRAIN_CARDS=True)
+    def test_due_counter_of_lazy_train_cards_is_updated(self):
+        self.client.get("/user/shelf/%s/stop/" % self.shelf.id)
+        self.client.get("/user/shelf/%s/start/" % self.shelf.id)
+        self.client.get("/user/deck/%s/train/" % self.deck.id)
+        self.assertDueCounter(3, 3)
+        self.answer("Good")
+        self.assertDueCounter(3, 2)
+        self.assertDueCounterIsRight()
+        card = Card.objects.exclude(traincard__isnull=False)[0]
+        self.client.get("/card/%s/delete/" % card.id)
+        self.assertDueCounter(2, 1)
+        self.assertDueCounterIsRight()
+
+    def test_cards_which_became_due_are_counted(self):
+        self.answer("Good")
+        self.answer("Good")
+        self.assertDueCounter(3, 1)
+
+        # Nothing to count yet.
+        self.assertEqual(DueCounter.update_due_counters(), 0)
+
+        # Time of one card passed.
+        train_card = TrainCard.objects.filter(n=1)[0]
+        train_card.time_to_show = datetime.datetime.now()
+        train_card.save()
+        DueCounter.objects.update(next_due=train_card.time_to_show)
+        stdout = StringIO()
+        call_command("update_due_counters", stdout=stdout)
+        self.assertIn("Updated 1 due counters", stdout.getvalue())
+        due_counter = self.assertDueCounter(3, 2)
+        self.assertEqual(due_counter.next_due,
+                         TrainCard.objects.exclude(
+                             id=train_card.id).get(n=1).time_to_show)
+
+    def test_cards_which_became_due_arent_removed_before_counted(self):
+        self.answer("Good")
+        self.answer("Good")
+        due_counter = self.assertDueCounter(3, 1)
+
+        # Time of both answered cards passed but counter wasn't counted
+        # again yet.
+        now = datetime.datetime.now()
+        became_due = now - datetime.timedelta(minutes=1)
+        TrainCard.objects.filter(n=1).update(time_to_show=became_due)
+        DueCounter.objects.update(next_due=became_due)
+        later = now + datetime.timedelta(days=1)
+        DueCounter.cards_answered(due_counter.userprofile_id,
+                                  due_counter.deck_id,
+                                  [(became_due, later)] * 2, now)
+        due_counter = self.assertDueCounter(3, 1)
+        self.assertEqual(due_counter.next_due, became_due)
+
+        # Counter is never negative.
+        DueCounter.objects.update(due_cards=0, next_due=None)
+        DueCounter.cards_answered(due_counter.userprofile_id,
+                                  due_counter.deck_id,
+                                  [(became_due, later)] * 2, now)
+        self.assertDueCounter(3, 0)
+
+    def test_deleted_card_doesnt_make_counter_negative(self):
+        DueCounter.objects.update(due_cards=0)
+        card = Card.objects.all()[0]
+        self.client.get("/card/%s/delete/" % card.id)
+        self.assertDueCounter(2, 0)
+
+    def test_missing_due_counters_are_created(self):
+        DueCounter.objects.all().delete()
+        DueCounter.update_due_counters()
+        self.assertDueCounter(3, 3)
@@ -1,5 +1,9 @@
 from django.core.files.uploadedfile import SimpleUploadedFile
-from pamietacz.models import Shelf, Deck, Card
+from pamietacz import dump_load
+from pamietacz.dump_load import dump_data_as_xml_chunks
+from pamietacz.models import Shelf, Deck, Card, DueCounter
+from pamietacz.rendering import RENDER_VERSION
+from StringIO import StringIO
 from test_utils import (add_shelf,
                         add_deck,
                         add_card,
@@ -83,7 +87,8 @@ class DumpLoadTests(TransactionTestCaseWithAuthentication):
              """  <shelf name="2nd shelf&gt;&lt;&quot;&amp;"/>\n"""
              """  <shelf name="3rd shelf"/>\n"""
              """</data>\n""")
-        self.assertEqual(c, r.content)
+        content = "".join(r.streaming_content)
+        self.assertEqual(c, content)
         self.assertEqual(200, r.status_code)
 
         # Delete all shelves (with all decks and cards) from database.
@@ -97,7 +102,7 @@ class DumpLoadTests(TransactionTestCaseWithAuthentication):
         self.assertEqual(len(Deck.objects.all()), 0)
 
         # Load data from XML file back to database.
-        sent_file = SimpleUploadedFile("dump_data.xml", r.content)
+        sent_file = SimpleUploadedFile("dump_data.xml", content)
         r = self.client.post("/data/load/", {"data_dump_file": sent_file},
                              follow=True)
         self.assertEqual(200, r.status_code)
@@ -159,7 +164,7 @@ class DumpLoadTests(TransactionTestCaseWithAuthentication):
         r = self.client.post("/data/load/", {"data_dump_file": sent_file},
                              follow=True)
         self.assertEqual(200, r.status_code)
-        self.assertIn("Error while parsing XML: Start tag expected",
+        self.assertIn("Error while parsing XML: Document is empty",
                       r.content)
         self.assertEqual(len(Card.objects.all()), 0)
         self.assertEqual(len(Shelf.objects.all()), 0)
@@ -273,4 +278,133 @@ class DumpLoadTests(TransactionTestCaseWithAuthentication):
              """    <deck name="first deck"/>\n"""
              """  </shelf>\n"""
              """</data>\n""")
-        self.assertEqual(c, r.content)
+        self.assertEqual(c, "".join(r.streaming_content))
+
+    def test_dump_is_read_by_one_query(self):
+        for i in range(3):
+            add_shelf(self.client, "shelf %d" % i)
+            shelf = Shelf.objects.get(name="shelf %d" % i)
+            for j in range(3):
+                add_deck(self.client, shelf.id, "deck %d" % j)
+                deck = Deck.objects.get(shelf=shelf, name="deck %d" % j)
+                add_card(self.client, deck.id, "question", "answer")
+        with self.assertNumQueries(1):
+            content = "".join(dump_data_as_xml_chunks())
+        self.assertEqual(content.count("<card>"), 9)
+
+    def test_dump_without_shelves(self):
+        self.assertEqual("".join(dump_data_as_xml_chunks()),
+                         "<?xml version='1.0' encoding='UTF-8'?>\n"
+                         "<data/>\n")
+
+    def test_cards_are_loaded_in_batches(self):
+        xml_content = ("<data><shelf name=\"shelf\">"
+                       "<deck name=\"first\">%s</deck>"
+                       "<deck name=\"second\">%s</deck>"
+                       "<deck name=\"empty\"/></shelf></data>" %
+                       ("".join("<card><question>q%d</question>"
+                                "<answer>*a*</answer></card>" % i
+                                for i in range(5)),
+                        "<card><question>q</question>"
+                        "<answer>a</answer></card>"))
+        old_cards_in_batch = dump_load.CARDS_IN_BATCH
+        dump_load.CARDS_IN_BATCH = 2
+        try:
+            # Shelf, three decks, three batches of cards and card counts.
+            with self.assertNumQueries(8):
+                dump_load.load_data_as_xml(StringIO(xml_content))
+        finally:
+            dump_load.CARDS_IN_BATCH = old_cards_in_batch
+        decks = Deck.objects.order_by("order")
+        self.assertEqual([(deck.name, deck.order, deck.card_count)
+                          for deck in decks],
+                         [("first", 0, 5), ("second", 1, 1),
+                          ("empty", 2, 0)])
+        card = Card.objects.get(question="q3")
+        self.assertEqual(card.answer_after_markdown, "<p><em>a</em></p>")
+        self.assertEqual(card.render_version, RENDER_VERSION)
+
+    def test_load_the_same_card_twice(self):
+        xml_content = ("<data><shelf name=\"shelf\"><deck name=\"deck\">"
+                       "<card><question>q</question><answer>a</answer></card>"
+                       "<card><question>q</question><answer>b</answer></card>"
+                       "</deck></shelf></data>")
+        sent_file = SimpleUploadedFile("dump_data.xml", xml_content)
+        r = self.client.post("/data/load/", {"data_dump_file": sent_file},
+                             follow=True)
+        self.assertIn("Error while parsing XML: cannot add cards", r.content)
+        self.assertEqual(len(Card.objects.all()), 0)
+        self.assertEqual(len(Shelf.objects.all()), 0)
+
+    def test_merge(self):
+        add_shelf(self.client, "shelf")
+        shelf = Shelf.objects.get()
+        add_deck(self.client, shelf.id, "deck")
+        deck = Deck.objects.get()
+        for i in range(3):
+            add_card(self.client, deck.id, "q%d" % i, "a%d" % i)
+        cards_ids = dict(Card.objects.values_list("question", "id"))
+        self.client.get("/user/shelf/%s/start/" % shelf.id)
+        self.client.get("/user/deck/%s/train/" % deck.id)
+        xml_content = ("<data><shelf name=\"shelf\"><deck name=\"deck\">"
+                       "<card><question>q0</question><answer>a0</answer>"
+                       "</card><card><question>q1</question>"
+                       "<answer>*changed*</answer></card>"
+                       "<card><question>q3</question><answer>a3</answer>"
+                       "</card></deck><deck name=\"new deck\">"
+                       "<card><question>q0</question><answer>a0</answer>"
+                       "</card></deck></shelf><shelf name=\"new shelf\"/>"
+                       "</data>")
+        sent_file = SimpleUploadedFile("dump_data.xml", xml_content)
+        r = self.client.post("/data/load/", {"data_dump_file": sent_file,
+                                             "merge": "on"},
+                             follow=True)
+        self.assertEqual(200, r.status_code)
+        self.assertEqual(list(Shelf.objects.order_by("id").values_list(
+            "name", flat=True)), ["shelf", "new shelf"])
+        self.assertEqual(list(Deck.objects.order_by("id").values_list(
+            "name", "order", "card_count")),
+            [("deck", 0, 4), ("new deck", 1, 1)])
+
+        # Cards which were in database are kept so training goes on.
+        cards = Card.objects.filter(deck=deck)
+        for card in cards.filter(question__in=["q0", "q1", "q2"]):
+            self.assertEqual(card.id, cards_ids[card.question])
+        changed_card = cards.get(question="q1")
+        self.assertEqual(changed_card.answer, "*changed*")
+        self.assertEqual(changed_card.answer_after_markdown,
+                         "<p><em>changed</em></p>")
+        self.assertEqual(cards.get(question="q3").answer, "a3")
+        due_counter = DueCounter.objects.get(deck=deck)
+        self.assertEqual((due_counter.total_cards, due_counter.due_cards),
+                         (4, 4))
+
+    def test_merge_repeated_cards_and_decks(self):
+        add_shelf(self.client, "shelf")
+        shelf = Shelf.objects.get()
+        add_deck(self.client, shelf.id, "deck")
+        deck = Deck.objects.get()
+        add_card(self.client, deck.id, "q0", "a0")
+        card = "<card><question>%s</question><answer>%s</answer></card>"
+        xml_content = ("<data><shelf name=\"shelf\">"
+                       "<deck name=\"deck\">%s%s</deck>"
+                       "<deck name=\"new deck\">%s%s</deck>"
+                       "<deck name=\"deck\">%s%s</deck>"
+                       "<deck name=\"new deck\">%s%s</deck>"
+                       "</shelf></data>" %
+                       (card % ("q1", "a1"), card % ("q1", "a1"),
+                        card % ("q0", "a0"), card % ("q0", "a0"),
+                        card % ("q1", "a1"), card % ("q0", "a0"),
+                        card % ("q0", "*changed*"), card % ("q2", "a2")))
+        sent_file = SimpleUploadedFile("dump_data.xml", xml_content)
+        r = self.client.post("/data/load/", {"data_dump_file": sent_file,
+                                             "merge": "on"},
+                             follow=True)
+        self.assertEqual(200, r.status_code)
+        self.assertNotIn("Error while parsing XML", r.content)
+        self.assertEqual(list(Deck.objects.order_by("id").values_list(
+            "name", "card_count")), [("deck", 2), ("new deck", 2)])
+        new_deck = Deck.objects.get(name="new deck")
+        self.assertEqual(sorted(Card.objects.filter(
+            deck=new_deck).values_list("question", "answer")),
+            [("q0", "*changed*"), ("q2", "a2")])
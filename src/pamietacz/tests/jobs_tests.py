@@ -0,0 +1,140 @@
+from django.test.utils import override_settings
+from pamietacz import jobs
+from pamietacz.models import (Shelf,
+                              Deck,
+                              Card,
+                              Job,
+                              TrainPool,
+                              TrainCard,
+                              UserProfile)
+from test_utils import (add_shelf,
+                        add_deck,
+                        add_card,
+                        TestCaseWithAuthentication)
+import datetime
+
+
+@override_settings(TRAIN_POOLS_IN_REQUEST_LIMIT=2)
+class AddCardToTrainPoolsJobTests(TestCaseWithAuthentication):
+    def setUp(self):
+        super(AddCardToTrainPoolsJobTests, self).setUp()
+        add_shelf(self.client, "Some nice shelf")
+        shelf = Shelf.objects.all()[0]
+        add_deck(self.client, shelf.id, "Some nice deck")
+        self.deck = Deck.objects.all()[0]
+
+    def start_training_by_users(self, number_of_users):
+        for i in range(number_of_users):
+            userprofile = UserProfile.objects.create(username="User %d" % i)
+            TrainPool.create_train_pool(userprofile, self.deck)
+
+    def test_card_is_added_in_request_for_few_train_pools(self):
+        self.start_training_by_users(2)
+        add_card(self.client, self.deck.id, "What is it?", "This is that.")
+        self.assertEqual(Job.objects.count(), 0)
+        self.assertEqual(TrainCard.objects.count(), 2)
+
+    def test_card_is_added_in_background_for_many_train_pools(self):
+        self.start_training_by_users(5)
+        add_card(self.client, self.deck.id, "What is it?", "This is that.")
+
+        # Train cards are not created in request.
+        self.assertEqual(TrainCard.objects.count(), 0)
+        job = Job.objects.get()
+        self.assertEqual(job.status, Job.PENDING)
+        r = self.client.get("/deck/%s/show/" % self.deck.id)
+        self.assertIn("Adding new card to train pools", r.content)
+
+        # Job is done batch by batch.
+        old_batch_size = jobs.TRAIN_POOLS_BATCH_SIZE
+        jobs.TRAIN_POOLS_BATCH_SIZE = 2
+        try:
+            finished = jobs.run_pending_jobs(10)
+        finally:
+            jobs.TRAIN_POOLS_BATCH_SIZE = old_batch_size
+        self.assertEqual(len(finished), 1)
+        job = Job.objects.get()
+        self.assertEqual(job.status, Job.DONE)
+        self.assertEqual((job.progress, job.total), (5, 5))
+        card = Card.objects.get()
+        self.assertEqual(TrainCard.objects.filter(card=card).count(), 5)
+
+        # Finished job is not shown on deck page.
+        r = self.client.get("/deck/%s/show/" % self.deck.id)
+        self.assertNotIn("Adding new card to train pools", r.content)
+
+        # Nothing more to do.
+        self.assertEqual(jobs.run_pending_jobs(10), [])
+
+    def test_repeated_job_skips_train_pools_with_card(self):
+        self.start_training_by_users(3)
+        add_card(self.client, self.deck.id, "What is it?", "This is that.")
+        card = Card.objects.get()
+
+        # Card was already added to one train pool.
+        train_pool = TrainPool.objects.order_by("id")[0]
+        TrainPool.add_card_to_train_pools_batch(card.id, self.deck.id,
+                                                train_pool.id, train_pool.id)
+        jobs.run_pending_jobs(10)
+        self.assertEqual(TrainCard.objects.filter(card=card).count(), 3)
+
+    def test_job_of_deleted_card_adds_nothing(self):
+        self.start_training_by_users(5)
+        add_card(self.client, self.deck.id, "What is it?", "This is that.")
+        Card.objects.get().delete()
+        finished = jobs.run_pending_jobs(10)
+        self.assertEqual(finished[0].status, Job.DONE)
+        self.assertEqual(TrainCard.objects.count(), 0)
+
+
+class RetryJobTests(TestCaseWithAuthentication):
+    def setUp(self):
+        super(RetryJobTests, self).setUp()
+
+        def failing_job(job):
+            raise ValueError("Something went wrong")
+        jobs.job_handlers["failing"] = failing_job
+
+    def tearDown(self):
+        del jobs.job_handlers["failing"]
+        super(RetryJobTests, self).tearDown()
+
+    def test_failed_job_is_retried_later(self):
+        Job.enqueue("failing")
+        jobs.run_pending_jobs(10)
+        job = Job.objects.get()
+        self.assertEqual(job.status, Job.PENDING)
+        self.assertEqual(job.attempts, 1)
+        self.assertIn("Something went wrong", job.error)
+        self.assertTrue(job.run_after > datetime.datetime.now())
+
+        # Job is not run before its time.
+        self.assertEqual(jobs.run_pending_jobs(10), [])
+
+        # After too many attempts job is marked as failed.
+        for attempt in range(jobs.MAX_ATTEMPTS - 1):
+            Job.objects.update(run_after=datetime.datetime.now())
+            jobs.run_pending_jobs(10)
+        job = Job.objects.get()
+        self.assertEqual(job.status, Job.FAILED)
+        self.assertEqual(job.attempts, jobs.MAX_ATTEMPTS)
+
+    def test_job_of_killed_worker_is_claimed_again(self):
+        Job.enqueue("failing")
+        job, = jobs.claim_jobs(10)
+        self.assertEqual(jobs.claim_jobs(10), [])
+
+        # Worker was killed and didn't finish the job.
+        Job.objects.update(claimed_at=datetime.datetime.now() -
+                           jobs.CLAIM_TIMEOUT - datetime.timedelta(seconds=1))
+        job, = jobs.claim_jobs(10)
+        self.assertEqual((job.status, job.attempts), (Job.RUNNING, 2))
+
+        # Job which used all attempts is failed.
+        Job.objects.update(attempts=jobs.MAX_ATTEMPTS,
+                           claimed_at=datetime.datetime.now() -
+                           jobs.CLAIM_TIMEOUT - datetime.timedelta(seconds=1))
+        self.assertEqual(jobs.claim_jobs(10), [])
+        job = Job.objects.get()
+        self.assertEqual(job.status, Job.FAILED)
+        self.assertIn("wasn't finished", job.error)
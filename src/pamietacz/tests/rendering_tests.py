@@ -0,0 +1,262 @@
+from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
+from markdown import Markdown
+from pamietacz import rendering
+from pamietacz.management.commands import rerender_cards
+from pamietacz.models import Shelf, Deck, Card, RenderedMarkdown
+from StringIO import StringIO
+import threading
+
+
+class RenderingTestCase(TestCase):
+    """Conversions done by Markdown are counted."""
+
+    def setUp(self):
+        self.conversions = []
+        self.convert = rendering.renderer_pool.convert
+
+        def convert(text):
+            self.conversions.append(text)
+            return self.convert(text)
+        rendering.renderer_pool.convert = convert
+        rendering.render_cache.clear()
+
+    def tearDown(self):
+        rendering.renderer_pool.convert = self.convert
+        rendering.render_cache.clear()
+
+
+class RenderCacheTests(RenderingTestCase):
+    def test_text_is_converted_once(self):
+        html = rendering.render_markdown("**What is it?**")
+        self.assertEqual(html, "<p><strong>What is it?</strong></p>")
+        self.assertEqual(rendering.render_markdown("**What is it?**"), html)
+        self.assertEqual(rendering.render_markdown_many(
+            ["**What is it?**", "*That*", "*That*"]),
+            [html, "<p><em>That</em></p>", "<p><em>That</em></p>"])
+        self.assertEqual(self.conversions, ["**What is it?**", "*That*"])
+        self.assertEqual(rendering.render_cache.hits, 2)
+
+    def test_least_recently_used_text_is_removed(self):
+        cache = rendering.RenderCache(2)
+        cache.set("a", "A")
+        cache.set("b", "B")
+        cache.get("a")
+        cache.set("c", "C")
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("a"), "A")
+        self.assertEqual(cache.get("c"), "C")
+
+    def test_key_depends_on_configuration(self):
+        key = rendering.render_key("Text")
+        old_config = rendering.RENDER_CONFIG
+        rendering.RENDER_CONFIG = "other configuration"
+        try:
+            self.assertNotEqual(rendering.render_key("Text"), key)
+        finally:
+            rendering.RENDER_CONFIG = old_config
+        self.assertEqual(rendering.render_key("Text"), key)
+        self.assertNotEqual(rendering.render_key("Other text"), key)
+
+    def test_configuration_contains_version_of_code(self):
+        self.assertIn("code-%s" % rendering.RENDER_CODE_VERSION,
+                      rendering.RENDER_CONFIG)
+
+
+class RendererPoolTests(TestCase):
+    def test_renderer_is_reset_after_conversion(self):
+        pool = rendering.RendererPool()
+        text = "<div>Some HTML</div>\n\n*Text*"
+        html = pool.convert(text)
+        self.assertEqual(pool.convert(text), html)
+        renderer = pool.free_renderers[0]
+        self.assertEqual(renderer.htmlStash.html_counter, 0)
+        stats = pool.stats()
+        self.assertEqual((stats["renderers"], stats["conversions"]), (1, 2))
+        self.assertTrue(stats["conversion_time"] > 0)
+
+    def test_renderers_are_used_by_many_threads(self):
+        pool = rendering.RendererPool()
+        texts = ["<div>HTML %d</div>\n\n**Text %d**\n\n"
+                 "~~~~{.python}\nprint %d\n~~~~" % (i, i, i)
+                 for i in range(10)]
+        expected = [rendering.create_markdown().convert(text)
+                    for text in texts]
+        results = {}
+
+        def convert(thread_number):
+            results[thread_number] = [pool.convert(text)
+                                      for text in texts * 5]
+
+        threads = [threading.Thread(target=convert, args=(i,))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for thread_number in range(8):
+            self.assertEqual(results[thread_number], expected * 5)
+        stats = pool.stats()
+        self.assertTrue(1 <= stats["renderers"] <= 8)
+        self.assertEqual(stats["conversions"], 8 * 50)
+        self.assertEqual(len(pool.free_renderers), stats["renderers"])
+
+
+class HighlightCacheTests(TestCase):
+    def setUp(self):
+        rendering.highlight_cache.clear()
+        rendering.highlight_stats.clear()
+
+    def tearDown(self):
+        rendering.highlight_cache.clear()
+        rendering.highlight_stats.clear()
+
+    def test_html_is_the_same_as_without_cache(self):
+        for text in ["```python\nimport os\n```",
+                     "    :::c\n    int main() {}",
+                     "~~~nosuchlanguage\n<b>code</b>\n~~~",
+                     "| a | b |\n|---|---|\n| 1 | 2 |"]:
+            markdown = Markdown(extensions=rendering.MARKDOWN_EXTENSIONS,
+                                output_format=rendering.MARKDOWN_OUTPUT_FORMAT)
+            self.assertEqual(rendering.create_markdown().convert(text),
+                             markdown.convert(text))
+
+    def test_code_is_highlighted_once(self):
+        markdown = rendering.create_markdown()
+        text = "```python\nimport os\n```\n\n```python\nimport os\n```"
+        html = markdown.convert(text)
+        self.assertEqual(html.count('<span class="kn">import</span>'), 2)
+        self.assertEqual(rendering.highlight_cache.misses, 1)
+        self.assertEqual(rendering.highlight_cache.hits, 1)
+        self.assertEqual(rendering.highlight_stats.lexers, {"Python": 1})
+
+    def test_lexer_is_not_guessed_for_given_language(self):
+        code = rendering.CachedCodeHilite("import os", lang="python")
+        code.hilite()
+        self.assertEqual(code.lexer_name, "Python")
+        code = rendering.CachedCodeHilite("#include <stdio.h>\n"
+                                          "int main() {}")
+        code.hilite()
+        self.assertEqual(code.lexer_name, "C")
+        self.assertEqual(rendering.highlight_stats.guesses, 1)
+
+
+@override_settings(MARKDOWN_PERSISTENT_CACHE=True)
+class PersistentRenderCacheTests(RenderingTestCase):
+    def test_html_is_kept_in_database(self):
+        html = rendering.render_markdown_many(["*One*", "*Two*"])
+        self.assertEqual(RenderedMarkdown.objects.count(), 2)
+
+        # HTML is taken from database when it's not in memory.
+        rendering.render_cache.clear()
+        with self.assertNumQueries(1):
+            self.assertEqual(rendering.render_markdown_many(["*One*",
+                                                             "*Two*"]),
+                             html)
+        self.assertEqual(self.conversions, ["*One*", "*Two*"])
+
+        # Now it's in memory again.
+        with self.assertNumQueries(0):
+            rendering.render_markdown("*One*")
+
+    def test_html_saved_by_other_process_is_not_saved_again(self):
+        RenderedMarkdown.objects.create(key=rendering.render_key("*One*"),
+                                        html="<p><em>One</em></p>")
+        RenderedMarkdown.store_many({rendering.render_key("*One*"): "Other",
+                                     rendering.render_key("*Two*"): "Two"})
+        self.assertEqual(RenderedMarkdown.objects.get(
+            key=rendering.render_key("*One*")).html, "<p><em>One</em></p>")
+        self.assertEqual(RenderedMarkdown.objects.count(), 2)
+
+    def test_html_saved_by_other_process_meanwhile_is_not_saved_again(self):
+        get_many = RenderedMarkdown.__dict__["get_many"]
+        get_many_of_model = RenderedMarkdown.get_many
+        found = []
+
+        def get_many_while_other_process_saves(keys):
+            found.append(get_many_of_model(keys))
+            RenderedMarkdown.objects.get_or_create(
+                key=rendering.render_key("*One*"),
+                html="<p><em>One</em></p>")
+            return found[-1]
+
+        RenderedMarkdown.get_many = staticmethod(
+            get_many_while_other_process_saves)
+        try:
+            RenderedMarkdown.store_many({
+                rendering.render_key("*One*"): "Other",
+                rendering.render_key("*Two*"): "Two"})
+        finally:
+            RenderedMarkdown.get_many = get_many
+        self.assertEqual(len(found), 2)
+        self.assertEqual(RenderedMarkdown.objects.get(
+            key=rendering.render_key("*One*")).html, "<p><em>One</em></p>")
+        self.assertEqual(RenderedMarkdown.objects.count(), 2)
+
+
+class RerenderCardsCommandTests(TransactionTestCase):
+    """Reading table description commits transaction in SQLite so it
+    can't be tested inside transaction."""
+
+    def setUp(self):
+        shelf = Shelf.objects.create(name="Shelf")
+        self.deck = Deck.objects.create(name="Deck", shelf=shelf)
+
+    def rerender(self, **options):
+        stdout = StringIO()
+        call_command("rerender_cards", stdout=stdout, **options)
+        return stdout.getvalue()
+
+    def test_stale_cards_are_rendered(self):
+        card = Card.objects.create(deck=self.deck, question="*Saved*",
+                                   answer="**Saved**")
+        self.assertEqual(card.render_version, rendering.RENDER_VERSION)
+        Card.objects.bulk_create([
+            Card(deck=self.deck,
+                 question="*Question %d*" % i,
+                 answer="**Answer %d**" % i,
+                 question_after_markdown="Old HTML",
+                 answer_after_markdown="Old HTML",
+                 render_version="old")
+            for i in range(25)])
+
+        for processes in (0, 2):
+            Card.objects.exclude(id=card.id).update(render_version="old")
+            output = self.rerender(processes=processes, chunk=10)
+            self.assertIn("25 cards to render", output)
+            self.assertIn("25 / 25 cards rendered", output)
+            self.assertEqual(Card.objects.filter(
+                render_version=rendering.RENDER_VERSION).count(), 26)
+            for card in Card.objects.all():
+                self.assertEqual(card.question_after_markdown,
+                                 rendering.render_markdown(card.question))
+                self.assertEqual(card.answer_after_markdown,
+                                 rendering.render_markdown(card.answer))
+
+        # Nothing more to render.
+        self.assertIn("0 cards to render", self.rerender(processes=0))
+
+    def test_card_changed_while_rendered_isnt_updated(self):
+        card = Card.objects.create(deck=self.deck, question="*Old*",
+                                   answer="Old")
+        Card.objects.filter(id=card.id).update(render_version="old")
+        command = rerender_cards
+        render = command.render_markdown_in_worker
+
+        def render_while_card_is_edited(texts):
+            card.question = "*New*"
+            card.save()
+            return render(texts)
+
+        command.render_markdown_in_worker = render_while_card_is_edited
+        try:
+            output = self.rerender(processes=0)
+        finally:
+            command.render_markdown_in_worker = render
+        self.assertIn("0 / 1 cards rendered", output)
+        self.assertIn("1 cards were changed while they were rendered",
+                      output)
+        card = Card.objects.get(id=card.id)
+        self.assertEqual(card.question_after_markdown,
+                         rendering.render_markdown("*New*"))
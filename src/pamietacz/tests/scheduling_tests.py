@@ -0,0 +1,156 @@
+from django.core.management import call_command
+from django.test import TestCase
+from pamietacz import scheduling
+from pamietacz.models import (Shelf,
+                              Deck,
+                              Card,
+                              TrainCard,
+                              Review,
+                              UserProfile)
+from StringIO import StringIO
+import datetime
+import os
+import random
+import tempfile
+
+
+class SchedulingTests(TestCase):
+    def test_intervals_are_the_same_as_for_single_card(self):
+        rng = random.Random(0)
+        now = datetime.datetime(2013, 10, 17, 12, 30, 15, 123456)
+        states = [(rng.uniform(1.3, 3.0), rng.randint(0, 6),
+                   rng.randint(0, 300), rng.randint(0, 5))
+                  for i in range(1000)]
+        ef, n, i, time_to_show = scheduling.calculate_intervals(
+            *(zip(*states) + [now]))
+        time_to_show = scheduling.to_datetimes(time_to_show)
+        for j, (old_ef, old_n, old_i, q) in enumerate(states):
+            train_card = TrainCard(ef=old_ef, n=old_n, i=old_i,
+                                   time_to_show=None)
+            train_card.calculate_interval(q, now)
+            self.assertEqual(train_card.ef, ef[j])
+            self.assertEqual(train_card.n, n[j])
+            self.assertEqual(train_card.i, i[j])
+            self.assertEqual(train_card.time_to_show, time_to_show[j])
+
+    def test_replay_is_the_same_as_answers_of_single_card(self):
+        rng = random.Random(1)
+        start = datetime.datetime(2013, 10, 17)
+        cards = 50
+        answers = [[rng.choice([-1, 0, 3, 4, 5]) for j in range(cards)]
+                   for k in range(20)]
+        times = [[start + datetime.timedelta(days=k)] * cards
+                 for k in range(20)]
+        ef, n, i, time_to_show = scheduling.replay(
+            [2.5] * cards, [0] * cards, [0] * cards, [start] * cards,
+            answers, times)
+        time_to_show = scheduling.to_datetimes(time_to_show)
+        for j in range(cards):
+            train_card = TrainCard(time_to_show=start)
+            for k in range(20):
+                if answers[k][j] >= 0:
+                    train_card.calculate_interval(answers[k][j], times[k][j])
+                    # Interval is saved in database as integer.
+                    train_card.i = int(train_card.i)
+            self.assertEqual((train_card.ef, train_card.n, train_card.i,
+                              train_card.time_to_show),
+                             (ef[j], n[j], i[j], time_to_show[j]))
+
+
+class RescheduleTrainCardsCommandTests(TestCase):
+    def setUp(self):
+        shelf = Shelf.objects.create(name="Shelf")
+        self.deck = Deck.objects.create(name="Deck", shelf=shelf)
+        other_deck = Deck.objects.create(name="Other deck", shelf=shelf)
+        self.userprofile = UserProfile.objects.create(username="John")
+        self.cards = [Card.objects.create(deck=self.deck,
+                                          question="Question %d" % i,
+                                          answer="Answer %d" % i)
+                      for i in range(3)]
+        other_card = Card.objects.create(deck=other_deck,
+                                         question="Question",
+                                         answer="Answer")
+        self.time_to_show = datetime.datetime(2013, 1, 1)
+        for card in self.cards + [other_card]:
+            TrainCard.objects.create(card=card, deck=card.deck,
+                                     userprofile=self.userprofile,
+                                     time_to_show=self.time_to_show,
+                                     n=2, i=6, ef=2.6)
+
+    def reschedule(self, *args, **options):
+        stdout = StringIO()
+        call_command("reschedule_train_cards", *args, stdout=stdout,
+                     **options)
+        return stdout.getvalue()
+
+    def test_train_cards_are_scheduled_from_given_time(self):
+        output = self.reschedule(decks=[self.deck.id],
+                                 from_time="2013-10-17 10:00:00",
+                                 chunk=2)
+        self.assertIn("Updated 3 train cards", output)
+        # Interval of 6 is 6 * 24 * 60 seconds like in calculate_interval.
+        self.assertEqual(
+            TrainCard.objects.filter(
+                time_to_show=datetime.datetime(2013, 10, 17, 12, 24)).count(),
+            3)
+        # Train cards of other decks are not changed.
+        self.assertEqual(TrainCard.objects.filter(
+            time_to_show=self.time_to_show).count(), 1)
+
+    def test_answers_are_replayed(self):
+        fd, path = tempfile.mkstemp(suffix=".csv")
+        with os.fdopen(fd, "w") as f:
+            for card in self.cards[:2]:
+                f.write("%d,%d,5,2013-10-02 10:00:00\n" %
+                        (self.userprofile.id, card.id))
+                f.write("%d,%d,4,2013-10-01 10:00:00\n" %
+                        (self.userprofile.id, card.id))
+        try:
+            self.reschedule(replay=path, users=["John"])
+        finally:
+            os.remove(path)
+
+        expected = TrainCard(time_to_show=self.time_to_show)
+        expected.calculate_interval(4, datetime.datetime(2013, 10, 1, 10))
+        expected.calculate_interval(5, datetime.datetime(2013, 10, 2, 10))
+        for card in self.cards[:2]:
+            train_card = TrainCard.objects.get(card=card)
+            self.assertEqual((train_card.ef, train_card.n, train_card.i,
+                              train_card.time_to_show),
+                             (expected.ef, expected.n, expected.i,
+                              expected.time_to_show))
+        # Train card without answers is not changed.
+        train_card = TrainCard.objects.get(card=self.cards[2])
+        self.assertEqual((train_card.n, train_card.time_to_show),
+                         (2, self.time_to_show))
+
+    def test_answers_from_reviews_are_replayed(self):
+        train_card = TrainCard.objects.get(card=self.cards[0])
+        answers = [(4, datetime.datetime(2013, 10, 1, 10)),
+                   (0, datetime.datetime(2013, 10, 2, 10)),
+                   (5, datetime.datetime(2013, 10, 3, 10))]
+        expected = TrainCard(time_to_show=self.time_to_show)
+        reviews = []
+        for q, answered_at in answers:
+            review = expected.review(q, answered_at)
+            review.userprofile = self.userprofile
+            review.card = self.cards[0]
+            reviews.append(review)
+        # Reviews are saved in other order than they were given.
+        Review.objects.bulk_create(reversed(reviews))
+        # Answers of other users are not used.
+        other_userprofile = UserProfile.objects.create(username="Other")
+        Review.objects.create(userprofile=other_userprofile,
+                              card=self.cards[0], q=0,
+                              time=datetime.datetime(2013, 10, 4),
+                              previous_interval=0, interval=0)
+
+        self.reschedule(reviews=True)
+        train_card = TrainCard.objects.get(id=train_card.id)
+        self.assertEqual((train_card.ef, train_card.n, train_card.i,
+                          train_card.time_to_show),
+                         (expected.ef, expected.n, expected.i,
+                          expected.time_to_show))
+        # Train cards without reviews are not changed.
+        self.assertEqual(TrainCard.objects.filter(
+            time_to_show=self.time_to_show).count(), 3)
@@ -1,4 +1,7 @@
+from django.db import connection, transaction
+from django.test.utils import override_settings
 from django.http import (HttpResponseRedirect,
+                         HttpResponseBadRequest,
                          HttpResponseForbidden,
                          HttpResponseNotFound)
 from pamietacz.models import (Shelf,
@@ -7,12 +10,16 @@ from pamietacz.models import (Shelf,
                               TrainSession,
                               TrainPool,
                               TrainCard,
+                              Review,
                               UserProfile)
 from test_utils import (add_shelf,
                         add_deck,
                         add_card,
-                        TestCaseWithAuthentication)
+                        TestCaseWithAuthentication,
+                        TransactionTestCaseWithAuthentication)
 import datetime
+import json
+import time
 
 
 class StartStopShelfTests(TestCaseWithAuthentication):
@@ -200,10 +207,14 @@ class TrainTests(TestCaseWithAuthentication):
         # The training cards was also not deleted.
         traincards = TrainCard.objects.all()
         self.assertEqual(len(traincards), 1)
+        self.assertEqual(Review.objects.count(), 1)
 
         # Stop shelf.
         self.client.get("/user/shelf/%s/stop/" % shelf.id)
 
+        # History of answers is deleted.
+        self.assertEqual(Review.objects.count(), 0)
+
         # But training pool is still present.
         trainpools = TrainPool.objects.all()
         self.assertEqual(len(trainpools), 0)
@@ -845,8 +856,7 @@ class TrainTests(TestCaseWithAuthentication):
         # Maximum 10 cards are in this session.
         trainsessions = TrainSession.objects.all()
         session = trainsessions[0]
-        traincards_of_session = session.train_cards.split(",")
-        self.assertEqual(len(traincards_of_session), 10)
+        self.assertEqual(session.trainsessioncard_set.count(), 10)
 
     def test_train_all_option_gets_all_cards_in_session(self):
         """Except normal train session which gets in session max
@@ -883,5 +893,460 @@ class TrainTests(TestCaseWithAuthentication):
         # All 20 cards will be put in session.
         trainsessions = TrainSession.objects.all()
         session = trainsessions[0]
-        traincards_of_session = session.train_cards.split(",")
-        self.assertEqual(len(traincards_of_session), 20)
+        self.assertEqual(session.trainsessioncard_set.count(), 20)
+
+    def test_train_cards_remember_user_and_deck(self):
+        """Train cards are created for user who trains the deck and
+        stopping shelf removes only train cards of this user."""
+
+        add_shelf(self.client, "Some nice shelf")
+        shelf = Shelf.objects.all()[0]
+        add_deck(self.client, shelf.id, "Some nice deck")
+        deck = Deck.objects.all()[0]
+        add_card(self.client, deck.id, "What is it?", "This is that.")
+
+        # Other user trains the same deck.
+        other = UserProfile.objects.create_user(username="Other",
+                                                password="Password")
+        other.shelves.add(shelf)
+        TrainPool.create_train_pool(other, deck)
+
+        # Start shelf and train a deck.
+        self.client.get("/user/shelf/%s/start/" % shelf.id)
+        self.client.get("/user/deck/%s/train/" % deck.id)
+
+        profile = UserProfile.objects.get(username="John")
+        self.assertEqual(
+            TrainCard.objects.filter(userprofile=profile, deck=deck).count(),
+            1)
+        self.assertEqual(
+            TrainCard.objects.filter(userprofile=other, deck=deck).count(),
+            1)
+
+        # New card is added to train pools of both users.
+        add_card(self.client, deck.id, "What was it?", "This was that.")
+        self.assertEqual(
+            TrainCard.objects.filter(userprofile=profile, deck=deck).count(),
+            2)
+        self.assertEqual(
+            TrainCard.objects.filter(userprofile=other, deck=deck).count(),
+            2)
+
+        # Stop shelf - train cards of other user are kept.
+        self.client.get("/user/shelf/%s/stop/" % shelf.id)
+        self.assertEqual(TrainCard.objects.filter(userprofile=profile).count(),
+                         0)
+        self.assertEqual(TrainCard.objects.filter(userprofile=other).count(),
+                         2)
+
+    def test_train_cards_are_created_with_constant_number_of_queries(self):
+        """Train cards are created in bulk when deck is started and when
+        card is added to deck trained by many users."""
+        add_shelf(self.client, "Some nice shelf")
+        shelf = Shelf.objects.all()[0]
+        add_deck(self.client, shelf.id, "Some nice deck")
+        deck = Deck.objects.all()[0]
+        for i in range(30):
+            add_card(self.client, deck.id, "Question %d" % i, "Answer")
+        profile = UserProfile.objects.get(username="John")
+        # Train pool, due counter (2 queries) and train cards.
+        with self.assertNumQueries(4):
+            TrainPool.create_train_pool(profile, deck)
+        self.assertEqual(TrainCard.objects.filter(userprofile=profile,
+                                                  deck=deck).count(), 30)
+
+        for i in range(20):
+            other = UserProfile.objects.create(username="Other %d" % i)
+            TrainPool.create_train_pool(other, deck)
+        card = Card.objects.create(deck=deck,
+                                   question="New question",
+                                   answer="New answer")
+        # Train pools are counted and then train cards are inserted.
+        with self.assertNumQueries(2):
+            TrainPool.add_card_to_train_pools(card)
+        self.assertEqual(TrainCard.objects.filter(card=card).count(), 21)
+
+    def test_train_all_cards_of_big_deck(self):
+        """Session of train all option has no limit of cards and
+        answering a card costs the same number of queries regardless of
+        the size of session."""
+        add_shelf(self.client, "Some nice shelf")
+        shelf = Shelf.objects.all()[0]
+        add_deck(self.client, shelf.id, "Some nice deck")
+        deck = Deck.objects.all()[0]
+        Card.objects.bulk_create([
+            Card(deck=deck,
+                 question="Question %d" % i,
+                 answer="Answer %d" % i,
+                 question_after_markdown="<p>Question %d</p>" % i,
+                 answer_after_markdown="<p>Answer %d</p>" % i)
+            for i in range(500)])
+        self.client.get("/user/shelf/%s/start/" % shelf.id)
+        self.client.get("/user/deck/%s/train/all/" % deck.id)
+        session = TrainSession.objects.all()[0]
+        self.assertEqual(session.trainsessioncard_set.count(), 500)
+
+        # Session of request, user, train session, card to answer, saving
+        # changed columns of train card, saving review, updating due
+        # counter, next card, saving train session.
+        with self.assertNumQueries(9):
+            r = self.client.post("/user/train/session/%s/" % session.id,
+                                 {"Answer": "Good"})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(TrainSession.objects.get().current_card_index, 1)
+
+    def test_card_deleted_during_session_is_skipped(self):
+        add_shelf(self.client, "Some nice shelf")
+        shelf = Shelf.objects.all()[0]
+        add_deck(self.client, shelf.id, "Some nice deck")
+        deck = Deck.objects.all()[0]
+        add_card(self.client, deck.id, "What is it?", "This is that.")
+        add_card(self.client, deck.id, "What was it?", "This was that.")
+        self.client.get("/user/shelf/%s/start/" % shelf.id)
+        self.client.get("/user/deck/%s/train/" % deck.id)
+        session = TrainSession.objects.all()[0]
+
+        # Card which is now shown is deleted so the other one is shown.
+        card = session.get_train_card().card
+        self.client.get("/card/%s/delete/" % card.id)
+        other_card = Card.objects.get()
+        r = self.client.get("/user/train/session/%s/" % session.id)
+        self.assertIn(str(other_card.question), r.content)
+
+        # Session is finished after answer.
+        r = self.client.post("/user/train/session/%s/" % session.id,
+                             {"Answer": "Good"})
+        self.assertEqual(r.status_code, HttpResponseRedirect.status_code)
+        self.assertEqual(TrainSession.objects.count(), 0)
+
+    def test_answers_are_kept_in_reviews(self):
+        add_shelf(self.client, "Some nice shelf")
+        shelf = Shelf.objects.all()[0]
+        add_deck(self.client, shelf.id, "Some nice deck")
+        deck = Deck.objects.all()[0]
+        add_card(self.client, deck.id, "What is it?", "This is that.")
+        card = Card.objects.get()
+        self.client.get("/user/shelf/%s/start/" % shelf.id)
+        for answer in ["Good", "Good", "Bad", "Good"]:
+            # Card is to repeat again.
+            TrainCard.objects.update(time_to_show=datetime.datetime.now())
+            self.client.get("/user/deck/%s/train/all/" % deck.id)
+            session = TrainSession.objects.get()
+            self.client.post("/user/train/session/%s/" % session.id,
+                             {"Answer": answer})
+
+        reviews = Review.objects.order_by("id")
+        self.assertEqual([(review.q, review.previous_interval,
+                           review.interval) for review in reviews],
+                         [(5, 0, 1), (5, 1, 6), (0, 6, 6), (5, 6, 1)])
+        userprofile = UserProfile.objects.get()
+        for review in reviews:
+            self.assertEqual(review.userprofile, userprofile)
+            self.assertEqual(review.card, card)
+        self.assertEqual(TrainCard.objects.get().i, reviews[3].interval)
+
+
+@override_settings(LAZY_TRAIN_CARDS=True)
+class LazyTrainCardsTests(TestCaseWithAuthentication):
+    def test_train_card_is_saved_on_first_answer(self):
+        """Train cards are not created when deck is started or card is
+        added. Card without train card can be trained now."""
+        add_shelf(self.client, "Some nice shelf")
+        shelf = Shelf.objects.all()[0]
+        add_deck(self.client, shelf.id, "Some nice deck")
+        deck = Deck.objects.all()[0]
+        add_card(self.client, deck.id, "What is it?", "This is that.")
+        self.client.get("/user/shelf/%s/start/" % shelf.id)
+
+        # Train a new deck - no train cards are created.
+        self.client.get("/user/deck/%s/train/" % deck.id)
+        self.assertEqual(TrainPool.objects.count(), 1)
+        self.assertEqual(TrainCard.objects.count(), 0)
+
+        # New card is added but still no train cards are created.
+        add_card(self.client, deck.id, "What was it?", "This was that.")
+        self.assertEqual(TrainCard.objects.count(), 0)
+
+        # Both cards can be trained now.
+        r = self.client.get("/")
+        self.assertIn("2 items to train", r.content)
+        r = self.client.get("/user/shelf/%s/show/" % shelf.id)
+        self.assertIn("(2 / 2)", r.content)
+        r = self.client.get("/user/deck/%s/show/" % deck.id)
+        self.assertIn("What is it?", r.content)
+        self.assertIn("What was it?", r.content)
+        self.assertNotIn("from now", r.content)
+
+        # Session is started with cards without train cards.
+        session = TrainSession.objects.all()[0]
+        self.assertEqual(session.trainsessioncard_set.count(), 1)
+        r = self.client.post("/user/train/session/%s/" % session.id,
+                             {"Answer": "Good"})
+
+        # Train card is saved after the answer.
+        self.assertEqual(TrainCard.objects.count(), 1)
+        r = self.client.get("/user/shelf/%s/show/" % shelf.id)
+        self.assertIn("(1 / 2)", r.content)
+        r = self.client.get("/user/deck/%s/show/" % deck.id)
+        self.assertIn("23 minutes from now", r.content)
+
+        # Only the second card is in new session.
+        self.client.get("/user/deck/%s/train/" % deck.id)
+        session = TrainSession.objects.all()[0]
+        self.assertEqual(session.get_train_card().card.question,
+                         "What was it?")
+        self.assertIsNone(session.get_train_card().id)
+
+
+class ChooseCardsToRepeatTests(TestCaseWithAuthentication):
+    def setUp(self):
+        super(ChooseCardsToRepeatTests, self).setUp()
+        add_shelf(self.client, "Some nice shelf")
+        shelf = Shelf.objects.all()[0]
+        add_deck(self.client, shelf.id, "Some nice deck")
+        self.deck = Deck.objects.all()[0]
+        for i in range(4):
+            add_card(self.client, self.deck.id, "Question %d" % i, "Answer")
+        self.profile = UserProfile.objects.get(username="John")
+        self.train_pool = TrainPool.create_train_pool(self.profile,
+                                                      self.deck)
+
+        # Cards have different time to show and EF. The last card
+        # is not ready to repeat.
+        now = datetime.datetime.now()
+        self.cards = list(Card.objects.order_by("id"))
+        for card, days, ef in ((self.cards[0], -1, 2.0),
+                               (self.cards[1], -3, 2.5),
+                               (self.cards[2], -2, 1.3),
+                               (self.cards[3], 1, 1.5)):
+            TrainCard.objects.filter(card=card).update(
+                time_to_show=now + datetime.timedelta(days=days), ef=ef)
+
+    def chosen_cards(self, limit, order):
+        return [card_id for card_id, train_card_id in
+                self.train_pool.choose_cards_to_repeat_now(limit, order)]
+
+    def test_most_overdue_order(self):
+        self.assertEqual(self.chosen_cards(None, "most_overdue"),
+                         [self.cards[1].id,
+                          self.cards[2].id,
+                          self.cards[0].id])
+        self.assertEqual(self.chosen_cards(1, "most_overdue"),
+                         [self.cards[1].id])
+
+    def test_lowest_ef_order(self):
+        self.assertEqual(self.chosen_cards(2, "lowest_ef"),
+                         [self.cards[2].id, self.cards[0].id])
+
+    def test_random_order(self):
+        chosen = self.chosen_cards(2, "random")
+        self.assertEqual(len(chosen), 2)
+        self.assertTrue(set(chosen) < set(card.id for card in self.cards[:3]))
+
+    def test_train_card_ids_are_returned(self):
+        chosen = dict(self.train_pool.choose_cards_to_repeat_now(
+            None, "random"))
+        for card in self.cards[:3]:
+            self.assertEqual(chosen[card.id],
+                             TrainCard.objects.get(card=card).id)
+
+    def test_unknown_order(self):
+        self.assertRaises(ValueError, self.chosen_cards, 1, "unknown")
+
+    def test_random_cards_are_chosen_from_the_most_overdue(self):
+        old_factor = TrainPool.CANDIDATES_FACTOR["random"]
+        TrainPool.CANDIDATES_FACTOR["random"] = 1
+        try:
+            for i in range(10):
+                self.assertEqual(self.chosen_cards(1, "random"),
+                                 [self.cards[1].id])
+        finally:
+            TrainPool.CANDIDATES_FACTOR["random"] = old_factor
+
+    @override_settings(TRAIN_SESSION_ORDER="most_overdue")
+    def test_session_is_created_with_constant_number_of_queries(self):
+        with self.assertNumQueries(3):
+            train_session = TrainSession.create_train_session(
+                self.profile, self.deck, self.train_pool, False)
+        self.assertEqual(train_session.get_train_card().card,
+                         self.cards[1])
+
+
+class ChooseCardsQueryPlanTests(TransactionTestCaseWithAuthentication):
+    """PRAGMA and EXPLAIN commit transaction in SQLite so they can't be
+    run inside transaction."""
+
+    def test_due_train_cards_are_found_by_index(self):
+        add_shelf(self.client, "Some nice shelf")
+        add_deck(self.client, Shelf.objects.get().id, "Some nice deck")
+        deck = Deck.objects.get()
+        add_card(self.client, deck.id, "What is it?", "This is that.")
+        train_pool = TrainPool.create_train_pool(
+            UserProfile.objects.get(username="John"), deck)
+        cursor = connection.cursor()
+        cursor.execute("PRAGMA index_list(%s)" % TrainCard._meta.db_table)
+        index_name, = [
+            name for name in [row[1] for row in cursor.fetchall()]
+            if [row[2] for row in cursor.execute(
+                "PRAGMA index_info(%s)" % name).fetchall()] ==
+            ["userprofile_id", "deck_id", "time_to_show"]]
+        for order in ["random", "most_overdue"]:
+            query, params = train_pool.cards_to_repeat_now_query(2, order)
+            cursor.execute("EXPLAIN QUERY PLAN " + query, params)
+            plan = "\n".join(row[-1] for row in cursor.fetchall())
+            # Due train cards are read in order of index so only the
+            # candidates are sorted.
+            self.assertIn("USING INDEX %s " % index_name, plan)
+            self.assertEqual(plan.count("TEMP B-TREE"), 1, plan)
+
+
+class TrainSessionJsonTests(TestCaseWithAuthentication):
+    def setUp(self):
+        super(TrainSessionJsonTests, self).setUp()
+        add_shelf(self.client, "Some nice shelf")
+        self.shelf = Shelf.objects.all()[0]
+        add_deck(self.client, self.shelf.id, "Some nice deck")
+        deck = Deck.objects.all()[0]
+        for i in range(7):
+            add_card(self.client, deck.id, "Question %d" % i, "Answer %d" % i)
+        self.client.get("/user/shelf/%s/start/" % self.shelf.id)
+        self.client.get("/user/deck/%s/train/" % deck.id)
+        self.session = TrainSession.objects.get()
+        self.cards_url = "/user/train/session/%s/cards/" % self.session.id
+        self.answers_url = ("/user/train/session/%s/answers/" %
+                            self.session.id)
+
+    def get_cards(self, **parameters):
+        r = self.client.get(self.cards_url, parameters)
+        self.assertEqual(r["Content-Type"], "application/json")
+        return json.loads(r.content)
+
+    def test_current_and_next_cards_are_returned(self):
+        data = self.get_cards()
+        self.assertEqual([card["position"] for card in data["cards"]],
+                         range(5))
+        self.assertEqual(data["finish_url"],
+                         "/user/shelf/%s/show/" % self.shelf.id)
+        current_card = self.session.get_train_card().card
+        self.assertEqual(data["cards"][0]["question"],
+                         current_card.question_after_markdown)
+        self.assertEqual(data["cards"][0]["answer"],
+                         current_card.answer_after_markdown)
+
+        # Next cards are returned from given position.
+        data = self.get_cards(**{"from": 5})
+        self.assertEqual([card["position"] for card in data["cards"]],
+                         [5, 6])
+        data = self.get_cards(**{"from": 7})
+        self.assertEqual(data["cards"], [])
+
+    def test_user_cannot_use_sessions_of_other_users(self):
+        UserProfile.objects.create_user(username="Other", password="Password")
+        self.client.logout()
+        self.client.login(username="Other", password="Password")
+        r = self.client.get(self.cards_url)
+        self.assertEqual(r.status_code, HttpResponseForbidden.status_code)
+        r = self.post_answers([])
+        self.assertEqual(r.status_code, HttpResponseForbidden.status_code)
+
+    def post_answers(self, answers):
+        return self.client.post(self.answers_url,
+                                json.dumps({"answers": answers}),
+                                content_type="application/json")
+
+    def test_answers_are_saved_in_batch(self):
+        data = self.get_cards()
+        cards = [card["card"] for card in data["cards"]]
+        # Answered an hour ago.
+        answered_at = int((time.time() - 3600) * 1000)
+        answers = [{"card": cards[0], "answer": "Good", "time": answered_at},
+                   {"card": cards[1], "answer": "Bad", "time": answered_at},
+                   {"card": cards[2], "answer": "Good", "time": answered_at}]
+        r = self.post_answers(answers)
+        self.assertEqual(json.loads(r.content), {"finished": False})
+        self.assertEqual(TrainSession.objects.get().current_card_index, 3)
+        train_card = TrainCard.objects.get(card=cards[0])
+        self.assertEqual(train_card.n, 1)
+        # Interval is counted from time of answer so the card is already
+        # to repeat.
+        self.assertTrue(train_card.time_to_show < datetime.datetime.now())
+        self.assertEqual(TrainCard.objects.get(card=cards[1]).n, 0)
+        reviews = Review.objects.order_by("id")
+        self.assertEqual([(review.card_id, review.q) for review in reviews],
+                         [(cards[0], 5), (cards[1], 0), (cards[2], 5)])
+        self.assertEqual(reviews[0].time,
+                         datetime.datetime.fromtimestamp(answered_at / 1000.0))
+
+        # Answers sent again are ignored.
+        r = self.post_answers(answers)
+        self.assertEqual(TrainCard.objects.filter(n=1).count(), 2)
+        self.assertEqual(Review.objects.count(), 3)
+
+        # The rest of answers finishes the session.
+        data = self.get_cards(**{"from": 3})
+        r = self.post_answers([{"card": card["card"],
+                                "answer": "Good",
+                                "time": answered_at}
+                               for card in data["cards"]])
+        self.assertEqual(json.loads(r.content), {"finished": True})
+        self.assertEqual(TrainSession.objects.count(), 0)
+        self.assertEqual(TrainCard.objects.filter(n=1).count(), 6)
+
+    def test_answers_are_saved_from_form_field(self):
+        # Beacon sent when page is closed can't set CSRF header.
+        data = self.get_cards()
+        answers = [{"card": card["card"],
+                    "answer": "Good",
+                    "time": int(time.time() * 1000)}
+                   for card in data["cards"][:2]]
+        r = self.client.post(self.answers_url,
+                             {"answers": json.dumps({"answers": answers})})
+        self.assertEqual(json.loads(r.content), {"finished": False})
+        self.assertEqual(TrainSession.objects.get().current_card_index, 2)
+
+    def test_batch_of_answers_is_saved_without_extra_queries(self):
+        data = self.get_cards()
+        answered_at = int(time.time() * 1000)
+        answers = [{"card": card["card"],
+                    "answer": "Good",
+                    "time": answered_at} for card in data["cards"]]
+        # Session of request, user, train session, cards to answer,
+        # saving each train card, saving all reviews, updating due counter,
+        # saving train session and checking if session is finished.
+        with self.assertNumQueries(8 + len(answers)):
+            self.post_answers(answers)
+        self.assertEqual(TrainCard.objects.filter(n=1).count(), len(answers))
+        self.assertEqual(Review.objects.count(), len(answers))
+
+    def test_wrong_batch_of_answers(self):
+        t = int(time.time() * 1000)
+        for answers in ([{"card": 1, "answer": "Maybe", "time": t}],
+                        [{"card": 1, "answer": "Good"}],
+                        [{"card": "x", "answer": "Good", "time": t}],
+                        [{"card": 1, "answer": "Good", "time": t}] * 101):
+            r = self.post_answers(answers)
+            self.assertEqual(r.status_code,
+                             HttpResponseBadRequest.status_code)
+        r = self.client.post(self.answers_url, "not json",
+                             content_type="application/json")
+        self.assertEqual(r.status_code, HttpResponseBadRequest.status_code)
+        self.assertEqual(TrainSession.objects.get().current_card_index, 0)
+
+
+class AnswerManyTransactionTests(TransactionTestCaseWithAuthentication):
+    def test_answers_dont_commit_transaction_of_caller(self):
+        add_shelf(self.client, "Some nice shelf")
+        shelf = Shelf.objects.get()
+        add_deck(self.client, shelf.id, "Some nice deck")
+        deck = Deck.objects.get()
+        add_card(self.client, deck.id, "What is it?", "This is that.")
+        self.client.get("/user/shelf/%s/start/" % shelf.id)
+        self.client.get("/user/deck/%s/train/" % deck.id)
+        train_session = TrainSession.objects.get()
+        card = Card.objects.get()
+        with transaction.commit_manually():
+            self.assertTrue(train_session.answer_many(
+                [(card.id, 5, datetime.datetime.now())]))
+            transaction.rollback()
+        self.assertEqual(Review.objects.count(), 0)
+        self.assertEqual(TrainSession.objects.get().current_card_index, 0)
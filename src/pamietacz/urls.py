@@ -42,6 +42,10 @@ urlpatterns = patterns(
      "pamietacz.views.user_train_deck", {"all_cards": True}),
     (r"^user/train/session/(?P<session_id>\d+)/$",
      "pamietacz.views.user_train_session"),
+    (r"^user/train/session/(?P<session_id>\d+)/cards/$",
+     "pamietacz.views.user_train_session_cards"),
+    (r"^user/train/session/(?P<session_id>\d+)/answers/$",
+     "pamietacz.views.user_train_session_answers"),
     (r"^user/deck/(?P<deck_id>\d+)/show/$",
      "pamietacz.views.user_show_deck"),
     (r"^data/dump/$", "pamietacz.views.dump_data"),
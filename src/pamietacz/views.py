@@ -5,21 +5,34 @@ from django.core.exceptions import PermissionDenied
 from django.forms.util import ErrorList
 from django.http import Http404
 from django.http import HttpResponse, HttpResponseBadRequest
+from django.http import StreamingHttpResponse
 from django.shortcuts import render, redirect, get_object_or_404
 from django.views.decorators.http import require_http_methods
 from django.core.files.storage import default_storage
 from django.core.files.base import ContentFile
+from django.db import transaction
 from forms import (ShelfForm,
                    DeckForm,
                    CardForm,
                    DataDumpUploadFileForm,
                    UserProfileCreationForm,
                    UploadedImage)
-from models import Shelf, Deck, Card, TrainSession, TrainPool, TrainCard
+from models import (Shelf,
+                    Deck,
+                    Card,
+                    TrainSession,
+                    TrainPool,
+                    TrainCard,
+                    DueCounter,
+                    Review,
+                    Job)
 import datetime
+import json
 from collections import OrderedDict
 from utils import backup
-from dump_load import (dump_data_as_xml,
+from database import retry_write
+from due_counts import count_cards_to_repeat_now
+from dump_load import (dump_data_as_xml_chunks,
                        load_data_as_xml,
                        XMLDataDumpException)
 from lxml import etree
@@ -137,14 +150,18 @@ def show_deck(request, deck_id):
     """Show what cards are available for specific deck."""
     deck = get_object_or_404(Deck, pk=deck_id)
     cards = Card.objects.filter(deck=deck).order_by("id")
+
+    # Show progress of background jobs which are not finished yet.
+    jobs = Job.objects.filter(deck=deck).exclude(status=Job.DONE)
     return render(request,
                   "show_deck.html",
-                  {"deck": deck, "cards": cards})
+                  {"deck": deck, "cards": cards, "jobs": jobs})
 
 
 @login_required
 @backup
 @require_http_methods(["GET", "POST"])
+@transaction.commit_on_success
 def add_edit_card(request, deck_id=None, card_id=None):
     if card_id:
         card = get_object_or_404(Card, pk=card_id)
@@ -165,15 +182,7 @@ def add_edit_card(request, deck_id=None, card_id=None):
                 deck = get_object_or_404(Deck, pk=deck_id)
                 card.deck = deck
                 card.save()
-
-                # If new card is added then we need also to add it
-                # to train pools so user can train it also from now.
-                trainpools = TrainPool.objects.filter(deck=deck)
-                for train_pool in trainpools:
-                    train_card = TrainCard(card=card)
-                    train_card.save()
-                    train_pool.train_cards.add(train_card)
-                    train_pool.save()
+                TrainPool.add_card_to_train_pools(card)
                 return redirect(request.path)
             else:
                 # Card is edited.
@@ -202,6 +211,7 @@ def upload_image(request):
 @login_required
 @backup
 @require_http_methods(["GET"])
+@transaction.commit_on_success
 def delete_card(request, card_id):
     card = get_object_or_404(Card, pk=card_id)
     deck_id = card.deck.id
@@ -229,16 +239,8 @@ def register_new_user(request):
 def user_shelves(request):
     """Show what shelves user started to learn."""
     profile = request.user
-    shelves = profile.shelves.all()
-    items_to_train_dict = {}
-    for shelf in shelves:
-        train_pools = TrainPool.objects.filter(
-            userprofile=profile,
-            deck__in=shelf.deck_set.all())
-        items_to_train_dict[shelf.id] = 0
-        for train_pool in train_pools:
-            items_to_train_dict[shelf.id] +=\
-                train_pool.number_of_cards_to_repeat_now()
+    shelves = list(profile.shelves.all())
+    items_to_train_dict, _ = count_cards_to_repeat_now(profile, shelves)
     return render(request,
                   "user_shelves.html",
                   {"all_shelves": shelves,
@@ -270,15 +272,13 @@ def stop_shelf(request, shelf_id):
     profile = request.user
     profile.shelves.remove(shelf)
     profile.save()
-    decks = Deck.objects.filter(shelf=shelf)
-    for deck in decks:
-        trainpools = TrainPool.objects.filter(deck=deck,
-                                              userprofile=profile)
-        for trainpool in trainpools:
-            trainpool.train_cards.all().delete()
-            trainpool.delete()
-        TrainSession.objects.filter(deck=deck,
-                                    userprofile=profile).delete()
+    TrainCard.objects.filter(deck__shelf=shelf, userprofile=profile).delete()
+    TrainPool.objects.filter(deck__shelf=shelf, userprofile=profile).delete()
+    DueCounter.objects.filter(deck__shelf=shelf, userprofile=profile).delete()
+    TrainSession.objects.filter(deck__shelf=shelf,
+                                userprofile=profile).delete()
+    Review.objects.filter(card__deck__shelf=shelf,
+                          userprofile=profile).delete()
     return redirect(request.GET.get("next", "/"))
 
 
@@ -295,20 +295,14 @@ def user_show_shelf(request, shelf_id):
 
     # Check if some sessions were started and if so
     # then display link Continue session instead of Train.
-    started_sessions = TrainSession.objects.filter(deck__in=decks,
+    started_sessions = TrainSession.objects.filter(deck__shelf=shelf,
                                                    userprofile=profile)
-    decks_ids = [train_session.deck.id
-                 for train_session in started_sessions]
+    decks_ids = list(started_sessions.values_list("deck_id", flat=True))
 
-    # Retrieve train pools (card sets) for specific user.
-    train_pools = TrainPool.objects.filter(userprofile=profile,
-                                           deck__in=decks)
-
-    # Get the number of cards ready to repeat for specific training pool.
-    number_of_cards_to_repeat_now = {}
-    for train_pool in train_pools:
-        number_of_cards_to_repeat_now[train_pool.deck.id] =\
-            train_pool.number_of_cards_to_repeat_now()
+    # Get the number of cards ready to repeat for decks which have
+    # train pool (card set) for specific user.
+    _, number_of_cards_to_repeat_now = (
+        count_cards_to_repeat_now(profile, [shelf]))
 
     return render(request,
                   "user_show_shelf.html",
@@ -322,6 +316,7 @@ def user_show_shelf(request, shelf_id):
 @login_required
 @backup
 @require_http_methods(["GET"])
+@retry_write
 def user_train_deck(request, deck_id, all_cards=False):
     """Prepare deck to be trained -
     create/get train pool, create/get train session."""
@@ -350,15 +345,30 @@ ANSWER_PARAMETER_NAME = "Answer"
 AVAILABLE_ANSWERS = OrderedDict([("Good", 5), ("Bad", 0)])
 
 
-@login_required
-@require_http_methods(["GET", "POST"])
-def user_train_session(request, session_id):
-    """This method displays appropriate question for given session."""
+# How many cards are sent at once to the browser so it can show next
+# card without waiting for the server.
+NUMBER_OF_PREFETCHED_CARDS = 5
+
+
+def get_train_session_of_user(request, session_id):
     train_session = get_object_or_404(TrainSession, pk=session_id)
     profile = request.user
     # Check if user can do this session.
-    if train_session.userprofile.id != profile.id:
+    if train_session.userprofile_id != profile.id:
         raise PermissionDenied
+    return train_session
+
+
+def json_response(data):
+    return HttpResponse(json.dumps(data), content_type="application/json")
+
+
+@login_required
+@require_http_methods(["GET", "POST"])
+@retry_write
+def user_train_session(request, session_id):
+    """This method displays appropriate question for given session."""
+    train_session = get_train_session_of_user(request, session_id)
 
     # Check if answer was sent - if yes then get new question.
     answer = request.POST.get(ANSWER_PARAMETER_NAME, None)
@@ -369,8 +379,8 @@ def user_train_session(request, session_id):
 
         # Calculate new time interval for given answer.
         if train_card is not None:
-            train_card.calculate_interval(AVAILABLE_ANSWERS[answer])
-            train_card.save()
+            train_session.save_answers(
+                [(train_card, AVAILABLE_ANSWERS[answer], None)])
         train_session.increase_train_card_index()
 
     # Get new card.
@@ -383,16 +393,79 @@ def user_train_session(request, session_id):
         return redirect(reverse("pamietacz.views.user_show_shelf",
                                 args=(shelf_id,)))
 
-    train_session.save()
+    train_session.save(update_fields=["current_card_index"])
 
     return render(request,
                   "user_train_session.html",
                   {"train_card": train_card,
+                   "train_session": train_session,
                    "request": request,
                    "answer_parameter_name": ANSWER_PARAMETER_NAME,
                    "available_answers": AVAILABLE_ANSWERS})
 
 
+@login_required
+@require_http_methods(["GET"])
+def user_train_session_cards(request, session_id):
+    """Return as JSON the current card of session and next cards so
+    browser can show them without waiting for the server. Cards are
+    returned from the position given in 'from' parameter or from the
+    current card."""
+    train_session = get_train_session_of_user(request, session_id)
+    position = request.GET.get("from", "")
+    if position.isdigit():
+        position = int(position)
+    else:
+        position = train_session.current_card_index
+    train_session_cards = train_session.next_train_session_cards(
+        position, NUMBER_OF_PREFETCHED_CARDS)
+    cards = [{"position": train_session_card.position,
+              "card": train_session_card.card_id,
+              "question": train_session_card.card.question_after_markdown,
+              "answer": train_session_card.card.answer_after_markdown}
+             for train_session_card in train_session_cards]
+    finish_url = reverse("pamietacz.views.user_show_shelf",
+                         args=(train_session.deck.shelf_id,))
+    return json_response({"cards": cards, "finish_url": finish_url})
+
+
+# How many answers can be sent at once.
+MAX_NUMBER_OF_ANSWERS_IN_BATCH = 100
+
+
+@login_required
+@require_http_methods(["POST"])
+@retry_write
+def user_train_session_answers(request, session_id):
+    """Save many answers sent at once in background. Request body is JSON
+    object with list of answers, e.g.:
+    {"answers": [{"card": 1, "answer": "Good", "time": 1381993200000}]}.
+    Time of answer is given in milliseconds since epoch. The same object
+    can be sent in 'answers' form field (answers sent by beacon when page
+    is closed). When all cards are answered then the session is
+    finished."""
+    train_session = get_train_session_of_user(request, session_id)
+    now = datetime.datetime.now()
+    answers = []
+    try:
+        data = json.loads(request.POST.get("answers") or request.body)
+        if len(data["answers"]) > MAX_NUMBER_OF_ANSWERS_IN_BATCH:
+            return HttpResponseBadRequest()
+        for answer in data["answers"]:
+            answered_at = datetime.datetime.fromtimestamp(
+                answer["time"] / 1000.0)
+            answers.append((int(answer["card"]),
+                            AVAILABLE_ANSWERS[answer["answer"]],
+                            # Time of answer can't be later than now.
+                            min(answered_at, now)))
+    except (ValueError, TypeError, KeyError):
+        return HttpResponseBadRequest()
+    finished = train_session.answer_many(answers)
+    if finished:
+        train_session.delete()
+    return json_response({"finished": finished})
+
+
 @login_required
 @require_http_methods(["GET"])
 def user_show_deck(request, deck_id):
@@ -406,9 +479,14 @@ def user_show_deck(request, deck_id):
     # Show 404 if this training for this deck was not started.
     try:
         train_pool = TrainPool.objects.get(deck=deck, userprofile=profile)
-        train_cards = train_pool.train_cards.all().order_by('time_to_show')
     except TrainPool.DoesNotExist:
         raise Http404
+
+    # New cards which were never answered can be repeated now so they
+    # are shown first.
+    train_cards = train_pool.new_train_cards()
+    train_cards.extend(train_pool.train_cards.select_related(
+        "card").order_by("time_to_show"))
     return render(request,
                   "user_show_deck.html",
                   {"deck": deck,
@@ -420,8 +498,8 @@ def user_show_deck(request, deck_id):
 def dump_data(request):
     """Save all shelf/deck/card data and return as XML file. User specific
     is not dumped."""
-    file_content = dump_data_as_xml()
-    file_response = HttpResponse(file_content, content_type="application/xml")
+    file_response = StreamingHttpResponse(dump_data_as_xml_chunks(),
+                                          content_type="application/xml")
     content_disposition = 'attachment; filename="dump_data.xml"'
     file_response["Content-Disposition"] = content_disposition
     return file_response
@@ -438,7 +516,8 @@ def load_data(request):
         upload_form = DataDumpUploadFileForm(request.POST, request.FILES)
         if upload_form.is_valid():
             try:
-                load_data_as_xml(request.FILES["data_dump_file"])
+                load_data_as_xml(request.FILES["data_dump_file"],
+                                 merge=upload_form.cleaned_data["merge"])
                 return redirect(reverse("pamietacz.views.shelf_list"))
             except (XMLDataDumpException, etree.XMLSyntaxError) as e:
                 upload_form._errors["data_dump_file"] = ErrorList()